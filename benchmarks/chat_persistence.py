@@ -0,0 +1,51 @@
+"""
+Per-turn persistence latency of ChatHistoryService.add_chat_message (user message + assistant message).
+Point it at the Firestore emulator (FIRESTORE_EMULATOR_HOST) or a test project and run it on two commits
+to compare.
+
+    python -m benchmarks.chat_persistence --turns 50
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+from langchain.schema import AIMessage, HumanMessage
+
+from benchmarks.context_service_load import percentile
+from services.chat_history_service import ChatHistoryService
+from services.context_service import ContextService
+from services.conversation_service import ConversationService
+
+
+async def _run(turns: int):
+    uid = f'benchmark-{uuid.uuid4().hex}'
+    conversation_service = ConversationService(context_service=ContextService(client=None), uid=uid)
+    conversation_id = await conversation_service.create_new_conversation()
+    chat_history_service = ChatHistoryService(uid)
+
+    latencies = []
+    for turn in range(turns):
+        start = time.perf_counter()
+        await chat_history_service.add_chat_message(conversation_id, HumanMessage(content=f'question {turn}'))
+        await chat_history_service.add_chat_message(conversation_id, AIMessage(content=f'answer {turn}'))
+        latencies.append(time.perf_counter() - start)
+
+    return {
+        'turns': turns,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--turns', type=int, default=50)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(_run(args.turns)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Compares the token-aware TokenTextChunker against the previous CharacterTextSplitter over a corpus of
+page texts (every *.txt / *.md / *.html file below --corpus). Reports throughput, the distribution of
+tokens per chunk and peak traced memory.
+
+    python -m benchmarks.chunking --corpus pages/
+"""
+import argparse
+import json
+import pathlib
+import time
+import tracemalloc
+from typing import Callable, List
+
+from langchain.text_splitter import CharacterTextSplitter
+
+from benchmarks.context_service_load import percentile
+from config import Config
+from utils.text_chunker import TokenTextChunker
+from utils.tokens import count_tokens
+
+config = Config()
+
+
+def _load_corpus(corpus: str) -> List[str]:
+    paths = [p for p in pathlib.Path(corpus).rglob('*') if p.suffix in {'.txt', '.md', '.html'}]
+    return [p.read_text(errors='ignore') for p in sorted(paths)]
+
+
+def _run(name: str, split: Callable[[str], List[str]], texts: List[str]):
+    tracemalloc.start()
+    start = time.perf_counter()
+    chunks = [chunk for text in texts for chunk in split(text)]
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    token_counts = [count_tokens(chunk) for chunk in chunks] or [0]
+    megabytes = sum(len(text.encode('utf-8')) for text in texts) / 1024 / 1024
+    return {
+        'splitter': name,
+        'chunks': len(chunks),
+        'throughput_mb_s': megabytes / elapsed if elapsed else None,
+        'tokens_min': min(token_counts),
+        'tokens_p50': percentile(token_counts, 50),
+        'tokens_p95': percentile(token_counts, 95),
+        'tokens_max': max(token_counts),
+        'chunks_over_budget': sum(1 for tokens in token_counts if tokens > config.chunk_tokens),
+        'peak_memory_mb': peak / 1024 / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--corpus', required=True)
+    args = parser.parse_args()
+    texts = _load_corpus(args.corpus)
+
+    character_splitter = CharacterTextSplitter(
+        chunk_size=config.chunk_size, chunk_overlap=config.chunk_overlap, separator='.'
+    )
+    token_chunker = TokenTextChunker(config.chunk_tokens, config.chunk_overlap_tokens)
+    results = [
+        _run('CharacterTextSplitter', character_splitter.split_text, texts),
+        _run('TokenTextChunker', lambda text: [chunk for chunk, _ in token_chunker.iter_chunks([text])], texts),
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Load test for ContextService retrieval on the event loop.
+
+Simulates a Weaviate query with a fixed latency and measures the latency of a
+cheap concurrent request (standing in for `/`, SSE token frames, ...) while N
+searches are in flight, once calling the blocking `search` directly from the
+loop and once awaiting `asearch`.
+
+    python -m benchmarks.context_service_load --in-flight 1 2 4 8 16 --query-latency 0.05
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import List
+
+from services.context_service import ContextService
+
+
+class _FakeQuery:
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def __getattr__(self, item):
+        if item.startswith('with_'):
+            return lambda *args, **kwargs: self
+        raise AttributeError(item)
+
+    def do(self):
+        time.sleep(self.latency)
+        return {'data': {'Get': {'Document': [{
+            'title': 'title',
+            'url': 'https://example.com',
+            'content': 'content',
+            'firebase_id': 'id',
+            '_additional': {'score': 0.5},
+        }]}}}
+
+
+class _FakeQueryBuilder:
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def get(self, *args, **kwargs):
+        return _FakeQuery(self.latency)
+
+
+class FakeWeaviateClient:
+    def __init__(self, latency: float):
+        self.query = _FakeQueryBuilder(latency)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[idx]
+
+
+async def _probe(samples: int, interval: float) -> List[float]:
+    latencies = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        await asyncio.sleep(0)
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(interval)
+    return latencies
+
+
+async def _run(service: ContextService, in_flight: int, use_async: bool, samples: int):
+    async def search(i: int):
+        # distinct queries, identical ones in flight would be coalesced into one by asearch
+        query = f'query {i}'
+        if use_async:
+            await service.asearch(query, 'user', limit=3)
+        else:
+            service.search(query, 'user', limit=3)
+
+    async def searches():
+        # keep `in_flight` searches running for the whole probe window
+        for _ in range(samples // 10 + 1):
+            await asyncio.gather(*[search(i) for i in range(in_flight)])
+
+    start = time.perf_counter()
+    probe, _ = await asyncio.gather(_probe(samples, 0.001), searches())
+    return {
+        'mode': 'async' if use_async else 'blocking',
+        'in_flight': in_flight,
+        'probe_p50_ms': percentile(probe, 50) * 1000,
+        'probe_p99_ms': percentile(probe, 99) * 1000,
+        'wall_s': time.perf_counter() - start,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--in-flight', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--query-latency', type=float, default=0.05)
+    parser.add_argument('--samples', type=int, default=200)
+    args = parser.parse_args()
+
+    service = ContextService(client=FakeWeaviateClient(args.query_latency))
+    results = []
+    for in_flight in args.in_flight:
+        for use_async in (False, True):
+            results.append(asyncio.run(_run(service, in_flight, use_async, args.samples)))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
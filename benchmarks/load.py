@@ -0,0 +1,345 @@
+"""
+End-to-end load harness. Boots `main:app` with uvicorn against local stand-ins and drives `/chat`, `/search`,
+`/store`, `/storepdf` and `/chat-history` at a fixed concurrency, one endpoint after the other:
+
+- OpenAI: `benchmarks.mock_openai`, streaming answers with --token-latency between tokens
+- vector store: the embedded local backend (VECTORSTORE_BACKEND=local) in a temporary directory
+- Firestore: the emulator at FIRESTORE_EMULATOR_HOST, e.g. `gcloud emulators firestore start --host-port=127.0.0.1:8080`
+
+Reports latency percentiles, time to first token for /chat, time until the ingest job is done for /store and
+/storepdf, throughput and the server's RSS as JSON. Run it on two commits and diff the output.
+
+The OpenAI admission limits (LLM_RPM, LLM_TPM, EMBEDDING_RPM, EMBEDDING_TPM) are set to 0, i.e. unlimited,
+unless they are set in the environment. With the defaults queued /chat requests would get 429s after a short
+burst and the numbers would describe the rate limiter.
+
+    python -m benchmarks.load --concurrency 16 --requests 200 --output load.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List
+
+import aiohttp
+
+from benchmarks.context_service_load import percentile
+
+ENDPOINTS = ['store', 'storepdf', 'search', 'chat', 'chat-history']
+
+WORDS = ('bookmark search context answer vector chunk folder history question summary article paper '
+         'streaming latency throughput memory index tenant filter ranking').split()
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _text(seed: int, words: int) -> str:
+    return ' '.join(WORDS[(seed * 7 + i * 13) % len(WORDS)] for i in range(words))
+
+
+def _pdf(text: str) -> bytes:
+    """
+    A single page PDF with one line of text, enough for the PDF text extraction.
+    """
+    stream = f'BT /F1 12 Tf 72 720 Td ({text}) Tj ET'.encode()
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R /Resources << /Font << /F1 5 0 R >> >> >>',
+        b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream',
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    pdf = b'%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b'%d 0 obj\n' % number + body + b'\nendobj\n'
+    xref = len(pdf)
+    pdf += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    pdf += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    pdf += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return pdf
+
+
+def _rss_mb(pid: int) -> float:
+    """
+    Resident memory of the process and its children (PDF workers), Linux only.
+    """
+    total = 0
+    pids = [pid]
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total / 1024
+
+
+def _summary(values: List[float]) -> Dict[str, float] | None:
+    if not values:
+        return None
+    return {
+        'p50_ms': percentile(values, 50) * 1000,
+        'p95_ms': percentile(values, 95) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+    }
+
+
+class _Sample:
+    def __init__(self):
+        self.latency: float | None = None
+        self.ttft: float | None = None
+        self.completion: float | None = None
+        self.error: str | None = None
+
+
+class LoadHarness:
+    def __init__(self, base_url: str, session: aiohttp.ClientSession, users: int, poll_interval: float):
+        self.base_url = base_url
+        self.session = session
+        self.users = [f'load-{uuid.uuid4().hex}' for _ in range(users)]
+        self.conversations: Dict[str, str] = {}
+        self.poll_interval = poll_interval
+
+    def __user(self, i: int) -> str:
+        return self.users[i % len(self.users)]
+
+    async def __wait_for_job(self, user_id: str, job_id: str, timeout: float = 300) -> str:
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            async with self.session.get(f'{self.base_url}/store/status/{job_id}', headers={'x-uid': user_id}) as response:
+                job = await response.json()
+            if job['status'] in ('done', 'failed'):
+                return job['status']
+            await asyncio.sleep(self.poll_interval)
+        return 'timeout'
+
+    async def __ingest(self, path: str, user_id: str, payload: dict, sample: _Sample, start: float):
+        async with self.session.post(f'{self.base_url}{path}', json=payload, headers={'x-uid': user_id}) as response:
+            response.raise_for_status()
+            job_id = (await response.json())['job_id']
+        sample.latency = time.perf_counter() - start
+        status = await self.__wait_for_job(user_id, job_id)
+        if status != 'done':
+            raise Exception(f'ingest job {status}')
+        sample.completion = time.perf_counter() - start
+
+    async def store(self, i: int, sample: _Sample, start: float):
+        await self.__ingest('/store', self.__user(i), {
+            'raw_text': _text(i, 600),
+            'url': f'https://example.com/store/{i}',
+            'title': f'document {i}',
+            'image_urls': [],
+            'timestamp': int(time.time()),
+            'folder': f'folder {i % 3}',
+        }, sample, start)
+
+    async def storepdf(self, i: int, sample: _Sample, start: float):
+        await self.__ingest('/storepdf', self.__user(i), {
+            'pdf_bytes': list(_pdf(_text(i, 80))),
+            'url': f'https://example.com/pdf/{i}',
+            'title': f'pdf {i}',
+            'timestamp': int(time.time()),
+            'folder': f'folder {i % 3}',
+        }, sample, start)
+
+    async def search(self, i: int, sample: _Sample, start: float):
+        payload = {'query': _text(i, 4), 'limit_chunks': 10}
+        async with self.session.post(f'{self.base_url}/search', json=payload, headers={'x-uid': self.__user(i)}) as response:
+            response.raise_for_status()
+            await response.read()
+        sample.latency = time.perf_counter() - start
+
+    async def chat(self, i: int, sample: _Sample, start: float, conversation_id: str | None = None):
+        # unique questions, so the answer cache does not short-circuit the model
+        params = {'q': f'{_text(i, 6)} {uuid.uuid4().hex}', 'protocol': 2}
+        if conversation_id:
+            params['conversation_id'] = conversation_id
+        async with self.session.get(f'{self.base_url}/chat', params=params, headers={'x-uid': self.__user(i)}) as response:
+            response.raise_for_status()
+            async for line in response.content:
+                if sample.ttft is None and line.startswith(b'event: delta'):
+                    sample.ttft = time.perf_counter() - start
+        sample.latency = time.perf_counter() - start
+
+    async def prepare_chat_history(self, turns: int):
+        for user_id in self.users:
+            async with self.session.put(f'{self.base_url}/conversation', headers={'x-uid': user_id}) as response:
+                response.raise_for_status()
+                self.conversations[user_id] = await response.json()
+        for turn in range(turns):
+            await asyncio.gather(*[
+                self.chat(i, _Sample(), time.perf_counter(), self.conversations[user_id])
+                for i, user_id in enumerate(self.users)
+            ])
+
+    async def chat_history(self, i: int, sample: _Sample, start: float):
+        user_id = self.__user(i)
+        params = {'conversation_id': self.conversations[user_id]}
+        async with self.session.get(f'{self.base_url}/chat-history', params=params, headers={'x-uid': user_id}) as response:
+            response.raise_for_status()
+            await response.read()
+        sample.latency = time.perf_counter() - start
+
+
+async def _drive(request: Callable[[int, _Sample, float], Awaitable], requests: int, concurrency: int, server_pid: int) -> dict:
+    samples = [_Sample() for _ in range(requests)]
+    next_request = iter(range(requests))
+    rss = [_rss_mb(server_pid)]
+
+    async def worker():
+        for i in next_request:
+            start = time.perf_counter()
+            try:
+                await request(i, samples[i], start)
+            except Exception as e:
+                samples[i].error = str(e) or type(e).__name__
+
+    async def sample_rss():
+        while True:
+            await asyncio.sleep(0.1)
+            rss.append(_rss_mb(server_pid))
+
+    sampler = asyncio.create_task(sample_rss())
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    sampler.cancel()
+    rss.append(_rss_mb(server_pid))
+
+    ok = [s for s in samples if s.error is None]
+    errors = [s.error for s in samples if s.error is not None]
+    return {
+        'requests': requests,
+        'errors': len(errors),
+        'error_examples': sorted(set(errors))[:3],
+        'duration_s': elapsed,
+        'throughput_rps': len(ok) / elapsed if elapsed else None,
+        'latency': _summary([s.latency for s in ok if s.latency is not None]),
+        'ttft': _summary([s.ttft for s in ok if s.ttft is not None]),
+        'completion': _summary([s.completion for s in ok if s.completion is not None]),
+        'rss_mb': {'start': rss[0], 'peak': max(rss), 'end': rss[-1]},
+    }
+
+
+async def _wait_ready(session: aiohttp.ClientSession, url: str, timeout: float):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.1)
+    raise Exception(f'{url} did not become ready within {timeout}s')
+
+
+async def _run(args, server_pid: int, base_url: str) -> dict:
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=args.request_timeout)
+    connector = aiohttp.TCPConnector(limit=args.concurrency * 2)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        await _wait_ready(session, f'{base_url}/ready', args.startup_timeout)
+        harness = LoadHarness(base_url, session, args.users, args.poll_interval)
+        results = {}
+        for endpoint in args.endpoints:
+            if endpoint == 'chat-history':
+                await harness.prepare_chat_history(args.history_turns)
+                request = harness.chat_history
+            else:
+                request = getattr(harness, endpoint)
+            results[endpoint] = await _drive(request, args.requests, args.concurrency, server_pid)
+        return results
+
+
+def _commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=ENDPOINTS)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=100, help='requests per endpoint')
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--token-latency', type=float, default=0.02)
+    parser.add_argument('--first-token-latency', type=float, default=0.2)
+    parser.add_argument('--answer-tokens', type=int, default=50)
+    parser.add_argument('--history-turns', type=int, default=5, help='chat turns stored per user before /chat-history is driven')
+    parser.add_argument('--poll-interval', type=float, default=0.05, help='seconds between ingest job status polls')
+    parser.add_argument('--request-timeout', type=float, default=120)
+    parser.add_argument('--startup-timeout', type=float, default=60)
+    parser.add_argument('--output', help='also write the results to this file')
+    args = parser.parse_args()
+
+    if not os.getenv('FIRESTORE_EMULATOR_HOST'):
+        sys.exit('Set FIRESTORE_EMULATOR_HOST to a running Firestore emulator, '
+                 'e.g. gcloud emulators firestore start --host-port=127.0.0.1:8080')
+
+    openai_port, server_port = _free_port(), _free_port()
+    with tempfile.TemporaryDirectory() as data_dir:
+        env = {
+            # admission is off unless set in the environment, the run measures the service, not the rate limiter
+            'LLM_RPM': '0',
+            'LLM_TPM': '0',
+            'EMBEDDING_RPM': '0',
+            'EMBEDDING_TPM': '0',
+            **os.environ,
+            'OPENAI_API_BASE': f'http://127.0.0.1:{openai_port}/v1',
+            'OPENAI_API_KEY': 'sk-load-test',
+            'VECTORSTORE_BACKEND': 'local',
+            'LOCAL_VECTORSTORE_PATH': os.path.join(data_dir, 'vectorstore'),
+            'EMBEDDING_CACHE_PATH': os.path.join(data_dir, 'embedding_cache.sqlite3'),
+        }
+        mock_openai = subprocess.Popen([
+            sys.executable, '-m', 'benchmarks.mock_openai', '--port', str(openai_port),
+            '--token-latency', str(args.token_latency),
+            '--first-token-latency', str(args.first_token_latency),
+            '--tokens', str(args.answer_tokens),
+        ], env=env)
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(server_port), '--log-level', 'warning'],
+            env=env,
+        )
+        try:
+            endpoints = asyncio.run(_run(args, server.pid, f'http://127.0.0.1:{server_port}'))
+        finally:
+            server.terminate()
+            mock_openai.terminate()
+            server.wait()
+            mock_openai.wait()
+
+    output = json.dumps({
+        'commit': _commit(),
+        'config': {k: v for k, v in vars(args).items() if k != 'output'},
+        'endpoints': endpoints,
+    }, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Stand-in for the OpenAI API used by the load harness: streaming and non-streaming chat completions with a
+configurable per-token latency, and embeddings from the deterministic hashing embedder of the vector store
+conformance checks. Point the API at it with OPENAI_API_BASE=http://127.0.0.1:<port>/v1.
+
+    python -m benchmarks.mock_openai --port 8100 --token-latency 0.02 --tokens 50
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+from aiohttp import web
+
+from benchmarks.vector_store_conformance import hash_embed
+
+
+def _completion_chunk(completion_id: str, model: str, delta: dict, finish_reason: str | None = None) -> bytes:
+    chunk = {
+        'id': completion_id,
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+    }
+    return f'data: {json.dumps(chunk)}\n\n'.encode()
+
+
+def build_app(token_latency: float, tokens: int, first_token_latency: float) -> web.Application:
+    async def chat_completions(request: web.Request):
+        body = await request.json()
+        model = body.get('model', 'gpt-3.5-turbo')
+        completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+        words = [f'token{i} ' for i in range(tokens)]
+
+        if not body.get('stream'):
+            await asyncio.sleep(first_token_latency + token_latency * tokens)
+            return web.json_response({
+                'id': completion_id,
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(words)}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': tokens, 'total_tokens': tokens},
+            })
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        await asyncio.sleep(first_token_latency)
+        await response.write(_completion_chunk(completion_id, model, {'role': 'assistant'}))
+        for word in words:
+            await asyncio.sleep(token_latency)
+            await response.write(_completion_chunk(completion_id, model, {'content': word}))
+        await response.write(_completion_chunk(completion_id, model, {}, 'stop'))
+        await response.write(b'data: [DONE]\n\n')
+        await response.write_eof()
+        return response
+
+    async def embeddings(request: web.Request):
+        body = await request.json()
+        texts = body['input'] if isinstance(body['input'], list) else [body['input']]
+        vectors = hash_embed([str(text) for text in texts])
+        return web.json_response({
+            'object': 'list',
+            'model': body.get('model'),
+            'data': [{'object': 'embedding', 'index': i, 'embedding': vector.tolist()} for i, vector in enumerate(vectors)],
+            'usage': {'prompt_tokens': sum(len(str(t).split()) for t in texts), 'total_tokens': sum(len(str(t).split()) for t in texts)},
+        })
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post('/v1/chat/completions', chat_completions)
+    app.router.add_post('/v1/embeddings', embeddings)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--token-latency', type=float, default=0.02, help='seconds between streamed tokens')
+    parser.add_argument('--first-token-latency', type=float, default=0.2, help='seconds until the first token')
+    parser.add_argument('--tokens', type=int, default=50, help='tokens per answer')
+    args = parser.parse_args()
+    web.run_app(build_app(args.token_latency, args.tokens, args.first_token_latency), host='127.0.0.1', port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Compares the legacy JSON `/storepdf` ingestion path against the raw body `/storepdf/upload` path
+for a given PDF. Each mode runs in a fresh subprocess so peak RSS is measured independently.
+
+    python -m benchmarks.pdf_upload --pdf large.pdf
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import PyPDF2
+
+from utils.pdf import iter_pdf_pages, pdf_executor
+
+
+def _legacy(pdf_path: str) -> int:
+    with open(pdf_path, 'rb') as f:
+        body = json.dumps({'pdf_bytes': list(f.read())})
+    # what FastAPI + the old handler did with the request body
+    pdf_bytes = bytes(json.loads(body)['pdf_bytes'])
+    pdf_text = ''
+    reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
+    for page_number in range(len(reader.pages)):
+        pdf_text += reader.pages[page_number].extract_text()
+    return len(pdf_text)
+
+
+def _streaming(pdf_path: str) -> int:
+    async def run():
+        with open(pdf_path, 'rb') as src, tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as dst:
+            while body_chunk := src.read(64 * 1024):
+                dst.write(body_chunk)
+        try:
+            pages = [page_text async for page_text in iter_pdf_pages(dst.name)]
+            return len(''.join(pages))
+        finally:
+            os.unlink(dst.name)
+
+    text_length = asyncio.run(run())
+    pdf_executor.shutdown()  # reap the workers so their RSS shows up in RUSAGE_CHILDREN
+    return text_length
+
+
+def _run_mode(mode: str, pdf_path: str):
+    start = time.perf_counter()
+    text_length = _legacy(pdf_path) if mode == 'legacy' else _streaming(pdf_path)
+    print(json.dumps({
+        'mode': mode,
+        'latency_s': time.perf_counter() - start,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_worker_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        'text_length': text_length,
+        'pdf_size_mb': os.path.getsize(pdf_path) / 1024 / 1024,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pdf', required=True)
+    parser.add_argument('--mode', choices=['legacy', 'streaming'])
+    args = parser.parse_args()
+
+    if args.mode:
+        _run_mode(args.mode, args.pdf)
+        return
+
+    for mode in ('legacy', 'streaming'):
+        subprocess.run([sys.executable, '-m', 'benchmarks.pdf_upload', '--pdf', args.pdf, '--mode', mode], check=True)
+
+
+if __name__ == '__main__':
+    main()
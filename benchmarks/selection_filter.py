@@ -0,0 +1,120 @@
+"""
+Query latency of selected-context filters as the selection grows, comparing the previous Or of one Equal per
+bookmark with a single ContainsAny operand. Seeds a throwaway user with --bookmarks bookmarks (random vectors,
+so no vectorizer calls are made) in the Weaviate at WEAVIATE_URL and removes them afterwards.
+
+    python -m benchmarks.selection_filter --sizes 1 10 100 1000 --queries 50
+"""
+import argparse
+import json
+import time
+import uuid
+from typing import Any, Dict, List
+
+import numpy as np
+
+from benchmarks.context_service_load import percentile
+from services.context_service import ContextService
+from utils.db import get_vectorstore
+
+DIMENSIONS = 1536
+
+
+def _or_filter(user_id: str, ids: List[str]) -> Dict[str, Any]:
+    operands = [{"path": ["firebase_id"], "operator": "Equal", "valueString": _id} for _id in ids]
+    return {
+        "operator": "And",
+        "operands": [
+            {"path": ["user_id"], "operator": "Equal", "valueString": user_id},
+            {"operator": "Or", "operands": operands} if len(operands) > 1 else operands[0],
+        ]
+    }
+
+
+def _contains_any_filter(user_id: str, ids: List[str]) -> Dict[str, Any]:
+    return {
+        "operator": "And",
+        "operands": [
+            {"path": ["user_id"], "operator": "Equal", "valueString": user_id},
+            {"path": ["firebase_id"], "operator": "ContainsAny", "valueTextArray": ids},
+        ]
+    }
+
+
+def _seed(service: ContextService, user_id: str, bookmarks: int, chunks_per_bookmark: int) -> List[str]:
+    ids = [uuid.uuid4().hex for _ in range(bookmarks)]
+    objects = [{
+        "title": f"bookmark {i}",
+        "url": f"https://example.com/{i}",
+        "content": f"chunk {k} of bookmark {i}",
+        "user_id": user_id,
+        "firebase_id": _id,
+        "folder": f"folder {i % 10}",
+        "token_count": 8,
+    } for i, _id in enumerate(ids) for k in range(chunks_per_bookmark)]
+    vectors = np.random.default_rng(0).random((len(objects), DIMENSIONS), dtype=np.float32).tolist()
+    for start in range(0, len(objects), 100):
+        errors = [e for e in service.insert_objects(objects[start:start + 100], vectors[start:start + 100]) if e]
+        if errors:
+            raise Exception(errors[0])
+    return ids
+
+
+def _measure(client, where_filter: Dict[str, Any], queries: int) -> List[float]:
+    vector = np.random.default_rng(1).random(DIMENSIONS, dtype=np.float32).tolist()
+    latencies = []
+    for _ in range(queries):
+        start = time.perf_counter()
+        res = client.query.get(
+            "Document", ["firebase_id"]
+        ).with_where(
+            where_filter
+        ).with_near_vector({
+            "vector": vector,
+        }).with_limit(
+            10
+        ).do()
+        latencies.append(time.perf_counter() - start)
+        if res.get('errors'):
+            raise Exception(res['errors'])
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--chunks-per-bookmark', type=int, default=3)
+    parser.add_argument('--queries', type=int, default=50)
+    args = parser.parse_args()
+
+    client = get_vectorstore()
+    service = ContextService(client)
+    user_id = f'benchmark-{uuid.uuid4().hex}'
+    ids = _seed(service, user_id, max(args.sizes), args.chunks_per_bookmark)
+    try:
+        results = []
+        for size in args.sizes:
+            selection = ids[:size]
+            for name, build in [('or', _or_filter), ('contains_any', _contains_any_filter)]:
+                start = time.perf_counter()
+                where_filter = build(user_id, selection)
+                build_ms = (time.perf_counter() - start) * 1000
+                latencies = _measure(client, where_filter, args.queries)
+                results.append({
+                    'selected': size,
+                    'filter': name,
+                    'filter_bytes': len(json.dumps(where_filter)),
+                    'build_ms': build_ms,
+                    'p50_ms': percentile(latencies, 50) * 1000,
+                    'p95_ms': percentile(latencies, 95) * 1000,
+                })
+        print(json.dumps(results, indent=2))
+    finally:
+        client.batch.delete_objects(
+            class_name="Document",
+            where={"path": ["user_id"], "operator": "Equal", "valueString": user_id}
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Cold start of the API: time to import `main`, time from process start until the first request is answered
+and until /ready reports both backends warmed up. Every run is a fresh interpreter. Run it on two commits
+to compare.
+
+    python -m benchmarks.startup --runs 5
+"""
+import argparse
+import json
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from statistics import median
+
+IMPORT_SNIPPET = 'import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)'
+
+
+def _import_time() -> float:
+    out = subprocess.run([sys.executable, '-c', IMPORT_SNIPPET], capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(url: str, start: float, timeout: float) -> float | None:
+    while time.perf_counter() - start < timeout:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter() - start
+        except (urllib.error.URLError, ConnectionError, TimeoutError):
+            pass
+        time.sleep(0.01)
+    return None
+
+
+def _serve_times(timeout: float):
+    port = _free_port()
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port), '--log-level', 'warning'],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        first_request = _wait_for(f'http://127.0.0.1:{port}/', start, timeout)
+        ready = _wait_for(f'http://127.0.0.1:{port}/ready', start, timeout)
+    finally:
+        server.terminate()
+        server.wait()
+    return first_request, ready
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    import_times, first_requests, readies = [], [], []
+    for _ in range(args.runs):
+        import_times.append(_import_time())
+        first_request, ready = _serve_times(args.timeout)
+        first_requests.append(first_request)
+        readies.append(ready)
+
+    def summary(values):
+        values = [v for v in values if v is not None]
+        return median(values) if values else None
+
+    print(json.dumps({
+        'runs': args.runs,
+        'import_s': summary(import_times),
+        'first_request_s': summary(first_requests),
+        # None on commits without /ready or when a backend is unreachable
+        'ready_s': summary(readies),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""
+Conformance checks and latency of a VectorStore backend. Seeds throwaway users, checks that both backends agree
+on the behaviour ContextService relies on (user scoping, firebase_id and folder filters, certainty cut-off,
+keyword ranking of hybrid search, delete counts) and reports add / search / delete latency. Vectors come from a
+deterministic hashing embedder, so no vectorizer calls are made. Exits non-zero when a check fails.
+
+    python -m benchmarks.vector_store_conformance --backend local
+    python -m benchmarks.vector_store_conformance --backend weaviate --bookmarks 200
+"""
+import argparse
+import hashlib
+import json
+import re
+import sys
+import tempfile
+import time
+import uuid
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from benchmarks.context_service_load import percentile
+from services.vector_stores import ChunkFilter, LocalVectorStore, VectorStore, WeaviateVectorStore
+
+# the dimensions of the Weaviate classes' text2vec-openai vectors
+DIMENSIONS = 1536
+
+WORDS = ['alpine', 'harbor', 'lantern', 'meadow', 'orbit', 'pepper', 'quartz', 'river', 'saddle', 'timber',
+         'velvet', 'walnut', 'yonder', 'zephyr', 'ember', 'falcon', 'glacier', 'hollow', 'island', 'jasper']
+
+
+def hash_embed(texts: List[str]) -> np.ndarray:
+    vectors = np.zeros((len(texts), DIMENSIONS), dtype=np.float32)
+    for i, text in enumerate(texts):
+        for token in re.findall(r'\w+', text.lower()):
+            digest = hashlib.md5(token.encode()).digest()
+            index = int.from_bytes(digest[:4], 'little') % DIMENSIONS
+            vectors[i, index] += 1 if digest[4] & 1 else -1
+    return vectors
+
+
+def _build_store(backend: str, path: str) -> VectorStore:
+    if backend == 'local':
+        return LocalVectorStore(path, embed=hash_embed)
+    from utils.db import get_vectorstore
+    return WeaviateVectorStore(get_vectorstore())
+
+
+def _seed_objects(user_id: str, bookmarks: int, chunks_per_bookmark: int) -> List[Dict]:
+    rng = np.random.default_rng(0)
+    objects = []
+    for i in range(bookmarks):
+        firebase_id = uuid.uuid4().hex
+        for k in range(chunks_per_bookmark):
+            words = ' '.join(rng.choice(WORDS, size=12))
+            objects.append({
+                "title": f"bookmark {i}",
+                "url": f"https://example.com/{i}",
+                "content": f"chunk {k} of bookmark {i} {words}",
+                "user_id": user_id,
+                "firebase_id": firebase_id,
+                "folder": f"folder {i % 5}",
+                "token_count": 16,
+            })
+    return objects
+
+
+def _timed(latencies: List[float], func: Callable, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    latencies.append(time.perf_counter() - start)
+    return result
+
+
+def _run(store: VectorStore, bookmarks: int, chunks_per_bookmark: int, queries: int):
+    user_id = f'conformance-{uuid.uuid4().hex}'
+    other_user_id = f'conformance-{uuid.uuid4().hex}'
+    objects = _seed_objects(user_id, bookmarks, chunks_per_bookmark)
+    others = _seed_objects(other_user_id, 2, chunks_per_bookmark)
+    firebase_ids = list(dict.fromkeys(obj['firebase_id'] for obj in objects))
+    failures = []
+    latencies = {'add': [], 'vector_search': [], 'hybrid_search': [], 'delete': []}
+
+    def check(name: str, ok: bool, detail=None):
+        if not ok:
+            failures.append({'check': name, 'detail': detail})
+
+    def vector(text: str) -> List[float]:
+        return hash_embed([text])[0].tolist()
+
+    batch = 100
+    errors = []
+    for start in range(0, len(objects), batch):
+        page = objects[start:start + batch]
+        errors += _timed(latencies['add'], store.add, page, hash_embed([o['content'] for o in page]).tolist())
+    errors += store.add(others, hash_embed([o['content'] for o in others]).tolist())
+    check('add', not any(errors), [e for e in errors if e][:3])
+
+    try:
+        target = objects[len(objects) // 2]
+        hits = store.vector_search(target['content'], ChunkFilter(user_id), limit=5, vector=vector(target['content']))
+        check('vector_search finds the exact chunk first', bool(hits) and hits[0].properties['content'] == target['content'],
+              [h.properties['content'] for h in hits[:3]])
+        check('vector_search is sorted', [h.score for h in hits] == sorted((h.score for h in hits), reverse=True))
+        check('vector_search is scoped to the user', all(h.properties['user_id'] == user_id for h in hits))
+        check('vector_search returns properties', bool(hits) and all(hits[0].properties.get(p) is not None for p in ['title', 'url', 'firebase_id', 'token_count']))
+
+        hits = store.vector_search(target['content'], ChunkFilter(user_id), limit=5, certainty=0.999, vector=vector(target['content']))
+        check('certainty cuts off dissimilar chunks', all(h.score >= 0.999 for h in hits) and len(hits) >= 1, [h.score for h in hits])
+
+        hits = store.vector_search(target['content'], ChunkFilter(user_id), limit=2, vector=vector(target['content']), with_vectors=True)
+        check('with_vectors returns vectors', bool(hits) and all(h.vector is not None and len(h.vector) == DIMENSIONS for h in hits))
+
+        selection = firebase_ids[:3]
+        hits = store.vector_search('river', ChunkFilter(user_id, firebase_ids=selection), limit=50, vector=vector('river'))
+        check('firebase_ids filter', len(hits) == 3 * chunks_per_bookmark and all(h.properties['firebase_id'] in selection for h in hits), len(hits))
+
+        hits = store.vector_search('river', ChunkFilter(user_id, folders=['folder 1']), limit=50, vector=vector('river'))
+        check('folders filter', bool(hits) and all(h.properties['folder'] == 'folder 1' for h in hits))
+
+        hits = store.vector_search('river', ChunkFilter(f'conformance-{uuid.uuid4().hex}'), limit=5, vector=vector('river'))
+        check('unknown user returns nothing', hits == [], len(hits))
+
+        # a word only one chunk contains must win a pure keyword search
+        unique = uuid.uuid4().hex
+        marked = dict(objects[0], content=f'{objects[0]["content"]} {unique}', firebase_id=uuid.uuid4().hex)
+        store.add([marked], hash_embed([marked['content']]).tolist())
+        hits = store.hybrid_search(unique, ChunkFilter(user_id), limit=5, alpha=0, vector=vector(unique))
+        check('hybrid keyword ranking', bool(hits) and unique in hits[0].properties['content'], [h.properties['content'] for h in hits[:3]])
+        hits = store.hybrid_search(unique, ChunkFilter(other_user_id), limit=5, alpha=0, vector=vector(unique))
+        check('hybrid_search is scoped to the user', all(h.properties['user_id'] == other_user_id for h in hits))
+
+        # objects with an id are replaced when the id is added again
+        chunk_id = str(uuid.uuid4())
+        keyed = dict(marked, content=f'first {unique}', firebase_id=uuid.uuid4().hex)
+        store.add([keyed], hash_embed([keyed['content']]).tolist(), [chunk_id])
+        store.add([dict(keyed, content=f'second {unique}')], hash_embed([f'second {unique}']).tolist(), [chunk_id])
+        ids = store.list_ids(ChunkFilter(user_id, firebase_ids=[keyed['firebase_id']]))
+        check('list_ids', ids == [chunk_id], ids)
+        hits = store.vector_search(unique, ChunkFilter(user_id, firebase_ids=[keyed['firebase_id']]), limit=5, vector=vector(unique))
+        check('add with an existing id replaces the object', [h.properties['content'] for h in hits] == [f'second {unique}'],
+              [h.properties['content'] for h in hits])
+        deleted = store.delete(ChunkFilter(user_id, chunk_ids=[chunk_id]))
+        check('delete by chunk id', deleted == 1 and not store.list_ids(ChunkFilter(user_id, firebase_ids=[keyed['firebase_id']])), deleted)
+
+        for i in range(queries):
+            text = objects[i % len(objects)]['content']
+            _timed(latencies['vector_search'], store.vector_search, text, ChunkFilter(user_id), limit=10, vector=vector(text))
+            _timed(latencies['hybrid_search'], store.hybrid_search, text, ChunkFilter(user_id), limit=10, alpha=0.25, vector=vector(text))
+
+        try:
+            store.delete(ChunkFilter(user_id))
+            check('delete without a filter is refused', False)
+        except ValueError:
+            pass
+
+        deleted = store.delete(ChunkFilter(user_id, firebase_ids=[marked['firebase_id']]))
+        check('delete count', deleted == 1, deleted)
+        hits = store.hybrid_search(unique, ChunkFilter(user_id), limit=5, alpha=0, vector=vector(unique))
+        check('deleted chunks are not returned', all(unique not in h.properties['content'] for h in hits))
+        deleted = store.delete(ChunkFilter(f'conformance-{uuid.uuid4().hex}', firebase_ids=[firebase_ids[0]]))
+        check('delete of an unknown user', deleted == 0, deleted)
+    finally:
+        for start in range(0, len(firebase_ids), 10):
+            _timed(latencies['delete'], store.delete, ChunkFilter(user_id, firebase_ids=firebase_ids[start:start + 10]))
+        store.delete(ChunkFilter(other_user_id, firebase_ids=list({o['firebase_id'] for o in others})))
+
+    return failures, {
+        name: {
+            'count': len(values),
+            'p50_ms': percentile(values, 50) * 1000,
+            'p95_ms': percentile(values, 95) * 1000,
+        } for name, values in latencies.items() if values
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=['local', 'weaviate'], default='local')
+    parser.add_argument('--path', help='directory of the local store, a temporary one by default')
+    parser.add_argument('--bookmarks', type=int, default=100)
+    parser.add_argument('--chunks-per-bookmark', type=int, default=3)
+    parser.add_argument('--queries', type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = _build_store(args.backend, args.path or tmp)
+        failures, latencies = _run(store, args.bookmarks, args.chunks_per_bookmark, args.queries)
+
+    print(json.dumps({
+        'backend': args.backend,
+        'chunks': args.bookmarks * args.chunks_per_bookmark,
+        'passed': not failures,
+        'failures': failures,
+        'latency': latencies,
+    }, indent=2))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
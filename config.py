@@ -32,14 +32,98 @@ class Config(metaclass=Singleton):
 
         self.chunk_size = int(os.getenv("CHUNK_SIZE", 1000))
         self.chunk_overlap = int(os.getenv("CHUNK_OVERLAP", 50))
+        self.chunk_tokens = int(os.getenv("CHUNK_TOKENS", 256))
+        self.chunk_overlap_tokens = int(os.getenv("CHUNK_OVERLAP_TOKENS", 16))
         self.max_tokens = int(os.getenv("LLM_MAX_TOKENS", 3000))
 
+        # route chunks to per-user tenants, run scripts/migrate_to_tenants.py before enabling it
+        self.vectorstore_multi_tenancy = os.getenv("VECTORSTORE_MULTI_TENANCY", "false").lower() == "true"
+        # "weaviate" or "local", the embedded store keeps chunks in LOCAL_VECTORSTORE_PATH and embeds with OpenAI
+        self.vectorstore_backend = os.getenv("VECTORSTORE_BACKEND", "weaviate")
+        self.local_vectorstore_path = os.getenv("LOCAL_VECTORSTORE_PATH", "vectorstore_data")
+
+        self.search_overfetch = int(os.getenv("SEARCH_OVERFETCH", 4))
+        self.search_max_chunks = int(os.getenv("SEARCH_MAX_CHUNKS", 200))
+        self.context_diversify = os.getenv("CONTEXT_DIVERSIFY", "false").lower() == "true"
+        self.context_max_chunks = int(os.getenv("CONTEXT_MAX_CHUNKS", 50))
+        self.context_max_chunks_per_bookmark = int(os.getenv("CONTEXT_MAX_CHUNKS_PER_BOOKMARK", 3))
+        self.context_mmr_lambda = float(os.getenv("CONTEXT_MMR_LAMBDA", 0.7))
+
+        self.ingest_workers = int(os.getenv("INGEST_WORKERS", 4))
+        self.ingest_batch_size = int(os.getenv("INGEST_BATCH_SIZE", 100))
+        self.ingest_batch_linger = float(os.getenv("INGEST_BATCH_LINGER", 0.05))
+        self.ingest_batch_writers = int(os.getenv("INGEST_BATCH_WRITERS", 2))
+        self.ingest_job_ttl = int(os.getenv("INGEST_JOB_TTL", 3600))
+        self.bulk_queue_size = int(os.getenv("BULK_QUEUE_SIZE", 64))
+        self.bulk_chunk_workers = int(os.getenv("BULK_CHUNK_WORKERS", os.cpu_count() or 1))
+        self.bulk_firestore_batch_size = min(int(os.getenv("BULK_FIRESTORE_BATCH_SIZE", 200)), 499)
+        self.bulk_firestore_concurrency = int(os.getenv("BULK_FIRESTORE_CONCURRENCY", 4))
+        self.bulk_vectorstore_workers = int(os.getenv("BULK_VECTORSTORE_WORKERS", 8))
+
+        self.delete_workers = int(os.getenv("DELETE_WORKERS", 2))
+        self.delete_firestore_batch_size = min(int(os.getenv("DELETE_FIRESTORE_BATCH_SIZE", 500)), 500)
+        self.delete_firestore_concurrency = int(os.getenv("DELETE_FIRESTORE_CONCURRENCY", 4))
+        self.delete_vectorstore_chunk_size = int(os.getenv("DELETE_VECTORSTORE_CHUNK_SIZE", 100))
+        self.delete_max_attempts = int(os.getenv("DELETE_MAX_ATTEMPTS", 5))
+        self.delete_retry_delay = float(os.getenv("DELETE_RETRY_DELAY", 1.0))
+        self.delete_job_ttl = int(os.getenv("DELETE_JOB_TTL", 3600))
+
+        self.chat_history_page_size = int(os.getenv("CHAT_HISTORY_PAGE_SIZE", 50))
+        self.chat_history_cache_size = int(os.getenv("CHAT_HISTORY_CACHE_SIZE", 1024))
+        self.chat_history_cache_ttl = int(os.getenv("CHAT_HISTORY_CACHE_TTL", 600))
+
+        self.conversations_page_size = int(os.getenv("CONVERSATIONS_PAGE_SIZE", 100))
+        self.conversations_cache_ttl = int(os.getenv("CONVERSATIONS_CACHE_TTL", 30))
+        # bookmarked URLs and folders per user for /info. Bookmarks written by other instances are picked up by
+        # an incremental query every refresh interval, deletions by other instances by a full reload after max age
+        self.bookmark_index_cache_size = int(os.getenv("BOOKMARK_INDEX_CACHE_SIZE", 10000))
+        self.bookmark_index_refresh_interval = int(os.getenv("BOOKMARK_INDEX_REFRESH_INTERVAL", 30))
+        self.bookmark_index_max_age = int(os.getenv("BOOKMARK_INDEX_MAX_AGE", 3600))
+        self.info_batch_max_urls = int(os.getenv("INFO_BATCH_MAX_URLS", 200))
+
+        self.write_behind_batch_size = min(int(os.getenv("WRITE_BEHIND_BATCH_SIZE", 500)), 500)
+        self.write_behind_interval = float(os.getenv("WRITE_BEHIND_INTERVAL", 1.0))
+
+        self.embedding_model = os.getenv("EMBEDDING_MODEL", "text-embedding-ada-002")
+        self.embedding_cache_path = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")
+        self.embedding_cache_memory_size = int(os.getenv("EMBEDDING_CACHE_MEMORY_SIZE", 5000))
+
+        self.pdf_max_workers = int(os.getenv("PDF_MAX_WORKERS", os.cpu_count() or 1))
+        self.pdf_page_batch_size = int(os.getenv("PDF_PAGE_BATCH_SIZE", 8))
+
         self.openai_api_key = os.getenv("OPENAI_API_KEY")
         openai.api_key = self.openai_api_key
         openai.organization = os.getenv("OPENAI_ORGANIZATION")
 
+        self.llm_request_timeout = float(os.getenv("LLM_REQUEST_TIMEOUT", 120))
+        self.llm_max_connections = int(os.getenv("LLM_MAX_CONNECTIONS", 100))
+
+        # OpenAI rate limits of the account, 0 disables the limit. Chat requests are admitted with an estimate
+        # of the context, question and answer tokens.
+        self.llm_rpm = int(os.getenv("LLM_RPM", 3500))
+        self.llm_tpm = int(os.getenv("LLM_TPM", 90000))
+        self.llm_answer_tokens_estimate = int(os.getenv("LLM_ANSWER_TOKENS_ESTIMATE", 500))
+        self.embedding_rpm = int(os.getenv("EMBEDDING_RPM", 3000))
+        self.embedding_tpm = int(os.getenv("EMBEDDING_TPM", 1000000))
+        # callers over the limit wait in a queue of this size for at most this many seconds, then get a 429
+        self.admission_max_queue = int(os.getenv("ADMISSION_MAX_QUEUE", 100))
+        self.admission_max_wait = float(os.getenv("ADMISSION_MAX_WAIT", 10))
+
+        self.answer_cache_size = int(os.getenv("ANSWER_CACHE_SIZE", 1000))
+        self.answer_cache_ttl = int(os.getenv("ANSWER_CACHE_TTL", 3600))
+
+        self.sse_protocol_version = int(os.getenv("SSE_PROTOCOL_VERSION", 1))
+        self.sse_coalesce_window = float(os.getenv("SSE_COALESCE_WINDOW", 0.03))
+        self.sse_coalesce_bytes = int(os.getenv("SSE_COALESCE_BYTES", 64))
+
         self.debug_mode = os.getenv("DEBUG_MODE", "False") == "True"
+        # per-stage histograms on /metrics and Server-Timing headers, off means no instrumentation at all
+        self.metrics_enabled = os.getenv("METRICS_ENABLED", "false").lower() == "true"
         self.lancedb_url = os.getenv("LANCEDB_URL", "lancedb")
+        # with the emulator the service account file is not needed and every client talks to it unauthenticated
+        self.firestore_emulator_host = os.getenv("FIRESTORE_EMULATOR_HOST")
+        self.firebase_project_id = os.getenv("FIREBASE_PROJECT_ID", "bookmarkai-c7f69")
         self.weaviate_url = os.getenv("WEAVIATE_URL", "weaviate")
         self.weaviate_key = os.getenv("WEAVIATE_KEY", None)
+        self.vectorstore_max_workers = int(os.getenv("VECTORSTORE_MAX_WORKERS", 8))
         self.environment = os.getenv("ENVIRONMENT", "dev")
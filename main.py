@@ -1,10 +1,52 @@
-from fastapi import FastAPI
+import asyncio
+import logging
+import math
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse
 from starlette.middleware.cors import CORSMiddleware
 
+from services.deletion_service import deletion_service
+from services.ingest_service import ingest_service
+from services.llm_service import llm_service
+from utils import metrics
+from utils.admission import AdmissionRejected
+from utils.db import warm_up
+from utils.write_behind import firestore_write_buffer
 from views.chat_view import router as chat_router
 from views.extension_view import router as extension_router
 
-app = FastAPI()
+log = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # warm-up runs in the background so the server binds right away, /ready reports when it is done
+    _start_warm_up(app)
+    yield
+    app.state.warm_up.cancel()
+    await ingest_service.stop()
+    await deletion_service.stop()
+    await firestore_write_buffer.stop()
+    await llm_service.close()
+
+
+def _start_warm_up(app: FastAPI):
+    app.state.warm_up = asyncio.create_task(warm_up())
+    app.state.warm_up.add_done_callback(_log_warm_up)
+
+
+def _log_warm_up(task: asyncio.Task):
+    if task.cancelled():
+        return
+    if task.exception():
+        log.error(f'Warm-up failed: {task.exception()}')
+    else:
+        log.info(f'Warm-up done: {task.result()}')
+
+
+app = FastAPI(lifespan=lifespan)
 origins = ["*"]
 
 app.add_middleware(
@@ -13,16 +55,50 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Server-Timing", "Retry-After"],
 )
+if metrics.enabled:
+    app.add_middleware(metrics.MetricsMiddleware)
+
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected(request: Request, exc: AdmissionRejected):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(math.ceil(exc.retry_after))},
+    )
+
 
 app.include_router(chat_router)
 app.include_router(extension_router)
 
+
 @app.get("/")
 async def root():
     return {"message": "Hello World"}
 
 
+@app.get("/ready")
+async def ready(response: Response):
+    warm_up_task: asyncio.Task = app.state.warm_up
+    if not warm_up_task.done():
+        response.status_code = 503
+        return {"ready": False}
+    if warm_up_task.cancelled() or warm_up_task.exception():
+        # retried on the next probe, the clients are still built lazily by requests in the meantime
+        _start_warm_up(app)
+        response.status_code = 503
+        return {"ready": False, "error": None if warm_up_task.cancelled() else str(warm_up_task.exception())}
+    return {"ready": True, "backends": warm_up_task.result()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    # Prometheus text format, without samples while METRICS_ENABLED is off
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/hello/{name}")
 async def say_hello(name: str):
     return {"message": f"Hello {name}"}
@@ -17,3 +17,4 @@ class VectorStoreBookmarkMetadata(BaseModel):
 class VectorStoreBookmark(BaseModel):
     page_content: str
     metadata: VectorStoreBookmarkMetadata
+    token_count: int | None = None
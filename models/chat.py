@@ -22,6 +22,10 @@ class UserSearchMessage(BaseModel):
     certainty: float = 0.8
     limit_chunks: int = 10
     alpha: float = 0.25
+    folders: List[str] | None = None
+    # one result per bookmark, diversified with maximal marginal relevance
+    group_by_bookmark: bool = False
+    mmr_lambda: float = 0.5
 
 
 class ChatEndpointMessage(BaseModel):
@@ -30,19 +34,62 @@ class ChatEndpointMessage(BaseModel):
     done: bool
 
 
+_message_types = {'human', 'ai', 'system', 'chat'}
+
+
 class ConversationMessage(BaseModel):
     message: Dict[str, Any]
     used_context: List[VectorStoreBookmarkMetadata] | List[str] | None = None
     timestamp: int
+    id: str | None = None
+
+    @property
+    def cursor(self) -> str:
+        return f'{self.timestamp}:{self.id}'
+
+    @classmethod
+    def _is_well_formed(cls, message: Any) -> bool:
+        # the shape _message_to_dict produces, anything else is normalised through langchain
+        return (
+            isinstance(message, dict)
+            and message.get('type') in _message_types
+            and isinstance(message.get('data'), dict)
+            and isinstance(message['data'].get('content'), str)
+            and 'additional_kwargs' in message['data']
+        )
 
     @classmethod
     def parse_obj(cls: Type['ConversationMessage'], obj: Any) -> 'ConversationMessage':
         if isinstance(obj, cls):
             return obj
         if isinstance(obj, dict):
+            message = obj['message']
+            if not cls._is_well_formed(message):
+                message = _message_to_dict(_message_from_dict(message))
             return cls(
-                message=_message_to_dict(_message_from_dict(obj['message'])),
+                message=message,
                 used_context=obj['used_context'],
-                timestamp=obj['timestamp']
+                timestamp=obj['timestamp'],
+                id=obj.get('id'),
             )
         raise TypeError(f'Cannot parse {cls} from {obj}')
+
+
+class ChatHistoryPage(BaseModel):
+    messages: List[ConversationMessage]
+    next_cursor: str | None = None
+
+
+class ConversationSummary(BaseModel):
+    id: str
+    title: str | None = None
+    timestamp: int | None = None
+
+    @property
+    def cursor(self) -> str:
+        return f'{self.timestamp}:{self.id}'
+
+
+class ConversationListPage(BaseModel):
+    conversations: List[ConversationSummary]
+    next_cursor: str | None = None
@@ -0,0 +1,27 @@
+from enum import Enum
+from typing import List
+
+from pydantic import BaseModel
+
+
+class DeleteJobStatus(str, Enum):
+    queued = 'queued'
+    running = 'running'
+    done = 'done'
+    failed = 'failed'
+
+
+class DeleteJob(BaseModel):
+    id: str
+    user_id: str
+    status: DeleteJobStatus = DeleteJobStatus.queued
+    total_bookmarks: int
+    # ids whose chunks / Firestore documents are not deleted yet, a resumed job only works through these
+    pending_vectorstore_ids: List[str]
+    pending_firestore_ids: List[str]
+    folders_to_delete: List[str] = []
+    deleted_chunks: int = 0
+    attempts: int = 0
+    error: str | None = None
+    created_at: int
+    finished_at: int | None = None
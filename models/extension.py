@@ -1,4 +1,4 @@
-from typing import Optional, List
+from typing import Dict, Optional, List
 
 from pydantic import BaseModel
 
@@ -16,9 +16,18 @@ class UrlMetadataInfo(BaseModel):
     is_bookmarked: bool
     folders: List[str]
 
-class ExtensionPDFDocument(BaseModel):
-    pdf_bytes: list
+
+class UrlBatchMetadataInfo(BaseModel):
+    # keyed by the requested URLs
+    is_bookmarked: Dict[str, bool]
+    folders: List[str]
+
+class ExtensionPDFMetadata(BaseModel):
     url: str
     title: str
     timestamp: int
-    folder: str
\ No newline at end of file
+    folder: str
+
+
+class ExtensionPDFDocument(ExtensionPDFMetadata):
+    pdf_bytes: list
@@ -0,0 +1,48 @@
+from enum import Enum
+from typing import List
+
+from pydantic import BaseModel
+
+
+class IngestJobStatus(str, Enum):
+    queued = 'queued'
+    running = 'running'
+    done = 'done'
+    failed = 'failed'
+
+
+class IngestJob(BaseModel):
+    id: str
+    user_id: str
+    url: str
+    status: IngestJobStatus = IngestJobStatus.queued
+    bookmark_id: str | None = None
+    # the URL was bookmarked already, only changed chunks are written
+    reused_bookmark: bool = False
+    total_chunks: int | None = None
+    stored_chunks: int = 0
+    skipped_chunks: int = 0
+    skipped_tokens: int = 0
+    deleted_chunks: int = 0
+    error: str | None = None
+    created_at: int
+    finished_at: int | None = None
+
+
+class BulkImportItemResult(BaseModel):
+    index: int
+    url: str | None = None
+    success: bool
+    bookmark_id: str | None = None
+    chunks: int = 0
+    error: str | None = None
+
+
+class BulkImportResult(BaseModel):
+    items: List[BulkImportItemResult]
+    succeeded: int
+    failed: int
+    chunks: int
+    elapsed_s: float
+    items_per_s: float
+    chunks_per_s: float
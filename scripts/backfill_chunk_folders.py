@@ -0,0 +1,85 @@
+"""
+Writes the `folder` property onto chunks stored before it was populated at ingest. Walks the Document class
+with a cursor, looks the folder up on the owner's Firestore bookmark and patches only chunks without one.
+Safe to re-run.
+
+    python -m scripts.backfill_chunk_folders [--dry-run]
+"""
+import argparse
+import asyncio
+import logging
+from typing import Dict
+
+from services.bookmark_store_service import AsyncBookmarkStoreService
+from services.context_service import vectorstore_executor
+from utils.db import get_vectorstore
+
+log = logging.getLogger(__name__)
+
+PAGE_SIZE = 500
+
+
+async def _get_folders(bookmark_service: AsyncBookmarkStoreService, user_id: str) -> Dict[str, str]:
+    bookmarks = await bookmark_service.get_user_document(user_id).collection('bookmarks').select(['folder']).get()
+    return {doc.id: doc.get('folder') for doc in bookmarks}
+
+
+async def _backfill(dry_run: bool):
+    client = get_vectorstore()
+    bookmark_service = AsyncBookmarkStoreService()
+    loop = asyncio.get_running_loop()
+    folders_by_user: Dict[str, Dict[str, str]] = {}
+    after = None
+    scanned = updated = missing = 0
+    while True:
+        query = client.query.get(
+            "Document", ["user_id", "firebase_id", "folder"]
+        ).with_additional(
+            ['id']
+        ).with_limit(
+            PAGE_SIZE
+        )
+        if after:
+            query = query.with_after(after)
+        res = await loop.run_in_executor(vectorstore_executor, query.do)
+        docs = res['data']['Get']['Document']
+        if not docs:
+            break
+        after = docs[-1]['_additional']['id']
+        scanned += len(docs)
+
+        updates = []
+        for d in docs:
+            if d.get('folder'):
+                continue
+            if d['user_id'] not in folders_by_user:
+                folders_by_user[d['user_id']] = await _get_folders(bookmark_service, d['user_id'])
+            folder = folders_by_user[d['user_id']].get(d['firebase_id'])
+            if folder is None:
+                missing += 1  # chunk of a bookmark that no longer exists in Firestore
+                continue
+            updates.append((d['_additional']['id'], folder))
+
+        if not dry_run:
+            await asyncio.gather(*[loop.run_in_executor(
+                vectorstore_executor,
+                lambda object_id=object_id, folder=folder: client.data_object.update(
+                    data_object={'folder': folder}, class_name="Document", uuid=object_id
+                )
+            ) for object_id, folder in updates])
+        updated += len(updates)
+        log.info(f'scanned {scanned} chunks, updated {updated}, without bookmark {missing}')
+
+    print(f'scanned {scanned} chunks, {"would update" if dry_run else "updated"} {updated}, without bookmark {missing}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_backfill(args.dry_run))
+
+
+if __name__ == '__main__':
+    main()
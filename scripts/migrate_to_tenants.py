@@ -0,0 +1,95 @@
+"""
+Copies every chunk of the shared Document class into its owner's tenant of the TenantDocument class, keeping
+object ids and vectors, so nothing is re-vectorized and re-runs overwrite instead of duplicating. Pages are
+read with a cursor and written as they arrive. Pass the printed cursor as --after to resume an interrupted run.
+
+Enable VECTORSTORE_MULTI_TENANCY once it is done and run it once more with the printed --created-after to copy
+only the chunks stored since the first run started. Deletes and re-indexes after the switch only touch the
+tenants, copying everything again would bring back what they removed. A resumed first run prints a later time,
+use the one logged when the first attempt started.
+
+    python -m scripts.migrate_to_tenants [--page-size 500] [--after <uuid>] [--created-after <unix ms>]
+"""
+import argparse
+import logging
+import time
+
+from services.vector_stores import WeaviateVectorStore, get_tenant_name
+from utils.db import document_schema, get_vectorstore, tenant_document_schema
+
+log = logging.getLogger(__name__)
+
+PROPERTIES = [prop['name'] for prop in document_schema['properties']]
+
+
+def _migrate(page_size: int, after: str | None, created_after: int | None):
+    run_started = int(time.time() * 1000)
+    client = get_vectorstore()
+    vector_store = WeaviateVectorStore(client, multi_tenancy=True)
+    batch = client.batch.configure(batch_size=None, dynamic=False)
+    source, target = document_schema['class'], tenant_document_schema['class']
+    copied = failed = skipped = 0
+    start = time.perf_counter()
+    if created_after is None:
+        log.info(f'started at {run_started}, pass it as --created-after to the run after the switch')
+    while True:
+        query = client.query.get(source, PROPERTIES).with_additional(['id', 'vector', 'creationTimeUnix']).with_limit(page_size)
+        if after:
+            query = query.with_after(after)
+        res = query.do()
+        if res.get('errors'):
+            raise Exception(res['errors'])
+        docs = res['data']['Get'][source]
+        if not docs:
+            break
+        after = docs[-1]['_additional']['id']
+
+        if created_after is not None:
+            # a cursor can't be combined with a filter, older objects are skipped here instead
+            new_docs = [d for d in docs if int(d['_additional']['creationTimeUnix']) > created_after]
+            skipped += len(docs) - len(new_docs)
+            docs = new_docs
+            if not docs:
+                continue
+
+        vector_store.ensure_tenants({d['user_id'] for d in docs if d.get('user_id')})
+        for d in docs:
+            additional = d.pop('_additional')
+            if not d.get('user_id'):
+                failed += 1
+                log.warning(f'Skipping object {additional["id"]} without user_id')
+                continue
+            batch.add_data_object(
+                {k: v for k, v in d.items() if v is not None},
+                target,
+                uuid=additional['id'],
+                vector=additional['vector'],
+                tenant=get_tenant_name(d['user_id']),
+            )
+        results = batch.create_objects()
+        errors = [r for r in results if (r.get('result') or {}).get('errors')]
+        failed += len(errors)
+        copied += len(results) - len(errors)
+        for r in errors:
+            log.error(f'Could not copy {r.get("id")}: {r["result"]["errors"]}')
+
+        log.info(f'copied {copied}, failed {failed}, {copied / (time.perf_counter() - start):.0f} objects/s, cursor {after}')
+
+    print(f'copied {copied} objects, {failed} failed, {skipped} older ones skipped')
+    if created_after is None:
+        print(f'after the switch, run again with --created-after {run_started}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--after', default=None, help='object id to resume after')
+    parser.add_argument('--created-after', type=int, default=None,
+                        help='only copy objects created after this unix time in milliseconds, printed by the first run')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    _migrate(args.page_size, args.after, args.created_after)
+
+
+if __name__ == '__main__':
+    main()
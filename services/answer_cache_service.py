@@ -0,0 +1,81 @@
+import hashlib
+import re
+from typing import Dict, List, Set, Tuple
+
+from cachetools import TTLCache
+
+from config import Config
+from models.bookmark import VectorStoreBookmark
+
+config = Config()
+
+_whitespace = re.compile(r'\s+')
+
+
+class AnswerCache:
+    """
+    Answers keyed by model, normalised question and the ordered context chunks they were generated from.
+    Entries are dropped when any bookmark they used is deleted.
+    """
+
+    def __init__(self, maxsize: int, ttl: int):
+        self.entries: TTLCache[str, Tuple[str, List[str]]] = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.keys_by_bookmark: Dict[str, Set[str]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def normalize_question(cls, question: str) -> str:
+        return _whitespace.sub(' ', question).strip().rstrip('?!.').lower()
+
+    @classmethod
+    def key(cls, model: str, question: str, context: List[VectorStoreBookmark]) -> str:
+        digest = hashlib.sha256()
+        digest.update(model.encode('utf-8'))
+        digest.update(b'\0' + cls.normalize_question(question).encode('utf-8'))
+        for doc in context:
+            digest.update(b'\0' + doc.metadata.id.encode('utf-8'))
+            digest.update(hashlib.sha1(doc.page_content.encode('utf-8')).digest())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> str | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: str, answer: str, context: List[VectorStoreBookmark]):
+        bookmark_ids = list({doc.metadata.id for doc in context})
+        self.entries[key] = (answer, bookmark_ids)
+        for bookmark_id in bookmark_ids:
+            self.keys_by_bookmark.setdefault(bookmark_id, set()).add(key)
+        if len(self.keys_by_bookmark) > 2 * self.entries.maxsize:
+            self.__prune_index()
+
+    def invalidate_bookmarks(self, bookmark_ids: List[str]):
+        for bookmark_id in bookmark_ids:
+            for key in self.keys_by_bookmark.pop(bookmark_id, ()):
+                self.entries.pop(key, None)
+
+    def __prune_index(self):
+        # drop index entries of answers that expired or were evicted
+        self.entries.expire()
+        self.keys_by_bookmark = {
+            bookmark_id: live_keys
+            for bookmark_id, keys in self.keys_by_bookmark.items()
+            if (live_keys := {key for key in keys if key in self.entries})
+        }
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'answer_cache_hits': self.hits,
+            'answer_cache_misses': self.misses,
+            'answer_cache_hit_rate': self.hits / lookups if lookups else 0.0,
+            'answer_cache_size': len(self.entries),
+        }
+
+
+answer_cache = AnswerCache(maxsize=config.answer_cache_size, ttl=config.answer_cache_ttl)
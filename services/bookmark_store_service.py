@@ -1,16 +1,30 @@
 import abc
 import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 from functools import lru_cache
-from typing import List
+from typing import Dict, List, Set, Tuple
 
-from google.cloud.firestore_v1 import ArrayUnion, ArrayRemove
+from cachetools import LRUCache
+from google.cloud.firestore_v1 import SERVER_TIMESTAMP, ArrayUnion, ArrayRemove
 
 from config import Config
 from models.bookmark_store import UserDoc
 from models.extension import ExtensionDocument
-from models.extension import ExtensionDocument, ExtensionPDFDocument
+from models.extension import ExtensionDocument, ExtensionPDFMetadata
 from services.context_service import config
-from utils.db import firebase_app, async_firebase_app
+from utils.db import get_async_firestore
+from utils.metrics import timed_async
+from utils.single_flight import SingleFlight
+
+log = logging.getLogger(__name__)
+
+# values of one Firestore `in` filter
+_in_query_size = 10
+# re-read what was written shortly before the last sync, commit times and the local clock differ
+_sync_overlap = timedelta(seconds=60)
 
 
 class BaseBookmarkStoreService(abc.ABC):
@@ -31,11 +45,54 @@ class BaseBookmarkStoreService(abc.ABC):
         pass
 
 
+@dataclass
+class _BookmarkIndex:
+    # bookmark ids by URL, a URL can be bookmarked more than once
+    ids_by_url: Dict[str, Set[str]]
+    url_by_id: Dict[str, str]
+    folders: List[str]
+    # bookmarks updated after this (server time) have not been read yet
+    synced_at: datetime
+    loaded_at: float
+    refreshed_at: float
+
+    def add(self, bookmark_id: str, url: str, folder: str | None = None):
+        self.ids_by_url.setdefault(url, set()).add(bookmark_id)
+        self.url_by_id[bookmark_id] = url
+        if folder is not None and folder not in self.folders:
+            self.folders.append(folder)
+
+    def remove(self, bookmark_id: str):
+        url = self.url_by_id.pop(bookmark_id, None)
+        if url is None:
+            return
+        ids = self.ids_by_url[url]
+        ids.discard(bookmark_id)
+        if not ids:
+            del self.ids_by_url[url]
+
+
 class AsyncBookmarkStoreService(BaseBookmarkStoreService):
+    """
+    Keeps the bookmarked URLs and folders of active users in memory, so /info is answered without Firestore.
+    The index is loaded in the background on first use, requests are answered with point queries until it is
+    there. Every write going through this service updates it, bookmarks written by other instances are read
+    incrementally by their `updated_at`.
+    """
+
+    __indexes: LRUCache[str, _BookmarkIndex] = LRUCache(maxsize=config.bookmark_index_cache_size)
+    # bumped by every write, an index loaded while a write happened is not cached
+    __index_generations: LRUCache[str, int] = LRUCache(maxsize=config.bookmark_index_cache_size)
+    __index_loads = SingleFlight()
+    __background_tasks: Set[asyncio.Task] = set()
+
     def __init__(self):
-        self.db = async_firebase_app
         self.config = Config()
 
+    @property
+    def db(self):
+        return get_async_firestore()
+
     @lru_cache(maxsize=64)
     def get_user_document(self, x_uid: str):
         if config.environment == 'production':
@@ -44,6 +101,7 @@ class AsyncBookmarkStoreService(BaseBookmarkStoreService):
             return self.db.collection('test_users').document(x_uid)
 
 
+    @timed_async('get_user_folders', backend='firestore')
     async def get_user_folders(self, x_uid: str) -> List[str]:
         doc_ref = self.get_user_document(x_uid)
         doc = await doc_ref.get()
@@ -51,46 +109,199 @@ class AsyncBookmarkStoreService(BaseBookmarkStoreService):
             raise Exception(f'User {x_uid} does not exist')
         return UserDoc.parse_obj(doc.to_dict()).folders
 
+    @timed_async('get_bookmarks_by_url', backend='firestore')
     async def get_bookmarks_by_url(self, x_uid: str, url: str):
         doc_ref = self.get_user_document(x_uid).collection('bookmarks')
         docs = await doc_ref.where('url', '==', url).get()
-        return [doc.to_dict() for doc in docs]
+        return [{**doc.to_dict(), 'id': doc.id} for doc in docs]
+
+    async def get_url_info(self, x_uid: str, urls: List[str]) -> Tuple[Dict[str, bool], List[str]]:
+        """
+        Returns whether each URL is bookmarked and the user's folders, from the in-memory index once it is loaded.
+        """
+        index = self.__indexes.get(x_uid)
+        if index is None:
+            self.__in_background(('load', x_uid), lambda: self.__load_index(x_uid))
+            return await self.__query_url_info(x_uid, urls)
+        now = time.monotonic()
+        if now - index.loaded_at > self.config.bookmark_index_max_age:
+            # picks up bookmarks deleted by other instances, the current index answers meanwhile
+            self.__in_background(('load', x_uid), lambda: self.__load_index(x_uid))
+        elif now - index.refreshed_at > self.config.bookmark_index_refresh_interval:
+            self.__in_background(('refresh', x_uid), lambda: self.__refresh_index(x_uid, index))
+        return {url: url in index.ids_by_url for url in urls}, list(index.folders)
+
+    def __in_background(self, key: Tuple[str, str], func):
+        if self.__index_loads.running(key):
+            return
+
+        async def run():
+            try:
+                await self.__index_loads.do(key, func)
+            except Exception as e:
+                log.error(f'Could not {key[0]} the bookmark index of {key[1]}: {e}')
+
+        task = asyncio.create_task(run())
+        self.__background_tasks.add(task)
+        task.add_done_callback(self.__background_tasks.discard)
+
+    @timed_async('query_url_info', backend='firestore')
+    async def __query_url_info(self, x_uid: str, urls: List[str]) -> Tuple[Dict[str, bool], List[str]]:
+        bookmarks_ref = self.get_user_document(x_uid).collection('bookmarks')
+        unique_urls = list(dict.fromkeys(urls))
+        results = await asyncio.gather(
+            self.get_user_folders(x_uid),
+            *[bookmarks_ref.where('url', 'in', unique_urls[start:start + _in_query_size]).select(['url']).get()
+              for start in range(0, len(unique_urls), _in_query_size)],
+        )
+        folders, pages = results[0], results[1:]
+        bookmarked = {doc.get('url') for docs in pages for doc in docs}
+        return {url: url in bookmarked for url in urls}, folders
+
+    @timed_async('load_bookmark_index', backend='firestore')
+    async def __load_index(self, x_uid: str) -> _BookmarkIndex:
+        generation = self.__index_generations.get(x_uid, 0)
+        synced_at = datetime.now(timezone.utc)
+        user_doc_ref = self.get_user_document(x_uid)
+        docs, folders = await asyncio.gather(
+            user_doc_ref.collection('bookmarks').select(['url']).get(),
+            self.get_user_folders(x_uid),
+        )
+        now = time.monotonic()
+        index = _BookmarkIndex(ids_by_url={}, url_by_id={}, folders=list(folders),
+                               synced_at=synced_at, loaded_at=now, refreshed_at=now)
+        for doc in docs:
+            index.add(doc.id, doc.get('url'))
+        if self.__index_generations.get(x_uid, 0) == generation:
+            self.__indexes[x_uid] = index
+        return index
 
-    async def add_bookmark(self, x_uid: str, document: ExtensionDocument | ExtensionPDFDocument):
+    @timed_async('refresh_bookmark_index', backend='firestore')
+    async def __refresh_index(self, x_uid: str, index: _BookmarkIndex):
+        generation = self.__index_generations.get(x_uid, 0)
+        synced_at = datetime.now(timezone.utc)
         user_doc_ref = self.get_user_document(x_uid)
-        firebase_data = {
+        # bills one read per bookmark written since the last sync instead of one per bookmark
+        docs, folders = await asyncio.gather(
+            user_doc_ref.collection('bookmarks').where('updated_at', '>', index.synced_at - _sync_overlap).select(['url']).get(),
+            self.get_user_folders(x_uid),
+        )
+        for doc in docs:
+            index.add(doc.id, doc.get('url'))
+        if self.__index_generations.get(x_uid, 0) == generation:
+            index.folders = list(folders)
+        index.synced_at = synced_at
+        index.refreshed_at = time.monotonic()
+
+    def __touch_index(self, x_uid: str) -> _BookmarkIndex | None:
+        self.__index_generations[x_uid] = self.__index_generations.get(x_uid, 0) + 1
+        return self.__indexes.get(x_uid)
+
+    @staticmethod
+    def __bookmark_data(document: ExtensionDocument | ExtensionPDFMetadata):
+        return {
             'folder': document.folder,
             'timestamp': document.timestamp,
             'url': document.url,
             'title': document.title,
-            'type': "pdf" if isinstance(document, ExtensionPDFDocument) else "url"
+            'type': "pdf" if isinstance(document, ExtensionPDFMetadata) else "url",
+            # commit time, the bookmark index of other instances reads what changed after its last sync
+            'updated_at': SERVER_TIMESTAMP,
         }
+
+    @timed_async('add_bookmark', backend='firestore')
+    async def add_bookmark(self, x_uid: str, document: ExtensionDocument | ExtensionPDFMetadata):
+        user_doc_ref = self.get_user_document(x_uid)
+        firebase_data = self.__bookmark_data(document)
         add_bookmark_task = user_doc_ref.collection('bookmarks').add(firebase_data)
         create_new_folder_task = user_doc_ref.update({
             'folders': ArrayUnion([document.folder])
         })
         bookmark_task, folder_task = await asyncio.gather(add_bookmark_task, create_new_folder_task)
-        return bookmark_task[1]  # bookmark_task: Tuple[timestamp, ref]
+        bookmark_ref = bookmark_task[1]  # bookmark_task: Tuple[timestamp, ref]
+        if index := self.__touch_index(x_uid):
+            index.add(bookmark_ref.id, document.url, document.folder)
+        return bookmark_ref
 
-    async def delete_user_bookmark(self, x_uid: str, document: ExtensionDocument | ExtensionPDFDocument):
-        col_ref = self.get_user_document(x_uid).collection('bookmarks')
-        docs = col_ref.where("url", '==', document.url).stream()
+    @timed_async('update_bookmark', backend='firestore')
+    async def update_bookmark(self, x_uid: str, bookmark_id: str, document: ExtensionDocument | ExtensionPDFMetadata):
+        """
+        Overwrites an existing bookmark with the metadata of a re-saved document.
+        """
+        user_doc_ref = self.get_user_document(x_uid)
+        await asyncio.gather(
+            user_doc_ref.collection('bookmarks').document(bookmark_id).set(self.__bookmark_data(document)),
+            user_doc_ref.update({
+                'folders': ArrayUnion([document.folder])
+            }),
+        )
+        if index := self.__touch_index(x_uid):
+            index.add(bookmark_id, document.url, document.folder)
 
-        for doc in docs:
-            await doc.reference.delete()
+    @timed_async('add_bookmarks', backend='firestore')
+    async def add_bookmarks(self, x_uid: str, documents: List[ExtensionDocument | ExtensionPDFMetadata]):
+        """
+        Creates the bookmarks in a single write batch together with the folder update and returns their refs
+        in input order. Firestore allows 500 writes per batch, so at most 499 documents can be passed.
+        """
+        if len(documents) > 499:
+            raise Exception('At most 499 bookmarks can be added in one batch')
+        user_doc_ref = self.get_user_document(x_uid)
+        bookmarks_ref = user_doc_ref.collection('bookmarks')
+        batch = self.db.batch()
+        doc_refs = []
+        for document in documents:
+            doc_ref = bookmarks_ref.document()  # ids are generated client side
+            batch.set(doc_ref, self.__bookmark_data(document))
+            doc_refs.append(doc_ref)
+        folders = list(dict.fromkeys(document.folder for document in documents))
+        if folders:
+            batch.update(user_doc_ref, {'folders': ArrayUnion(folders)})
+        await batch.commit()
+        if index := self.__touch_index(x_uid):
+            for doc_ref, document in zip(doc_refs, documents):
+                index.add(doc_ref.id, document.url, document.folder)
+        return doc_refs
 
+    @timed_async('delete_user_bookmark', backend='firestore')
+    async def delete_user_bookmark(self, x_uid: str, document: ExtensionDocument | ExtensionPDFMetadata):
+        col_ref = self.get_user_document(x_uid).collection('bookmarks')
+        docs = await col_ref.where("url", '==', document.url).select([]).get()
+        await self.__delete_refs([doc.reference for doc in docs])
+        if index := self.__touch_index(x_uid):
+            for doc in docs:
+                index.remove(doc.id)
+
+    @timed_async('batch_delete', backend='firestore')
     async def batch_delete(self, x_uid: str, ids: List[str], folders_to_delete: List[str] | None = None):
-        doc_refs = [
-            self.get_user_document(
-                x_uid
-            ).collection(
-                'bookmarks'
-            ).document(_id) for _id in ids
-        ]
-        await asyncio.gather(*[doc_ref.delete() for doc_ref in doc_refs])
-        if folders_to_delete:
-            user_doc_ref = self.get_user_document(x_uid)
-            await user_doc_ref.update({
-                'folders': ArrayRemove(folders_to_delete)
-            })
+        bookmarks_ref = self.get_user_document(x_uid).collection('bookmarks')
+        try:
+            await self.__delete_refs([bookmarks_ref.document(_id) for _id in ids])
+            if folders_to_delete:
+                user_doc_ref = self.get_user_document(x_uid)
+                await user_doc_ref.update({
+                    'folders': ArrayRemove(folders_to_delete)
+                })
+        except Exception:
+            # some batches may have been committed, the index is reloaded instead of guessing
+            self.__touch_index(x_uid)
+            self.__indexes.pop(x_uid, None)
+            raise
+        if index := self.__touch_index(x_uid):
+            for _id in ids:
+                index.remove(_id)
+            index.folders = [folder for folder in index.folders if folder not in (folders_to_delete or [])]
+
+    async def __delete_refs(self, doc_refs):
+        # a write batch holds at most 500 writes, and only a few are committed at the same time to stay within quotas
+        size = self.config.delete_firestore_batch_size
+        semaphore = asyncio.Semaphore(self.config.delete_firestore_concurrency)
+
+        async def commit(refs):
+            async with semaphore:
+                batch = self.db.batch()
+                for doc_ref in refs:
+                    batch.delete(doc_ref)
+                await batch.commit()
 
+        await asyncio.gather(*[commit(doc_refs[start:start + size]) for start in range(0, len(doc_refs), size)])
@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List, Tuple
+
+from pydantic import ValidationError
+
+from config import Config
+from models.extension import ExtensionDocument
+from models.ingest import BulkImportItemResult, BulkImportResult
+from services.bookmark_store_service import AsyncBookmarkStoreService
+from services.ingest_service import IngestService, ingest_service as default_ingest_service
+from utils.text_chunker import Chunk, TokenTextChunker
+
+log = logging.getLogger(__name__)
+config = Config()
+
+
+@dataclass
+class _BulkItem:
+    index: int
+    document: ExtensionDocument
+    chunks: List[Chunk] | None = None
+    bookmark_id: str | None = None
+
+
+class BulkImportService:
+    """
+    Imports a stream of NDJSON encoded ExtensionDocuments for one user through a pipeline of
+    parse -> chunk -> Firestore write batches -> vector store batches. Stages are connected by bounded
+    queues, so a slow stage holds back the request body instead of buffering it. A failing item is
+    reported in the result and never aborts the rest of the import. If the import itself is aborted (the client
+    disconnects), the bookmarks that were written without their chunks are rolled back.
+    """
+
+    def __init__(self,
+                 uid: str,
+                 chunker: TokenTextChunker,
+                 bookmark_service: AsyncBookmarkStoreService | None = None,
+                 ingest_service: IngestService | None = None):
+        self.uid = uid
+        self.chunker = chunker
+        self.bookmark_service = bookmark_service or AsyncBookmarkStoreService()
+        self.ingest_service = ingest_service or default_ingest_service
+        self.results: Dict[int, BulkImportItemResult] = {}
+        # Firestore commits that may still be running when the import is aborted
+        self.__bookmark_commits: Dict[asyncio.Future, List[_BulkItem]] = {}
+        # (bookmark id, url) of the items whose bookmark is written but whose chunks are not stored yet
+        self.__unfinished: Dict[int, Tuple[str, str]] = {}
+
+    async def import_documents(self, body: AsyncIterator[bytes]) -> BulkImportResult:
+        start = time.perf_counter()
+        chunk_queue: asyncio.Queue[_BulkItem | None] = asyncio.Queue(maxsize=config.bulk_queue_size)
+        bookmark_queue: asyncio.Queue[_BulkItem | None] = asyncio.Queue(maxsize=config.bulk_queue_size)
+        vector_queue: asyncio.Queue[_BulkItem | None] = asyncio.Queue(maxsize=config.bulk_queue_size)
+
+        chunk_workers = [asyncio.create_task(self.__chunk_worker(chunk_queue, bookmark_queue))
+                         for _ in range(config.bulk_chunk_workers)]
+        bookmark_writer = asyncio.create_task(self.__bookmark_writer(bookmark_queue, vector_queue))
+        vector_workers = [asyncio.create_task(self.__vector_worker(vector_queue))
+                          for _ in range(config.bulk_vectorstore_workers)]
+        tasks = chunk_workers + [bookmark_writer] + vector_workers
+        try:
+            await self.__read(body, chunk_queue)
+            # every stage is closed with one sentinel per consumer once its producers are done
+            for _ in chunk_workers:
+                await chunk_queue.put(None)
+            await asyncio.gather(*chunk_workers)
+            await bookmark_queue.put(None)
+            await bookmark_writer
+            for _ in vector_workers:
+                await vector_queue.put(None)
+            await asyncio.gather(*vector_workers)
+        except BaseException:
+            # runs to the end even if the request is cancelled again meanwhile
+            await asyncio.shield(self.__abort(tasks))
+            raise
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        elapsed = time.perf_counter() - start
+        items = [self.results[index] for index in sorted(self.results)]
+        succeeded = sum(1 for item in items if item.success)
+        chunks = sum(item.chunks for item in items if item.success)
+        return BulkImportResult(
+            items=items,
+            succeeded=succeeded,
+            failed=len(items) - succeeded,
+            chunks=chunks,
+            elapsed_s=elapsed,
+            items_per_s=len(items) / elapsed if elapsed else 0.0,
+            chunks_per_s=chunks / elapsed if elapsed else 0.0,
+        )
+
+    async def __read(self, body: AsyncIterator[bytes], chunk_queue: asyncio.Queue):
+        index = 0
+        remainder = b''
+        async for body_chunk in body:
+            lines = (remainder + body_chunk).split(b'\n')
+            remainder = lines.pop()
+            for line in lines:
+                if line.strip():
+                    await self.__parse(index, line, chunk_queue)
+                    index += 1
+        if remainder.strip():
+            await self.__parse(index, remainder, chunk_queue)
+
+    async def __parse(self, index: int, line: bytes, chunk_queue: asyncio.Queue):
+        try:
+            document = ExtensionDocument.parse_raw(line)
+        except ValidationError as e:
+            self.__fail(index, None, f'Invalid document: {e}')
+            return
+        await chunk_queue.put(_BulkItem(index=index, document=document))
+
+    async def __chunk_worker(self, chunk_queue: asyncio.Queue, bookmark_queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while (item := await chunk_queue.get()) is not None:
+            try:
+                item.chunks = await loop.run_in_executor(None, self.chunker.split_text, item.document.raw_text)
+                item.document.raw_text = ''  # only the chunks are needed from here on
+            except Exception as e:
+                self.__fail(item.index, item.document.url, str(e))
+                continue
+            await bookmark_queue.put(item)
+
+    async def __bookmark_writer(self, bookmark_queue: asyncio.Queue, vector_queue: asyncio.Queue):
+        semaphore = asyncio.Semaphore(config.bulk_firestore_concurrency)
+        commits = set()
+        closed = False
+        while not closed:
+            item = await bookmark_queue.get()
+            if item is None:
+                break
+            batch = [item]
+            if bookmark_queue.qsize() < config.bulk_firestore_batch_size - 1:
+                await asyncio.sleep(config.ingest_batch_linger)
+            while len(batch) < config.bulk_firestore_batch_size and not bookmark_queue.empty():
+                item = bookmark_queue.get_nowait()
+                if item is None:
+                    closed = True
+                    break
+                batch.append(item)
+
+            await semaphore.acquire()  # waits while `bulk_firestore_concurrency` commits are in flight
+            commit = asyncio.create_task(self.__commit_bookmarks(batch, vector_queue))
+            commit.add_done_callback(lambda _: semaphore.release())
+            commits.add(commit)
+            commit.add_done_callback(commits.discard)
+        await asyncio.gather(*commits)
+
+    async def __commit_bookmarks(self, batch: List[_BulkItem], vector_queue: asyncio.Queue):
+        # cancelling this task must not cancel a commit that may already be applied, __abort collects its ids
+        commit = asyncio.ensure_future(self.bookmark_service.add_bookmarks(self.uid, [item.document for item in batch]))
+        self.__bookmark_commits[commit] = batch
+        try:
+            doc_refs = await asyncio.shield(commit)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            del self.__bookmark_commits[commit]
+            log.error(f'Could not write {len(batch)} bookmarks: {e}')
+            for item in batch:
+                self.__fail(item.index, item.document.url, str(e))
+            return
+        del self.__bookmark_commits[commit]
+        self.__committed(batch, doc_refs)
+        for item in batch:
+            await vector_queue.put(item)
+
+    def __committed(self, batch: List[_BulkItem], doc_refs):
+        for item, doc_ref in zip(batch, doc_refs):
+            item.bookmark_id = doc_ref.id
+            self.__unfinished[item.index] = (doc_ref.id, item.document.url)
+
+    async def __abort(self, tasks: List[asyncio.Task]):
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for commit, batch in list(self.__bookmark_commits.items()):
+            try:
+                self.__committed(batch, await commit)
+            except Exception:
+                pass  # a failed write batch wrote nothing
+        if not self.__unfinished:
+            return
+        bookmark_ids = [bookmark_id for bookmark_id, _ in self.__unfinished.values()]
+        log.warning(f'Bulk import aborted, rolling back {len(bookmark_ids)} bookmarks without chunks')
+        for index, (_, url) in list(self.__unfinished.items()):
+            self.__fail(index, url, 'Import aborted')
+        try:
+            await self.ingest_service.rollback_bookmarks(self.uid, bookmark_ids)
+        except Exception as e:
+            log.error(f'Could not roll back bookmarks {bookmark_ids}: {e}')
+
+    async def __vector_worker(self, vector_queue: asyncio.Queue):
+        while (item := await vector_queue.get()) is not None:
+            try:
+                await self.ingest_service.store_chunks(self.uid, item.document, item.bookmark_id, item.chunks)
+            except Exception as e:
+                self.__fail(item.index, item.document.url, str(e))
+                try:
+                    await self.ingest_service.rollback_bookmark(self.uid, item.bookmark_id)
+                except Exception as rollback_error:
+                    log.error(f'Could not roll back bookmark {item.bookmark_id}: {rollback_error}')
+                self.__unfinished.pop(item.index, None)
+                continue
+            self.__unfinished.pop(item.index, None)
+            self.results[item.index] = BulkImportItemResult(
+                index=item.index,
+                url=item.document.url,
+                success=True,
+                bookmark_id=item.bookmark_id,
+                chunks=len(item.chunks),
+            )
+
+    def __fail(self, index: int, url: str | None, error: str):
+        self.results[index] = BulkImportItemResult(index=index, url=url, success=False, error=error)
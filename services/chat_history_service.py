@@ -1,82 +1,279 @@
 import logging
+from dataclasses import dataclass
 from datetime import datetime
-from typing import List
+from typing import Dict, List, Set, Tuple
 
+from cachetools import LRUCache, TTLCache
+from fastapi import HTTPException
 from google.cloud.firestore_v1.types import firestore
 from langchain.schema import BaseMessage, _message_to_dict, HumanMessage, AIMessage
 
 from config import Config
 from models.bookmark import VectorStoreBookmark, VectorStoreBookmarkMetadata
-from models.chat import ConversationMessage
-from utils.db import async_firebase_app
+from models.chat import ChatHistoryPage, ConversationListPage, ConversationMessage, ConversationSummary
+from utils.db import get_async_firestore
+from utils.metrics import timed_async
+from utils.write_behind import firestore_write_buffer
 
 log = logging.getLogger(__name__)
+config = Config()
+
+
+def _parse_cursor(cursor: str) -> Tuple[int, str]:
+    # cursors come from the client, `<timestamp>:<document id>`
+    try:
+        timestamp, document_id = cursor.split(':', 1)
+        return int(timestamp), document_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f'Invalid cursor {cursor!r}')
+
+
+@dataclass
+class _CachedHistory:
+    # the newest messages of a conversation in chronological order, `complete` when nothing older exists
+    messages: List[ConversationMessage]
+    complete: bool
+
+    def page(self, limit: int, cursor: str | None) -> ChatHistoryPage | None:
+        if cursor is None:
+            end = len(self.messages)
+        else:
+            end = next((i for i, m in enumerate(self.messages) if m.cursor == cursor), None)
+            if end is None:
+                return None
+        start = end - limit
+        if start > 0:
+            return ChatHistoryPage(messages=self.messages[start:end], next_cursor=self.messages[start].cursor)
+        if self.complete:
+            return ChatHistoryPage(messages=self.messages[:end])
+        if start == 0 and end > 0:
+            return ChatHistoryPage(messages=self.messages[:end], next_cursor=self.messages[0].cursor)
+        return None
 
 
 class ChatHistoryService:
+    __history_cache: TTLCache[Tuple[str, str], _CachedHistory] = TTLCache(
+        maxsize=config.chat_history_cache_size, ttl=config.chat_history_cache_ttl
+    )
+    # short lived, it only absorbs repeated sidebar refreshes
+    __conversations_cache: TTLCache[str, Dict[Tuple[int, str | None], ConversationListPage]] = TTLCache(
+        maxsize=config.chat_history_cache_size, ttl=config.conversations_cache_ttl
+    )
+    __indexed_users: Set[str] = set()
+    # conversations this process has seen, mapped to whether they have a title, saves the existence check
+    __known_conversations: LRUCache[Tuple[str, str], bool] = LRUCache(maxsize=config.chat_history_cache_size * 10)
+
     def __init__(self, x_uid: str):
-        self.db = async_firebase_app
+        self.db = get_async_firestore()
         self.config = Config()
         self.x_uid = x_uid
 
-    def __get_user_document(self):
+    def get_user_document(self):
         if self.config.environment == 'production':
             return self.db.collection('users').document(self.x_uid)
         else:
             return self.db.collection('test_users').document(self.x_uid)
 
     def get_conversation_document(self, conversation_id: str):
-        user_doc_ref = self.__get_user_document()
+        user_doc_ref = self.get_user_document()
         return user_doc_ref.collection('conversations').document(conversation_id)
 
-    async def get_chat_history(self, conversation_id: str) -> List[ConversationMessage]:
+    @timed_async('chat_history.get')
+    async def get_chat_history(self, conversation_id: str, limit: int | None = None, cursor: str | None = None) -> ChatHistoryPage:
+        """
+        Returns up to `limit` messages older than `cursor` (the newest ones without a cursor) in chronological
+        order. `next_cursor` of the page points at the next older page.
+        """
+        limit = limit or self.config.chat_history_page_size
+        cache_key = (self.x_uid, conversation_id)
+        cached = self.__history_cache.get(cache_key)
+        if cached is not None:
+            page = cached.page(limit, cursor)
+            if page is not None:
+                return page
+
+        page = await self.__fetch_history_page(conversation_id, limit, cursor)
+        if cursor is None and page.messages:
+            self.__history_cache[cache_key] = _CachedHistory(list(page.messages), complete=page.next_cursor is None)
+        elif cached is not None and cached.messages and cached.messages[0].cursor == cursor:
+            cached.messages = page.messages + cached.messages
+            cached.complete = page.next_cursor is None
+        if cursor is None and not page.messages:
+            return ChatHistoryPage(messages=await self.__get_legacy_chat_history(conversation_id))
+        return page
+
+    @timed_async('fetch_history_page', backend='firestore')
+    async def __fetch_history_page(self, conversation_id: str, limit: int, cursor: str | None) -> ChatHistoryPage:
         conversation_doc_ref = self.get_conversation_document(conversation_id)
-        sorted_collection = conversation_doc_ref.collection('messages').order_by('timestamp')
-        history = [ConversationMessage.parse_obj(mes.to_dict()) async for mes in sorted_collection.stream()]
-        if not history:
-            try:
-                doc = await conversation_doc_ref.get()
-                doc = doc.to_dict()
-                return [
-                    ConversationMessage(
-                        message=_message_to_dict(HumanMessage(content=doc.get('question'))),
-                        used_context=[],
-                        timestamp=doc.get('timestamp'),
-                    ),
-                    ConversationMessage(
-                        message=_message_to_dict(AIMessage(content=doc.get('answer'))),
-                        used_context=[VectorStoreBookmarkMetadata(url=url, title='', id='') for url in doc.get('context_urls', [])],
-                        timestamp=doc.get('timestamp'),
-                    )
-                ]
-            except Exception as e:
-                log.warning(f'Could not get conversation {conversation_id}: {e}')
-                return []
-        return history
+        query = conversation_doc_ref.collection('messages').order_by(
+            'timestamp', direction='DESCENDING'
+        ).order_by(
+            '__name__', direction='DESCENDING'
+        )
+        if cursor is not None:
+            timestamp, message_id = _parse_cursor(cursor)
+            query = query.start_after({'timestamp': timestamp, '__name__': message_id})
+
+        # one extra message tells whether an older page exists
+        newest_first = [
+            ConversationMessage.parse_obj({**mes.to_dict(), 'id': mes.id})
+            async for mes in query.limit(limit + 1).stream()
+        ]
+        has_more = len(newest_first) > limit
+        messages = newest_first[:limit][::-1]
+        return ChatHistoryPage(messages=messages, next_cursor=messages[0].cursor if has_more else None)
+
+    async def __get_legacy_chat_history(self, conversation_id: str) -> List[ConversationMessage]:
+        conversation_doc_ref = self.get_conversation_document(conversation_id)
+        try:
+            doc = await conversation_doc_ref.get()
+            doc = doc.to_dict()
+            return [
+                ConversationMessage(
+                    message=_message_to_dict(HumanMessage(content=doc.get('question'))),
+                    used_context=[],
+                    timestamp=doc.get('timestamp'),
+                ),
+                ConversationMessage(
+                    message=_message_to_dict(AIMessage(content=doc.get('answer'))),
+                    used_context=[VectorStoreBookmarkMetadata(url=url, title='', id='') for url in doc.get('context_urls', [])],
+                    timestamp=doc.get('timestamp'),
+                )
+            ]
+        except Exception as e:
+            log.warning(f'Could not get conversation {conversation_id}: {e}')
+            return []
+
+    @classmethod
+    def remember_conversation(cls, x_uid: str, conversation_id: str, has_title: bool):
+        cls.__known_conversations[(x_uid, conversation_id)] = has_title
 
+    @timed_async('add_chat_message', backend='firestore')
     async def add_chat_message(self, conversation_id: str, message: BaseMessage, used_context: List[VectorStoreBookmark] = None):
         conversation_doc_ref = self.get_conversation_document(conversation_id)
-        conversation_doc = await conversation_doc_ref.get()
-        if not conversation_doc.exists:
-            raise Exception(f'Conversation {conversation_id} does not exist')
-        if not conversation_doc.get('title'):
-            await conversation_doc_ref.update({
-                'title': message.content[:250] + '...' if len(message.content) > 250 else message.content
-            })
-        await conversation_doc_ref.collection('messages').add(ConversationMessage(
+        known_key = (self.x_uid, conversation_id)
+        has_title = self.__known_conversations.get(known_key)
+        conversation_timestamp = None
+        if has_title is None:
+            conversation_doc = await conversation_doc_ref.get(['title', 'timestamp'])
+            if not conversation_doc.exists:
+                raise Exception(f'Conversation {conversation_id} does not exist')
+            conversation_data = conversation_doc.to_dict()
+            has_title = bool(conversation_data.get('title'))
+            conversation_timestamp = conversation_data.get('timestamp')
+
+        conversation_message = self.__build_message(message, used_context)
+        message_ref = conversation_doc_ref.collection('messages').document()
+        conversation_message.id = message_ref.id
+
+        # message and title go out in a single commit
+        batch = self.db.batch()
+        batch.set(message_ref, conversation_message.dict(exclude={'id'}))
+        if not has_title:
+            title = message.content[:250] + '...' if len(message.content) > 250 else message.content
+            batch.update(conversation_doc_ref, {'title': title})
+            index_entry = {'title': title}
+            if conversation_timestamp is not None:
+                index_entry['timestamp'] = conversation_timestamp
+            batch.set(self.get_conversation_index().document(conversation_id), index_entry, merge=True)
+        await batch.commit()
+
+        self.__known_conversations[known_key] = True
+        if not has_title:
+            self.invalidate_conversations(self.x_uid)
+        self.__cache_message(conversation_id, conversation_message)
+
+    def enqueue_chat_message(self, conversation_id: str, message: BaseMessage, used_context: List[VectorStoreBookmark] = None):
+        """
+        Write-behind variant of add_chat_message for conversations that are known to exist and have a title,
+        the message is committed with the next flush of the shared write buffer.
+        """
+        message_ref = self.get_conversation_document(conversation_id).collection('messages').document()
+        conversation_message = self.__build_message(message, used_context)
+        conversation_message.id = message_ref.id
+        firestore_write_buffer.set(message_ref, conversation_message.dict(exclude={'id'}))
+        self.__cache_message(conversation_id, conversation_message)
+
+    @classmethod
+    def __build_message(cls, message: BaseMessage, used_context: List[VectorStoreBookmark] | None) -> ConversationMessage:
+        return ConversationMessage(
             message=_message_to_dict(message),
             timestamp=int(datetime.now().timestamp()),
             used_context=[bookmark.metadata.dict() for bookmark in used_context] if used_context else None
-        ).dict())
+        )
+
+    def __cache_message(self, conversation_id: str, conversation_message: ConversationMessage):
+        # write-through, so the cached newest page stays correct
+        cached = self.__history_cache.get((self.x_uid, conversation_id))
+        if cached is not None:
+            cached.messages.append(conversation_message)
+
+    @classmethod
+    def invalidate_conversations(cls, x_uid: str):
+        cls.__conversations_cache.pop(x_uid, None)
+
+    def get_conversation_index(self):
+        # one small {title, timestamp} document per conversation, so listing never reads message payloads
+        return self.get_user_document().collection('conversation_index')
+
+    @timed_async('conversations.get')
+    async def get_conversations(self, limit: int | None = None, cursor: str | None = None) -> ConversationListPage:
+        limit = limit or self.config.conversations_page_size
+        cached_pages = self.__conversations_cache.get(self.x_uid)
+        if cached_pages is not None and (limit, cursor) in cached_pages:
+            return cached_pages[(limit, cursor)]
+
+        await self.__ensure_conversation_index()
+        query = self.get_conversation_index().order_by(
+            'timestamp', direction='DESCENDING'
+        ).order_by(
+            '__name__', direction='DESCENDING'
+        )
+        if cursor is not None:
+            timestamp, conversation_id = _parse_cursor(cursor)
+            query = query.start_after({'timestamp': timestamp, '__name__': conversation_id})
 
-    async def get_conversations(self):
-        user_doc_ref = self.__get_user_document()
-        conversations_ref = user_doc_ref.collection('conversations')
         conversations = [
-            {
-                'id': conversation.id,
-                'title': conversation.to_dict().get('title') or conversation.to_dict().get('question'), # backwards compatibility
-            } async for conversation in conversations_ref.order_by('timestamp', direction="DESCENDING").stream()
+            ConversationSummary(id=conversation.id, **conversation.to_dict())
+            async for conversation in query.limit(limit + 1).stream()
         ]
+        has_more = len(conversations) > limit
+        conversations = conversations[:limit]
+        page = ConversationListPage(
+            conversations=conversations,
+            next_cursor=conversations[-1].cursor if has_more else None,
+        )
 
-        return conversations
+        if cached_pages is None:
+            cached_pages = self.__conversations_cache[self.x_uid] = {}
+        cached_pages[(limit, cursor)] = page
+        return page
+
+    async def __ensure_conversation_index(self):
+        if self.x_uid in self.__indexed_users:
+            return
+        user_doc_ref = self.get_user_document()
+        user_doc = await user_doc_ref.get(['conversation_index_built'])
+        if not (user_doc.to_dict() or {}).get('conversation_index_built'):
+            await self.__build_conversation_index()
+            await user_doc_ref.set({'conversation_index_built': True}, merge=True)
+        self.__indexed_users.add(self.x_uid)
+
+    async def __build_conversation_index(self):
+        conversations_ref = self.get_user_document().collection('conversations')
+        index_ref = self.get_conversation_index()
+        batch = self.db.batch()
+        batch_size = 0
+        async for conversation in conversations_ref.select(['title', 'question', 'timestamp']).stream():
+            data = conversation.to_dict()
+            batch.set(index_ref.document(conversation.id), {
+                'title': data.get('title') or data.get('question'),  # backwards compatibility
+                'timestamp': data.get('timestamp'),
+            })
+            batch_size += 1
+            if batch_size == 500:  # firestore write batch limit
+                await batch.commit()
+                batch = self.db.batch()
+                batch_size = 0
+        if batch_size:
+            await batch.commit()
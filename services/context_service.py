@@ -1,137 +1,229 @@
-from typing import List, Dict, Any
+import asyncio
+import contextvars
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import List, Dict, Any, Tuple
 
-import tiktoken
+import numpy as np
 import weaviate
+
 from config import Config
 from models.bookmark import VectorStoreBookmark
+from services.vector_stores import ChunkFilter, ChunkHit, LocalVectorStore, VectorStore, WeaviateVectorStore
+from utils.db import get_vectorstore
+from utils.metrics import timed
+from utils.mmr import best_per_group, mmr, normalize_relevance
+from utils.single_flight import SingleFlight
+from utils.tokens import count_tokens
 
 config = Config()
 
+# the vector store clients are blocking, so every call is pushed to a bounded pool to keep the event loop free
+vectorstore_executor = ThreadPoolExecutor(
+    max_workers=config.vectorstore_max_workers,
+    thread_name_prefix='vectorstore',
+)
 
-class ContextService:
-    def __init__(self, client: weaviate.Client):
-        self.client = client
 
-    def get_context(self, message: str, user_id: str, selected_context: List[str] | None = None,  certainty: float = 0.8) -> List[VectorStoreBookmark]:
-        relevant_docs = self.__get_relevant_documents(message, user_id, selected_context, certainty)
-        limited_context = self.__limit_context(relevant_docs, config.max_tokens)
+async def get_context_service() -> 'ContextService':
+    """
+    FastAPI dependency. Builds the vector store client off the event loop if startup warm-up has not done it yet.
+    """
+    if not get_shared_context_service.cache_info().currsize:
+        return await asyncio.to_thread(get_shared_context_service)
+    return get_shared_context_service()
+
+
+@lru_cache()
+def get_shared_context_service() -> 'ContextService':
+    if config.vectorstore_backend == 'local':
+        return ContextService(vector_store=LocalVectorStore(config.local_vectorstore_path))
+    return ContextService(get_vectorstore())
+
+
+class ContextService:
+    """
+    Stores and queries bookmark chunks through a `VectorStore`, Weaviate unless another store is given.
+    Ranking on top of the store (token budget, grouping by bookmark, MMR) lives here so every backend shares it.
+    """
+
+    def __init__(self,
+                 client: weaviate.Client | None = None,
+                 executor: Executor | None = None,
+                 multi_tenancy: bool | None = None,
+                 vector_store: VectorStore | None = None):
+        self.vector_store = vector_store or WeaviateVectorStore(client, multi_tenancy)
+        self.executor = executor or vectorstore_executor
+        self.searches = SingleFlight()
+
+    async def _run_in_executor(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        # run_in_executor does not carry the context over, the request's stage timings live in it
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, partial(context.run, func, *args, **kwargs))
+
+    async def aget_context(self, message: str, user_id: str, selected_context: List[str] | None = None, certainty: float = 0.8, folders: List[str] | None = None, diversify: bool | None = None) -> List[VectorStoreBookmark]:
+        return await self._run_in_executor(self.get_context, message, user_id, selected_context, certainty, folders, diversify)
+
+    async def asearch(self, query: str, user_id: str, use_hybrid: bool = True, certainty: float = 0.8, limit: int = 3, alpha: float = 0.25, folders: List[str] | None = None,
+                      group_by_bookmark: bool = False, mmr_lambda: float = 0.5) -> List[VectorStoreBookmark]:
+        # identical searches in flight (typing bursts, several tabs) share one query and its vectorization
+        key = (user_id, query, use_hybrid, certainty, limit, alpha, tuple(folders or ()), group_by_bookmark, mmr_lambda)
+        return await self.searches.do(key, partial(
+            self._run_in_executor, self.search, query, user_id, use_hybrid, certainty, limit, alpha, folders, group_by_bookmark, mmr_lambda
+        ))
+
+    async def abatch_delete(self, user_id: str, firebase_ids: List[str]) -> int:
+        # chunks are deleted concurrently, bounded by the executor
+        deleted = await asyncio.gather(*[
+            self._run_in_executor(self.delete_chunk, user_id, chunk) for chunk in self.__chunk_ids(firebase_ids)
+        ])
+        return sum(deleted)
+
+    async def adelete_chunks_by_id(self, user_id: str, chunk_ids: List[str]) -> int:
+        deleted = await asyncio.gather(*[
+            self._run_in_executor(self.delete_chunks_by_id, user_id, chunk) for chunk in self.__chunk_ids(chunk_ids)
+        ])
+        return sum(deleted)
+
+    async def alist_chunk_ids(self, user_id: str, firebase_id: str) -> List[str]:
+        return await self._run_in_executor(self.list_chunk_ids, user_id, firebase_id)
+
+    async def ainsert_objects(self, objects: List[Dict[str, Any]], vectors: List[List[float] | None] | None = None, ids: List[str] | None = None) -> List[str | None]:
+        return await self._run_in_executor(self.insert_objects, objects, vectors, ids)
+
+    def insert_objects(self, objects: List[Dict[str, Any]], vectors: List[List[float] | None] | None = None, ids: List[str] | None = None) -> List[str | None]:
+        """
+        Writes `objects` as one batch and returns the error message for every object,
+        or None for the ones that were stored. Objects without a precomputed vector are vectorized by the store,
+        objects with the id of a stored chunk replace it.
+        """
+        with timed('add', self.vector_store.name):
+            return self.vector_store.add(objects, vectors, ids)
+
+    def list_chunk_ids(self, user_id: str, firebase_id: str) -> List[str]:
+        with timed('list_ids', self.vector_store.name):
+            return self.vector_store.list_ids(ChunkFilter(user_id, firebase_ids=[firebase_id]))
+
+    def delete_chunks_by_id(self, user_id: str, chunk_ids: List[str]) -> int:
+        if not chunk_ids:
+            return 0
+        with timed('delete', self.vector_store.name):
+            return self.vector_store.delete(ChunkFilter(user_id, chunk_ids=chunk_ids))
+
+    def get_context(self, message: str, user_id: str, selected_context: List[str] | None = None,  certainty: float = 0.8, folders: List[str] | None = None, diversify: bool | None = None) -> List[VectorStoreBookmark]:
+        with timed('context.retrieve'):
+            if config.context_diversify if diversify is None else diversify:
+                relevant_docs = self.__get_diverse_documents(message, user_id, selected_context, certainty, folders)
+            else:
+                relevant_docs = self.__get_relevant_documents(message, user_id, selected_context, certainty, folders)
+        with timed('context.limit_tokens'):
+            limited_context = self.__limit_context(relevant_docs, config.max_tokens)
         return limited_context
 
-    def search(self, query: str, user_id: str, use_hybrid: bool = True, certainty: float = 0.8, limit: int = 3, alpha: float = 0.25) -> List[VectorStoreBookmark]:
-        if use_hybrid:
-            relevant_docs = self.__hybrid_search(query, user_id, limit, alpha)
+    def search(self, query: str, user_id: str, use_hybrid: bool = True, certainty: float = 0.8, limit: int = 3, alpha: float = 0.25, folders: List[str] | None = None,
+               group_by_bookmark: bool = False, mmr_lambda: float = 0.5) -> List[VectorStoreBookmark]:
+        if group_by_bookmark:
+            relevant_docs = self.__search_bookmarks(query, user_id, use_hybrid, certainty, limit, alpha, folders, mmr_lambda)
+        elif use_hybrid:
+            relevant_docs = self.__hybrid_search(query, user_id, limit, alpha, folders)
         else:
-            relevant_docs = self.__get_relevant_documents(query, user_id, None, certainty)
+            relevant_docs = self.__get_relevant_documents(query, user_id, None, certainty, folders)
         return relevant_docs
 
-    def batch_delete(self, user_id: str, firebase_ids: List[str]):
-        where_filter = self.__get_where_filter(user_id, firebase_ids)
-        self.client.batch.delete_objects(
-            class_name="Document",
-            where=where_filter
-        )
+    def batch_delete(self, user_id: str, firebase_ids: List[str]) -> int:
+        return sum(self.delete_chunk(user_id, chunk) for chunk in self.__chunk_ids(firebase_ids))
 
-    @classmethod
-    def __build_id_in_filter(cls, selected_context: List[str]) -> Dict[str, Any]:
-        filters = [{
-            "path": ["firebase_id"],
-            "operator": "Equal",
-            "valueString": context
-        } for context in selected_context]
-
-        if len(filters) > 1:
-            where_filter = {
-                "operator": "Or",
-                "operands": filters
-            }
-        elif len(filters) == 1:
-            where_filter = filters[0]
-        else:
-            raise ValueError("selected_context must not be empty")
+    def delete_chunk(self, user_id: str, firebase_ids: List[str]) -> int:
+        """
+        Deletes every chunk of the given bookmarks and returns how many were deleted. Keep `firebase_ids`
+        at most `delete_vectorstore_chunk_size` long, the filter grows with it.
+        """
+        if not firebase_ids:
+            return 0
+        with timed('delete', self.vector_store.name):
+            return self.vector_store.delete(ChunkFilter(user_id, firebase_ids=firebase_ids))
 
-        return where_filter
+    @classmethod
+    def __chunk_ids(cls, firebase_ids: List[str]) -> List[List[str]]:
+        size = config.delete_vectorstore_chunk_size
+        return [firebase_ids[start:start + size] for start in range(0, len(firebase_ids), size)]
 
     @classmethod
-    def __get_where_filter(cls, user_id: str, selected_context: List[str] | None) -> Dict[str, Any]:
-        where_filter_user = {
-            "path": ["user_id"],
-            "operator": "Equal",
-            "valueString": user_id
-        }
-
-        if selected_context:
-            where_filter = {
-                "operator": "And",
-                "operands": [
-                    where_filter_user,
-                    cls.__build_id_in_filter(selected_context)
-                ]
-            }
+    def __to_bookmarks(cls, hits: List[ChunkHit], with_vectors: bool = False) -> Tuple[List[VectorStoreBookmark], np.ndarray | None]:
+        bookmarks = [VectorStoreBookmark(page_content=hit.properties.get('content'), metadata={
+            'title': hit.properties.get('title'),
+            'url': hit.properties.get('url'),
+            'id': hit.properties.get('firebase_id'),
+            'similarity_score': hit.score,
+        }, token_count=hit.properties.get('token_count')) for hit in hits]
+        vectors = np.asarray([hit.vector for hit in hits], dtype=np.float32) if with_vectors else None
+        return bookmarks, vectors
+
+    def __query(self, message: str, user_id: str, use_hybrid: bool, certainty: float, alpha: float, limit: int | None,
+                selected_context: List[str] | None, folders: List[str] | None, with_vectors: bool = False) -> Tuple[List[VectorStoreBookmark], np.ndarray | None]:
+        chunk_filter = ChunkFilter(user_id, firebase_ids=selected_context, folders=folders)
+        # includes vectorizing the query text, which the store does as part of the search
+        if use_hybrid:
+            with timed('hybrid_search', self.vector_store.name):
+                hits = self.vector_store.hybrid_search(message, chunk_filter, limit=limit, alpha=alpha, with_vectors=with_vectors)
         else:
-            where_filter = where_filter_user
-
-        return where_filter
-
-    def __hybrid_search(self, message: str, user_id: str, limit: int, alpha: float) -> List[VectorStoreBookmark]:
-        where_filter = self.__get_where_filter(user_id, None)
-        res = self.client.query.get(
-            "Document", ["title", "url", "content", "firebase_id"]
-        ).with_where(
-            where_filter
-        ).with_hybrid(
-            query=message,
-            alpha=alpha
-        ).with_limit(
-            limit
-        ).with_additional(
-            ['score']
-        ).do()
-
-        docs: List[Dict[str, Any]] = res['data']['Get']['Document']
-        bookmarks = [VectorStoreBookmark(page_content=d.pop('content'), metadata={
-            'title': d.get('title'),
-            'url': d.get('url'),
-            'id': d.get('firebase_id'),
-            'similarity_score': d.get('_additional', {}).get('score'),
-        }) for d in docs]
-        return bookmarks
+            with timed('vector_search', self.vector_store.name):
+                hits = self.vector_store.vector_search(message, chunk_filter, limit=limit, certainty=certainty, with_vectors=with_vectors)
+        return self.__to_bookmarks(hits, with_vectors)
 
+    def __hybrid_search(self, message: str, user_id: str, limit: int, alpha: float, folders: List[str] | None) -> List[VectorStoreBookmark]:
+        bookmarks, _ = self.__query(message, user_id, True, 0, alpha, limit, None, folders)
+        return bookmarks
 
-    def __get_relevant_documents(self, message: str, user_id: str, selected_context: List[str] | None, certainty: float) -> List[VectorStoreBookmark]:
-        where_filter = self.__get_where_filter(user_id, selected_context)
-
-        res = self.client.query.get(
-            "Document", ["title", "url", "content", "firebase_id"]
-        ).with_where(
-            where_filter
-        ).with_near_text({
-            "concepts": [message],
-            "certainty": certainty,
-        }).with_additional(
-            ['certainty']
-        ).do()
-        if res.get('errors', None):
-            raise Exception(res['errors'])
-        docs: List[Dict[str, Any]] = res['data']['Get']['Document']
-
-        bookmarks = [VectorStoreBookmark(page_content=d.pop('content'), metadata={
-            'title': d.get('title'),
-            'url': d.get('url'),
-            'id': d.get('firebase_id'),
-            'similarity_score': d.get('_additional', {}).get('certainty'),
-        }) for d in docs]
+    def __get_relevant_documents(self, message: str, user_id: str, selected_context: List[str] | None, certainty: float, folders: List[str] | None) -> List[VectorStoreBookmark]:
+        bookmarks, _ = self.__query(message, user_id, False, certainty, 0, None, selected_context, folders)
         return bookmarks
 
+    def __search_bookmarks(self, query: str, user_id: str, use_hybrid: bool, certainty: float, limit: int, alpha: float,
+                           folders: List[str] | None, mmr_lambda: float) -> List[VectorStoreBookmark]:
+        """
+        Returns up to `limit` distinct bookmarks, each represented by its most relevant chunk and ordered by
+        MMR so near-duplicate bookmarks don't crowd out the rest. Chunks are over-fetched, and fetched again with
+        a doubled limit while too few distinct bookmarks came back and more chunks may exist.
+        """
+        fetch_limit = min(limit * config.search_overfetch, config.search_max_chunks)
+        while True:
+            chunks, vectors = self.__query(query, user_id, use_hybrid, certainty, alpha, fetch_limit, None, folders, with_vectors=True)
+            relevance = normalize_relevance([float(c.metadata.similarity_score or 0) for c in chunks])
+            best = best_per_group([c.metadata.id for c in chunks], relevance)
+            if len(best) >= limit or len(chunks) < fetch_limit or fetch_limit >= config.search_max_chunks:
+                break
+            fetch_limit = min(fetch_limit * 2, config.search_max_chunks)
+
+        if not len(best):
+            return []
+        with timed('search.mmr'):
+            selected = mmr(relevance[best], vectors[best], limit, mmr_lambda)
+        return [chunks[best[i]] for i in selected]
+
+    def __get_diverse_documents(self, message: str, user_id: str, selected_context: List[str] | None, certainty: float,
+                                folders: List[str] | None) -> List[VectorStoreBookmark]:
+        # MMR order, so the token budget is spent on distinct chunks instead of near-duplicates of the best one
+        chunks, vectors = self.__query(message, user_id, False, certainty, 0, config.context_max_chunks, selected_context, folders, with_vectors=True)
+        if not chunks:
+            return []
+        relevance = normalize_relevance([float(c.metadata.similarity_score or 0) for c in chunks])
+        with timed('context.mmr'):
+            order = mmr(relevance, vectors, len(chunks), config.context_mmr_lambda,
+                        groups=[c.metadata.id for c in chunks], max_per_group=config.context_max_chunks_per_bookmark)
+        return [chunks[i] for i in order]
+
     @classmethod
     def __limit_context(cls, context: List[VectorStoreBookmark], token_limit: int) -> List[VectorStoreBookmark]:
         ctx = []
         used_tokens = 0
-        encoding = tiktoken.encoding_for_model(config.fast_llm_model)
         for doc in context:
-            tokens = encoding.encode(doc.page_content)
-            if used_tokens + len(tokens) > token_limit:
-                break
+            # chunks stored before token_count existed are counted on the fly
+            tokens = doc.token_count if doc.token_count is not None else count_tokens(doc.page_content)
+            if used_tokens + tokens > token_limit:
+                continue  # a smaller, less relevant chunk may still fit
             ctx.append(doc)
-            used_tokens += len(tokens)
+            used_tokens += tokens
 
         return ctx
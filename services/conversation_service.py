@@ -1,22 +1,41 @@
-import asyncio
+import time
+from contextlib import aclosing
+from dataclasses import dataclass
 from datetime import datetime
 from typing import AsyncIterator, List
 from langchain import PromptTemplate
-from langchain.callbacks import AsyncIteratorCallbackHandler
-from langchain.callbacks.manager import AsyncCallbackManager
-from langchain.chat_models import ChatOpenAI
 from langchain.schema import BaseMessage, SystemMessage, Document, HumanMessage
 
 from config import Config
 from models.bookmark import VectorStoreBookmark
 from models.chat import ChatServiceMessage
+from services.answer_cache_service import answer_cache
+from services.chat_history_service import ChatHistoryService
 from services.context_service import ContextService
-from utils.db import firebase_app as db
+from services.llm_service import llm_service
+from utils import metrics
+from utils.db import get_async_firestore
+from utils.tokens import count_tokens
+from utils.write_behind import firestore_write_buffer
 
 
 config = Config()
 
 
+@dataclass
+class PreparedChat:
+    message: str
+    context: List[VectorStoreBookmark]
+    cache_key: str
+    cached_answer: str | None
+
+    def prompt_tokens(self) -> int:
+        # chunks stored before token_count existed are counted on the fly
+        return count_tokens(self.message) + sum(
+            doc.token_count if doc.token_count is not None else count_tokens(doc.page_content) for doc in self.context
+        )
+
+
 class ConversationService:
     __system_prompt = """
        You are a helpful, creative, clever, and very friendly assistant. The user will be giving you a PROMPT, 
@@ -35,6 +54,8 @@ class ConversationService:
         ASSISTANT RESPONSE:
     """
 
+    __replay_chunk_size = 16
+
     def __init__(self, context_service: ContextService, uid: str):
         self.context_service = context_service
         self.uid = uid
@@ -54,60 +75,93 @@ class ConversationService:
     def _get_message_generator(self,
                                context: List[VectorStoreBookmark],
                                user_message: BaseMessage) -> AsyncIterator[str]:
-        msg_iterator = AsyncIteratorCallbackHandler()
-        llm = ChatOpenAI(
-            verbose=True,
-            callback_manager=AsyncCallbackManager([msg_iterator]),
-            streaming=True,
-            model_name=config.fast_llm_model,
-        )
-        msgs: List[List[BaseMessage]] = [[
+        msgs: List[BaseMessage] = [
             SystemMessage(content=self._get_system_prompt()),
             HumanMessage(content=self._get_user_prompt(
                 user_message.content, self._format_context(context),
             )),
-        ]]
-
-        asyncio.ensure_future(llm.agenerate(messages=msgs))
+        ]
 
-        return msg_iterator.aiter()
+        return llm_service.stream(msgs)
 
     def store_conversation(self, question: str, context: List[VectorStoreBookmark], answer: str):
-        # store the conversation in firebase
-        collection_ref = db.collection('users').document(self.uid).collection('conversations')
-        collection_ref.add({
+        # store the conversation in firebase, committed by the write-behind buffer
+        chat_history_service = ChatHistoryService(self.uid)
+        doc_ref = chat_history_service.get_user_document().collection('conversations').document()
+        timestamp = int(datetime.now().timestamp())
+        firestore_write_buffer.set(doc_ref, {
             'question': question,
             'context_urls': list({doc.metadata.url for doc in context}),
             'answer': answer,
-            'timestamp': int(datetime.now().timestamp()),
+            'timestamp': timestamp,
+        })
+        # the index is only backfilled once per user, later conversations have to be added to it here
+        firestore_write_buffer.set(chat_history_service.get_conversation_index().document(doc_ref.id), {
+            'title': question,
+            'timestamp': timestamp,
         })
+        ChatHistoryService.invalidate_conversations(self.uid)
 
-    def create_new_conversation(self) -> str:
-        collection_ref = db.collection('users').document(self.uid).collection('conversations')
-        update_time, doc_ref = collection_ref.add({
+    @metrics.timed_async('create_conversation', backend='firestore')
+    async def create_new_conversation(self) -> str:
+        chat_history_service = ChatHistoryService(self.uid)
+        doc_ref = chat_history_service.get_user_document().collection('conversations').document()
+        summary = {
             'timestamp': int(datetime.now().timestamp()),
             'title': None
-        })
+        }
+        batch = get_async_firestore().batch()
+        batch.set(doc_ref, summary)
+        batch.set(chat_history_service.get_conversation_index().document(doc_ref.id), summary)
+        await batch.commit()
+        ChatHistoryService.invalidate_conversations(self.uid)
+        ChatHistoryService.remember_conversation(self.uid, doc_ref.id, has_title=False)
         return doc_ref.id
 
-    async def chat(self, message: str, selected_context: List[str] | None):
-        context = self.context_service.get_context(message=message, user_id=self.uid, selected_context=selected_context)
-        full_response = ''
+    async def prepare(self, message: str, selected_context: List[str] | None, folders: List[str] | None = None) -> PreparedChat:
+        """
+        Retrieves the context and looks up the cached answer, before the response starts streaming.
+        """
+        with metrics.timed('chat.context'):
+            context = await self.context_service.aget_context(message=message, user_id=self.uid, selected_context=selected_context, folders=folders)
+        cache_key = answer_cache.key(config.fast_llm_model, message, context)
+        return PreparedChat(message=message, context=context, cache_key=cache_key, cached_answer=answer_cache.get(cache_key))
+
+    async def chat(self, prepared: PreparedChat):
+        message, context, cache_key, cached_answer = prepared.message, prepared.context, prepared.cache_key, prepared.cached_answer
+        if cached_answer is not None:
+            # replay through the same stream, so clients can't tell a cached answer apart
+            for start in range(0, len(cached_answer), self.__replay_chunk_size):
+                yield ChatServiceMessage.construct(
+                    msg=cached_answer[start:start + self.__replay_chunk_size], relevant_documents=context, done=False
+                )
+            yield ChatServiceMessage(msg=cached_answer, relevant_documents=context, done=True)
+            return
+
+        full_response: List[str] = []
 
         token_generator = self._get_message_generator(
             context=context,
             user_message=HumanMessage(content=message),
         )
 
-        # emit content + save it to full_response
-        async for chunk in token_generator:
-            # content = chunk['choices'][0]['delta'].get('content', '')  # extract the message
-            content = chunk
-            full_response += content
-            if content == '':  # if the message is empty - ignore it
-                continue
-
-            yield ChatServiceMessage(msg=content, relevant_documents=context, done=False)
-
-        yield ChatServiceMessage(msg=full_response, relevant_documents=context, done=True)
-
+        start = time.perf_counter() if metrics.enabled else None
+        # emit content + save it to full_response, closing the generator cancels the LLM request
+        async with aclosing(token_generator):
+            async for chunk in token_generator:
+                # content = chunk['choices'][0]['delta'].get('content', '')  # extract the message
+                content = chunk
+                if content == '':  # if the message is empty - ignore it
+                    continue
+                if start is not None and not full_response:
+                    metrics.record('time_to_first_token', time.perf_counter() - start, backend='openai')
+                full_response.append(content)
+
+                # construct skips re-validating the whole context for every token
+                yield ChatServiceMessage.construct(msg=content, relevant_documents=context, done=False)
+
+        if start is not None:
+            metrics.record('chat_completion', time.perf_counter() - start, backend='openai')
+        answer = ''.join(full_response)
+        answer_cache.set(cache_key, answer, context)
+        yield ChatServiceMessage(msg=answer, relevant_documents=context, done=True)
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import Dict, List
+
+from cachetools import TTLCache
+
+from config import Config
+from models.deletion import DeleteJob, DeleteJobStatus
+from services.answer_cache_service import answer_cache
+from services.bookmark_store_service import AsyncBookmarkStoreService
+from services.context_service import ContextService, get_shared_context_service
+
+log = logging.getLogger(__name__)
+config = Config()
+
+
+class DeletionService:
+    """
+    Deletes bookmarks as background jobs. Chunks are removed from the vector store before the Firestore
+    documents, so a bookmark that is gone from Firestore never leaves orphaned chunks behind. Every finished
+    chunk of work is recorded on the job, failed steps are retried with backoff and a failed job can be resumed.
+    """
+
+    def __init__(self,
+                 context_service: ContextService | None = None,
+                 bookmark_service: AsyncBookmarkStoreService | None = None):
+        self._context_service = context_service
+        self.bookmark_service = bookmark_service or AsyncBookmarkStoreService()
+        self.jobs: TTLCache[str, DeleteJob] = TTLCache(maxsize=10000, ttl=config.delete_job_ttl)
+        self._finished: Dict[str, asyncio.Event] = {}
+        self._job_queue: asyncio.Queue[DeleteJob] | None = None
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def context_service(self) -> ContextService:
+        if self._context_service is None:
+            self._context_service = get_shared_context_service()
+        return self._context_service
+
+    def submit(self, user_id: str, ids: List[str], folders_to_delete: List[str] | None = None) -> DeleteJob:
+        ids = list(dict.fromkeys(ids))
+        job = DeleteJob(
+            id=uuid.uuid4().hex,
+            user_id=user_id,
+            total_bookmarks=len(ids),
+            pending_vectorstore_ids=ids,
+            pending_firestore_ids=list(ids),
+            folders_to_delete=folders_to_delete or [],
+            created_at=int(time.time()),
+        )
+        self.jobs[job.id] = job
+        self.__enqueue(job)
+        return job
+
+    def resume(self, job_id: str) -> DeleteJob | None:
+        job = self.jobs.get(job_id)
+        if job is None or job.status != DeleteJobStatus.failed:
+            return job
+        job.status = DeleteJobStatus.queued
+        job.attempts = 0
+        job.error = None
+        job.finished_at = None
+        self.__enqueue(job)
+        return job
+
+    def get_job(self, job_id: str) -> DeleteJob | None:
+        return self.jobs.get(job_id)
+
+    async def wait(self, job: DeleteJob):
+        finished = self._finished.get(job.id)
+        if finished is not None:
+            await finished.wait()
+
+    async def stop(self):
+        if not self._tasks:
+            return
+        await self._job_queue.join()  # half deleted bookmarks are worse than a slower shutdown
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def __enqueue(self, job: DeleteJob):
+        if not self._tasks:
+            self._job_queue = asyncio.Queue()
+            self._tasks = [asyncio.create_task(self.__job_worker()) for _ in range(config.delete_workers)]
+        self._finished[job.id] = asyncio.Event()
+        self._job_queue.put_nowait(job)
+
+    async def __job_worker(self):
+        while True:
+            job = await self._job_queue.get()
+            try:
+                await self.__run_job(job)
+            except Exception as e:
+                log.exception(f'Delete job {job.id} crashed: {e}')
+            finally:
+                self._finished.pop(job.id).set()
+                self._job_queue.task_done()
+
+    async def __run_job(self, job: DeleteJob):
+        job.status = DeleteJobStatus.running
+        while True:
+            job.attempts += 1
+            try:
+                await self.__delete_chunks(job)
+                await self.__delete_bookmarks(job)
+                if job.folders_to_delete:
+                    await self.bookmark_service.batch_delete(job.user_id, [], job.folders_to_delete)
+                    job.folders_to_delete = []
+            except Exception as e:
+                log.error(f'Delete job {job.id} attempt {job.attempts} failed: {e}')
+                job.error = str(e)
+                if job.attempts >= config.delete_max_attempts:
+                    job.status = DeleteJobStatus.failed
+                    break
+                await asyncio.sleep(config.delete_retry_delay * 2 ** (job.attempts - 1))
+            else:
+                job.status = DeleteJobStatus.done
+                job.error = None
+                break
+        job.finished_at = int(time.time())
+
+    async def __delete_chunks(self, job: DeleteJob):
+        size = config.delete_vectorstore_chunk_size
+        chunks = [job.pending_vectorstore_ids[start:start + size]
+                  for start in range(0, len(job.pending_vectorstore_ids), size)]
+
+        async def delete(ids: List[str]):
+            deleted = await self.context_service.abatch_delete(job.user_id, ids)
+            job.deleted_chunks += deleted
+            answer_cache.invalidate_bookmarks(ids)
+            return ids
+
+        await self.__run_steps(job, 'pending_vectorstore_ids', [delete(ids) for ids in chunks])
+
+    async def __delete_bookmarks(self, job: DeleteJob):
+        # only bookmarks whose chunks are gone may be removed from Firestore
+        pending_chunks = set(job.pending_vectorstore_ids)
+        ids = [_id for _id in job.pending_firestore_ids if _id not in pending_chunks]
+        size = config.delete_firestore_batch_size
+        semaphore = asyncio.Semaphore(config.delete_firestore_concurrency)
+
+        async def delete(batch_ids: List[str]):
+            async with semaphore:
+                await self.bookmark_service.batch_delete(job.user_id, batch_ids)
+            return batch_ids
+
+        await self.__run_steps(job, 'pending_firestore_ids',
+                               [delete(ids[start:start + size]) for start in range(0, len(ids), size)])
+
+    @classmethod
+    async def __run_steps(cls, job: DeleteJob, pending_field: str, steps):
+        """
+        Runs all steps even if some fail, drops the ids of the successful ones from `pending_field`
+        and raises the first error afterwards.
+        """
+        results = await asyncio.gather(*steps, return_exceptions=True)
+        done = {_id for result in results if not isinstance(result, BaseException) for _id in result}
+        setattr(job, pending_field, [_id for _id in getattr(job, pending_field) if _id not in done])
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            raise errors[0]
+
+
+deletion_service = DeletionService()
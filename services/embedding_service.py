@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import math
+from typing import List
+
+import numpy as np
+import openai
+
+from config import Config
+from utils.admission import embedding_admission
+from utils.embedding_cache import EmbeddingCache, embedding_key
+
+log = logging.getLogger(__name__)
+config = Config()
+
+
+class EmbeddingService:
+    """
+    Embeds chunk text with the same OpenAI model Weaviate's text2vec-openai module uses, so objects
+    can be written with a precomputed vector. Identical chunks, across users and re-bookmarks, are
+    only ever embedded once.
+    """
+
+    def __init__(self, cache: EmbeddingCache | None = None, model: str | None = None):
+        self._cache = cache
+        self.model = model or config.embedding_model
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        self.embedded_tokens = 0
+
+    @property
+    def cache(self) -> EmbeddingCache:
+        if self._cache is None:
+            self._cache = EmbeddingCache(config.embedding_cache_path, config.embedding_cache_memory_size)
+        return self._cache
+
+    async def embed_chunks(self, texts: List[str], token_counts: List[int]) -> List[List[float] | None]:
+        """
+        Returns a vector for every text. Texts that could not be embedded get None and are left
+        for Weaviate to vectorize.
+        """
+        loop = asyncio.get_running_loop()
+        keys = [embedding_key(text, self.model) for text in texts]
+        vectors = await loop.run_in_executor(None, self.cache.get_many, keys)
+
+        missing = {}  # key -> index of the first text with that key
+        for i, key in enumerate(keys):
+            if key in vectors or key in missing:
+                self.hits += 1
+                self.saved_tokens += token_counts[i]
+            else:
+                missing[key] = i
+
+        self.misses += len(missing)
+        if missing:
+            try:
+                # ingestion runs in the background, so it waits for capacity instead of being rejected
+                await embedding_admission.acquire(sum(token_counts[i] for i in missing.values()), max_wait=math.inf)
+                response = await openai.Embedding.acreate(
+                    model=self.model,
+                    input=[texts[i] for i in missing.values()],
+                )
+                new_vectors = {
+                    key: np.asarray(item['embedding'], dtype=np.float32)
+                    for key, item in zip(missing.keys(), sorted(response['data'], key=lambda d: d['index']))
+                }
+                self.embedded_tokens += response['usage']['total_tokens']
+                await loop.run_in_executor(None, self.cache.set_many, new_vectors)
+                vectors.update(new_vectors)
+            except Exception as e:
+                log.warning(f'Could not embed {len(missing)} chunks, leaving them to the vectorizer: {e}')
+
+        return [vectors[key].tolist() if key in vectors else None for key in keys]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'saved_tokens': self.saved_tokens,
+            'embedded_tokens': self.embedded_tokens,
+        }
+
+
+embedding_service = EmbeddingService()
@@ -0,0 +1,275 @@
+import asyncio
+import hashlib
+import logging
+import time
+import uuid
+import weakref
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Set, Tuple
+
+from cachetools import TTLCache
+
+from config import Config
+from models.extension import ExtensionDocument, ExtensionPDFMetadata
+from models.ingest import IngestJob, IngestJobStatus
+from services.bookmark_store_service import AsyncBookmarkStoreService
+from services.context_service import ContextService, get_shared_context_service
+from services.embedding_service import EmbeddingService, embedding_service as default_embedding_service
+from utils.text_chunker import Chunk
+
+log = logging.getLogger(__name__)
+config = Config()
+
+ChunkLoader = Callable[[], Awaitable[List[Chunk]]]
+
+_chunk_namespace = uuid.UUID('c5e34acc-87c7-4cc5-a852-3f8239cf3db6')
+
+
+def get_chunk_id(user_id: str, bookmark_id: str, url: str, content: str) -> str:
+    """
+    Object id of a chunk, the same for the same content of a bookmark on every save. The bookmark is part of
+    it, a URL bookmarked twice (bulk imports) must not share the objects of the other bookmark.
+    """
+    content_hash = hashlib.sha256(content.encode()).hexdigest()
+    return str(uuid.uuid5(_chunk_namespace, f'{user_id}\0{bookmark_id}\0{url}\0{content_hash}'))
+
+
+@dataclass
+class _PendingChunk:
+    job: IngestJob | None
+    id: str
+    properties: Dict[str, Any]
+    result: asyncio.Future
+
+
+class IngestService:
+    """
+    In-process ingestion queue. Job workers chunk documents and create the Firestore bookmark, batchers
+    coalesce the chunks of all running jobs into Weaviate batches of up to `ingest_batch_size`.
+    Re-saving a bookmarked URL reuses its bookmark and only writes the chunks that changed.
+    """
+
+    def __init__(self,
+                 context_service: ContextService | None = None,
+                 bookmark_service: AsyncBookmarkStoreService | None = None,
+                 embedding_service: EmbeddingService | None = None):
+        self._context_service = context_service
+        self.bookmark_service = bookmark_service or AsyncBookmarkStoreService()
+        self.embedding_service = embedding_service or default_embedding_service
+        self.jobs: TTLCache[str, IngestJob] = TTLCache(maxsize=10000, ttl=config.ingest_job_ttl)
+        # job ids by (user, Idempotency-Key), a repeated submit gets the job of the first one
+        self.idempotent_jobs: TTLCache[Tuple[str, str], str] = TTLCache(maxsize=10000, ttl=config.ingest_job_ttl)
+        # jobs for the same URL of a user run one after the other, both would create a bookmark otherwise
+        self._url_locks: weakref.WeakValueDictionary[Tuple[str, str], asyncio.Lock] = weakref.WeakValueDictionary()
+        self._job_queue: asyncio.Queue[Tuple[IngestJob, ExtensionDocument | ExtensionPDFMetadata, ChunkLoader]] | None = None
+        self._chunk_queue: asyncio.Queue[_PendingChunk] | None = None
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def context_service(self) -> ContextService:
+        if self._context_service is None:
+            self._context_service = get_shared_context_service()
+        return self._context_service
+
+    def submit(self,
+               user_id: str,
+               document: ExtensionDocument | ExtensionPDFMetadata,
+               load_chunks: ChunkLoader,
+               idempotency_key: str | None = None) -> IngestJob:
+        if job := self.get_idempotent_job(user_id, idempotency_key):
+            return job
+        self.__ensure_started()
+        job = IngestJob(id=uuid.uuid4().hex, user_id=user_id, url=document.url, created_at=int(time.time()))
+        self.jobs[job.id] = job
+        if idempotency_key:
+            self.idempotent_jobs[(user_id, idempotency_key)] = job.id
+        self._job_queue.put_nowait((job, document, load_chunks))
+        return job
+
+    def get_job(self, job_id: str) -> IngestJob | None:
+        return self.jobs.get(job_id)
+
+    def get_idempotent_job(self, user_id: str, idempotency_key: str | None) -> IngestJob | None:
+        if not idempotency_key:
+            return None
+        job_id = self.idempotent_jobs.get((user_id, idempotency_key))
+        return self.jobs.get(job_id) if job_id else None
+
+    async def stop(self):
+        if not self._tasks:
+            return
+        await self._job_queue.join()  # finish every accepted job before shutting down
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def __ensure_started(self):
+        if self._tasks:
+            return
+        self._job_queue = asyncio.Queue()
+        # bounded so that large documents wait for the batcher instead of piling up in memory
+        self._chunk_queue = asyncio.Queue(maxsize=config.ingest_batch_size * 2)
+        self._tasks = [asyncio.create_task(self.__job_worker()) for _ in range(config.ingest_workers)]
+        self._tasks += [asyncio.create_task(self.__batcher()) for _ in range(config.ingest_batch_writers)]
+
+    async def __job_worker(self):
+        while True:
+            job, document, load_chunks = await self._job_queue.get()
+            try:
+                await self.__run_job(job, document, load_chunks)
+            except Exception as e:
+                log.exception(f'Ingest job {job.id} crashed: {e}')
+            finally:
+                self._job_queue.task_done()
+
+    async def __run_job(self, job: IngestJob, document: ExtensionDocument | ExtensionPDFMetadata, load_chunks: ChunkLoader):
+        job.status = IngestJobStatus.running
+        try:
+            chunks = await load_chunks()
+            log.info(f'created {len(chunks)} chunks')
+            job.total_chunks = len(chunks)
+
+            lock_key = (job.user_id, document.url)
+            lock = self._url_locks.get(lock_key)
+            if lock is None:
+                lock = self._url_locks[lock_key] = asyncio.Lock()
+            async with lock:
+                bookmarks = await self.bookmark_service.get_bookmarks_by_url(job.user_id, document.url)
+                if bookmarks:
+                    await self.__reindex(job, document, chunks, bookmarks)
+                else:
+                    bookmark_ref = await self.bookmark_service.add_bookmark(job.user_id, document)
+                    job.bookmark_id = bookmark_ref.id
+                    await self.store_chunks(job.user_id, document, bookmark_ref.id, chunks, job)
+        except Exception as e:
+            log.error(e)
+            job.status = IngestJobStatus.failed
+            job.error = str(e)
+            if not job.reused_bookmark:
+                await self.__rollback(job)
+        else:
+            job.status = IngestJobStatus.done
+        finally:
+            job.finished_at = int(time.time())
+
+    async def __reindex(self,
+                        job: IngestJob,
+                        document: ExtensionDocument | ExtensionPDFMetadata,
+                        chunks: List[Chunk],
+                        bookmarks: List[Dict[str, Any]]):
+        """
+        Updates the existing bookmark of the URL in place. Chunks whose id is stored already are skipped,
+        chunks that are not part of the document anymore are deleted once the new ones are written.
+        Bookmarks of earlier saves of the same URL are merged into it.
+        """
+        bookmark, *duplicates = sorted(bookmarks, key=lambda b: b['id'])
+        job.bookmark_id = bookmark['id']
+        job.reused_bookmark = True
+
+        stored_ids = set(await self.context_service.alist_chunk_ids(job.user_id, bookmark['id']))
+        # title and folder are properties of every chunk, a change has to rewrite all of them
+        metadata_changed = bookmark.get('title') != document.title or bookmark.get('folder') != document.folder
+        await self.bookmark_service.update_bookmark(job.user_id, bookmark['id'], document)
+
+        chunk_ids = await self.store_chunks(
+            job.user_id, document, bookmark['id'], chunks, job, skip_ids=set() if metadata_changed else stored_ids
+        )
+        job.deleted_chunks += await self.context_service.adelete_chunks_by_id(job.user_id, list(stored_ids - chunk_ids))
+        if duplicates:
+            duplicate_ids = [b['id'] for b in duplicates]
+            job.deleted_chunks += await self.context_service.abatch_delete(job.user_id, duplicate_ids)
+            await self.bookmark_service.batch_delete(job.user_id, duplicate_ids)
+        log.info(f'Re-indexed {document.url}: {job.stored_chunks} chunks written, {job.skipped_chunks} '
+                 f'({job.skipped_tokens} tokens) skipped, {job.deleted_chunks} deleted')
+
+    async def store_chunks(self,
+                           user_id: str,
+                           document: ExtensionDocument | ExtensionPDFMetadata,
+                           bookmark_id: str,
+                           chunks: List[Chunk],
+                           job: IngestJob | None = None,
+                           skip_ids: Set[str] | None = None) -> Set[str]:
+        """
+        Hands the chunks of one bookmark to the batchers and waits until all of them are written.
+        Chunks in `skip_ids` and repeated chunks are not written again. Returns the ids of all chunks of the
+        document and raises the first error if any chunk could not be stored.
+        """
+        self.__ensure_started()
+        loop = asyncio.get_running_loop()
+        chunk_ids = set()
+        results = []
+        for chunk, token_count in chunks:
+            chunk_id = get_chunk_id(user_id, bookmark_id, document.url, chunk)
+            if chunk_id in chunk_ids or (skip_ids and chunk_id in skip_ids):
+                chunk_ids.add(chunk_id)
+                if job is not None:
+                    job.skipped_chunks += 1
+                    job.skipped_tokens += token_count
+                continue
+            chunk_ids.add(chunk_id)
+            pending_chunk = _PendingChunk(job=job, id=chunk_id, result=loop.create_future(), properties={
+                "title": document.title,
+                "content": chunk,
+                "user_id": user_id,
+                "url": document.url,
+                "firebase_id": bookmark_id,  # all chunks have same firebase id
+                "folder": document.folder,
+                "token_count": token_count,
+            })
+            await self._chunk_queue.put(pending_chunk)
+            results.append(pending_chunk.result)
+
+        errors = [e for e in await asyncio.gather(*results, return_exceptions=True) if e is not None]
+        if errors:
+            raise errors[0]
+        return chunk_ids
+
+    async def rollback_bookmark(self, user_id: str, bookmark_id: str):
+        await self.rollback_bookmarks(user_id, [bookmark_id])
+
+    async def rollback_bookmarks(self, user_id: str, bookmark_ids: List[str]):
+        await self.context_service.abatch_delete(user_id, bookmark_ids)
+        await self.bookmark_service.batch_delete(user_id, bookmark_ids)
+
+    async def __rollback(self, job: IngestJob):
+        if not job.bookmark_id:
+            return
+        try:
+            await self.rollback_bookmark(job.user_id, job.bookmark_id)
+        except Exception as e:
+            log.error(f'Could not roll back ingest job {job.id}: {e}')
+
+    async def __batcher(self):
+        while True:
+            batch = [await self._chunk_queue.get()]
+            if self._chunk_queue.qsize() < config.ingest_batch_size - 1:
+                # give concurrent jobs a moment to contribute to the same batch
+                await asyncio.sleep(config.ingest_batch_linger)
+            while len(batch) < config.ingest_batch_size and not self._chunk_queue.empty():
+                batch.append(self._chunk_queue.get_nowait())
+            await self.__write_batch(batch)
+
+    async def __write_batch(self, batch: List[_PendingChunk]):
+        try:
+            vectors = await self.embedding_service.embed_chunks(
+                [c.properties['content'] for c in batch],
+                [c.properties['token_count'] for c in batch],
+            )
+            errors = await self.context_service.ainsert_objects([c.properties for c in batch], vectors, [c.id for c in batch])
+        except Exception as e:
+            errors = [str(e)] * len(batch)
+        errors += ['no result returned for object'] * (len(batch) - len(errors))
+
+        for pending_chunk, error in zip(batch, errors):
+            if pending_chunk.result.done():
+                continue
+            if error:
+                pending_chunk.result.set_exception(Exception(error))
+            else:
+                if pending_chunk.job is not None:
+                    pending_chunk.job.stored_chunks += 1
+                pending_chunk.result.set_result(None)
+
+
+ingest_service = IngestService()
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+from typing import AsyncIterator, List
+
+import aiohttp
+import openai
+from langchain.callbacks import AsyncIteratorCallbackHandler
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import BaseMessage
+
+from config import Config
+
+log = logging.getLogger(__name__)
+config = Config()
+
+
+class LLMService:
+    """
+    Owns the chat model and a pooled aiohttp session shared by every request. Each generation runs as a
+    tracked task which is cancelled as soon as its consumer goes away or the request deadline passes.
+    """
+
+    def __init__(self):
+        self._llm: ChatOpenAI | None = None
+        self._session: aiohttp.ClientSession | None = None
+        self.completed_generations = 0
+        self.cancelled_generations = 0
+        self.timed_out_generations = 0
+        self.tokens_before_cancel = 0  # tokens paid for answers nobody read to the end
+
+    @property
+    def llm(self) -> ChatOpenAI:
+        if self._llm is None:
+            self._llm = ChatOpenAI(
+                streaming=True,
+                model_name=config.fast_llm_model,
+                request_timeout=config.llm_request_timeout,
+            )
+        return self._llm
+
+    def __get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=config.llm_max_connections, keepalive_timeout=60),
+            )
+        return self._session
+
+    async def stream(self, messages: List[BaseMessage], timeout: float | None = None) -> AsyncIterator[str]:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or config.llm_request_timeout)
+        handler = AsyncIteratorCallbackHandler()
+
+        # the generation task copies the current context, so it picks up the shared session
+        openai.aiosession.set(self.__get_session())
+        generation = asyncio.create_task(self.llm.agenerate(messages=[messages], callbacks=[handler]))
+        tokens = 0
+        next_token: asyncio.Future | None = None
+        timed_out = False
+        try:
+            while True:
+                next_token = asyncio.ensure_future(handler.queue.get())
+                done, _ = await asyncio.wait(
+                    {next_token, generation},
+                    timeout=max(0.0, deadline - loop.time()),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if next_token in done:
+                    tokens += 1
+                    yield next_token.result()
+                    continue
+
+                next_token.cancel()
+                if generation not in done:
+                    timed_out = True
+                    raise asyncio.TimeoutError(f'LLM generation exceeded {timeout or config.llm_request_timeout}s')
+
+                while not handler.queue.empty():
+                    tokens += 1
+                    yield handler.queue.get_nowait()
+                generation.result()  # surface generation errors
+                self.completed_generations += 1
+                return
+        finally:
+            if next_token is not None:
+                next_token.cancel()
+            if not generation.done():
+                generation.cancel()
+                if timed_out:
+                    self.timed_out_generations += 1
+                else:
+                    self.cancelled_generations += 1
+                self.tokens_before_cancel += tokens
+                log.info(f'Cancelled LLM generation after {tokens} tokens')
+            await asyncio.gather(generation, return_exceptions=True)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def stats(self):
+        return {
+            'completed_generations': self.completed_generations,
+            'cancelled_generations': self.cancelled_generations,
+            'timed_out_generations': self.timed_out_generations,
+            'tokens_before_cancel': self.tokens_before_cancel,
+        }
+
+
+llm_service = LLMService()
@@ -0,0 +1,3 @@
+from services.vector_stores.base import ChunkFilter, ChunkHit, VectorStore
+from services.vector_stores.local_store import LocalVectorStore
+from services.vector_stores.weaviate_store import WeaviateVectorStore, get_tenant_name
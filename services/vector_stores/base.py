@@ -0,0 +1,84 @@
+import abc
+from dataclasses import dataclass, field
+from typing import Any, Dict, List
+
+import numpy as np
+
+# objects returned by a search without an explicit limit, mirrors Weaviate's QUERY_DEFAULTS_LIMIT
+DEFAULT_LIMIT = 25
+
+# chunk properties every backend stores and returns
+CHUNK_PROPERTIES = ["title", "url", "content", "firebase_id", "user_id", "folder", "token_count"]
+
+
+@dataclass
+class ChunkFilter:
+    user_id: str
+    firebase_ids: List[str] | None = None
+    folders: List[str] | None = None
+    # object ids of individual chunks
+    chunk_ids: List[str] | None = None
+
+
+@dataclass
+class ChunkHit:
+    properties: Dict[str, Any]
+    # certainty for vector search, fused rank score for hybrid search, higher is better
+    score: float
+    vector: np.ndarray | None = field(default=None, repr=False)
+
+
+class VectorStore(abc.ABC):
+    """
+    Storage and retrieval of bookmark chunks. Every query is scoped to one user, implementations are blocking
+    and called from the vector store executor.
+    """
+
+    # backend label of the metrics
+    name: str
+
+    @abc.abstractmethod
+    def add(self,
+            objects: List[Dict[str, Any]],
+            vectors: List[List[float] | None] | None = None,
+            ids: List[str] | None = None) -> List[str | None]:
+        """
+        Stores the chunks and returns an error message per object, None for the stored ones.
+        Objects without a vector are vectorized by the store. An object whose id exists already replaces it.
+        """
+
+    @abc.abstractmethod
+    def vector_search(self,
+                      text: str,
+                      chunk_filter: ChunkFilter,
+                      limit: int | None = None,
+                      certainty: float | None = None,
+                      vector: List[float] | None = None,
+                      with_vectors: bool = False) -> List[ChunkHit]:
+        """
+        Chunks closest to `vector`, or to `text` vectorized by the store, most similar first.
+        """
+
+    @abc.abstractmethod
+    def hybrid_search(self,
+                      text: str,
+                      chunk_filter: ChunkFilter,
+                      limit: int | None = None,
+                      alpha: float = 0.5,
+                      vector: List[float] | None = None,
+                      with_vectors: bool = False) -> List[ChunkHit]:
+        """
+        Ranked fusion of keyword (BM25) and vector search, `alpha` = 1 is pure vector search.
+        """
+
+    @abc.abstractmethod
+    def list_ids(self, chunk_filter: ChunkFilter) -> List[str]:
+        """
+        Object ids of the matching chunks.
+        """
+
+    @abc.abstractmethod
+    def delete(self, chunk_filter: ChunkFilter) -> int:
+        """
+        Deletes the matching chunks and returns how many were deleted.
+        """
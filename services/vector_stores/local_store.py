@@ -0,0 +1,350 @@
+import json
+import logging
+import math
+import re
+import threading
+import uuid
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+import openai
+
+from config import Config
+from services.vector_stores.base import DEFAULT_LIMIT, ChunkFilter, ChunkHit, VectorStore
+
+log = logging.getLogger(__name__)
+config = Config()
+
+Embedder = Callable[[List[str]], np.ndarray]
+
+_token_pattern = re.compile(r'\w+')
+
+# BM25 parameters, Weaviate's defaults
+_k1 = 1.2
+_b = 0.75
+# reciprocal rank fusion constant, as in Weaviate's rankedFusion
+_rank_constant = 60
+
+
+def openai_embed(texts: List[str]) -> np.ndarray:
+    res = openai.Embedding.create(model=config.embedding_model, input=texts)
+    data = sorted(res['data'], key=lambda item: item['index'])
+    return np.asarray([item['embedding'] for item in data], dtype=np.float32)
+
+
+def _tokenize(text: str) -> List[str]:
+    return _token_pattern.findall(text.lower())
+
+
+class _UserIndex:
+    """
+    Rows and BM25 postings of one user, every query only looks at these.
+    """
+
+    def __init__(self):
+        self.rows: List[int] = []
+        self.postings: Dict[str, Dict[int, int]] = defaultdict(dict)
+        self.lengths: Dict[int, int] = {}
+        self.total_length = 0
+
+    def add(self, row: int, content: str):
+        terms = Counter(_tokenize(content))
+        for term, tf in terms.items():
+            self.postings[term][row] = tf
+        length = sum(terms.values())
+        self.rows.append(row)
+        self.lengths[row] = length
+        self.total_length += length
+
+    def remove(self, rows: set, contents: Dict[int, str]):
+        self.rows = [row for row in self.rows if row not in rows]
+        for row in rows:
+            for term in set(_tokenize(contents[row])):
+                self.postings[term].pop(row, None)
+                if not self.postings[term]:
+                    del self.postings[term]
+            self.total_length -= self.lengths.pop(row)
+
+    def keyword_stats(self, query: str) -> '_KeywordStats':
+        # copies what scoring the query needs, so it can run outside the store's lock
+        postings = {term: dict(self.postings[term]) for term in set(_tokenize(query)) if term in self.postings}
+        lengths = {row: self.lengths[row] for term_postings in postings.values() for row in term_postings}
+        n = len(self.rows)
+        return _KeywordStats(postings, lengths, n, self.total_length / n if n else 0)
+
+
+@dataclass
+class _KeywordStats:
+    postings: Dict[str, Dict[int, int]]
+    lengths: Dict[int, int]
+    rows: int
+    avg_length: float
+
+    def bm25(self, candidates: np.ndarray) -> np.ndarray:
+        scores = np.zeros(len(candidates), dtype=np.float32)
+        if not len(candidates):
+            return scores
+        position = {row: i for i, row in enumerate(candidates.tolist())}
+        for postings in self.postings.values():
+            idf = math.log(1 + (self.rows - len(postings) + 0.5) / (len(postings) + 0.5))
+            for row, tf in postings.items():
+                i = position.get(row)
+                if i is None:
+                    continue
+                norm = _k1 * (1 - _b + _b * self.lengths[row] / self.avg_length) if self.avg_length else _k1
+                scores[i] += idf * tf * (_k1 + 1) / (tf + norm)
+        return scores
+
+
+class LocalVectorStore(VectorStore):
+    """
+    Embedded, file-backed vector store for small deployments, tests and benchmarks. Unit vectors are appended
+    to a raw float32 file that is memory-mapped for search, chunk properties to a JSON lines log that is replayed
+    on start. Keeps the row of every object id and a per-user row list and BM25 index in memory. Searches are exact
+    (brute force) over the user's rows, which is fast enough for the tens of thousands of chunks a user has.
+
+    Rows and vectors are matched by position. Vectors are written before the log lines that reference them, and both
+    files are cut back to what the log references before every append and on start, so a failed or torn write
+    never shifts the vectors of later rows.
+    """
+
+    name = 'local'
+
+    def __init__(self, path: str, embed: Embedder | None = None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.embed = embed or openai_embed
+        self._lock = threading.Lock()
+        self._properties: List[Dict[str, Any] | None] = []
+        self._ids: List[str] = []
+        self._rows_by_id: Dict[str, int] = {}
+        self._users: Dict[str, _UserIndex] = defaultdict(_UserIndex)
+        self._dimensions: int | None = None
+        self._vectors: np.ndarray | None = None
+        # bytes of the log that hold complete entries
+        self._log_size = 0
+        self._embed_query = lru_cache(maxsize=1024)(self.__embed_query)
+        self.__load()
+
+    @property
+    def __objects_path(self) -> Path:
+        return self.path / 'objects.jsonl'
+
+    @property
+    def __vectors_path(self) -> Path:
+        return self.path / 'vectors.f32'
+
+    def __load(self):
+        if self.__objects_path.exists():
+            with self.__objects_path.open('rb') as log_file:
+                for line in log_file:
+                    if not line.endswith(b'\n'):
+                        break  # torn by a failed write, it is cut off below
+                    entry = json.loads(line)
+                    if 'delete' in entry:
+                        self.__remove_rows(set(entry['delete']))
+                    else:
+                        # logs written before objects had ids
+                        self.__index(entry.get('id') or str(uuid.uuid4()), entry['properties'])
+                    self._log_size += len(line)
+            self.__truncate(self.__objects_path, self._log_size)
+        meta_path = self.path / 'meta.json'
+        if meta_path.exists():
+            self._dimensions = json.loads(meta_path.read_text())['dimensions']
+            # vectors written before their log lines failed are dropped
+            self.__truncate(self.__vectors_path, len(self._properties) * self.__row_bytes)
+            self.__map_vectors()
+
+    @property
+    def __row_bytes(self) -> int:
+        return self._dimensions * np.dtype(np.float32).itemsize
+
+    @classmethod
+    def __truncate(cls, path: Path, size: int):
+        if path.exists() and path.stat().st_size > size:
+            log.warning(f'Cutting {path} back to {size} bytes after an incomplete write')
+            with path.open('r+b') as f:
+                f.truncate(size)
+
+    def __append_log(self, data: bytes):
+        with self.__objects_path.open('ab') as log_file:
+            log_file.truncate(self._log_size)
+            log_file.write(data)
+        self._log_size += len(data)
+
+    def __map_vectors(self):
+        rows = len(self._properties)
+        self._vectors = np.memmap(self.__vectors_path, dtype=np.float32, mode='r', shape=(rows, self._dimensions)) if rows else None
+
+    def __index(self, _id: str, properties: Dict[str, Any]):
+        if _id in self._rows_by_id:
+            # an existing id is replaced, like a Weaviate batch import does
+            self.__remove_rows({self._rows_by_id[_id]})
+        row = len(self._properties)
+        self._properties.append(properties)
+        self._ids.append(_id)
+        self._rows_by_id[_id] = row
+        self._users[properties['user_id']].add(row, properties.get('content') or '')
+
+    def __remove_rows(self, rows: set):
+        by_user = defaultdict(set)
+        for row in rows:
+            if self._properties[row] is not None:
+                by_user[self._properties[row]['user_id']].add(row)
+        for user_id, user_rows in by_user.items():
+            self._users[user_id].remove(user_rows, {row: self._properties[row].get('content') or '' for row in user_rows})
+        for row in rows:
+            self._properties[row] = None
+            if self._rows_by_id.get(self._ids[row]) == row:
+                del self._rows_by_id[self._ids[row]]
+
+    def __embed_query(self, text: str) -> np.ndarray:
+        return self.__normalize(self.embed([text]))[0]
+
+    @classmethod
+    def __normalize(cls, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def add(self,
+            objects: List[Dict[str, Any]],
+            vectors: List[List[float] | None] | None = None,
+            ids: List[str] | None = None) -> List[str | None]:
+        if not objects:
+            return []
+        ids = [_id or str(uuid.uuid4()) for _id in ids] if ids else [str(uuid.uuid4()) for _ in objects]
+        vectors = list(vectors or [None] * len(objects))
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            try:
+                embedded = self.embed([objects[i].get('content') or '' for i in missing])
+            except Exception as e:
+                return [str(e)] * len(objects)
+            for i, vector in zip(missing, embedded):
+                vectors[i] = vector
+        matrix = self.__normalize(np.asarray(vectors, dtype=np.float32))
+        # serialized before either file is touched, an object that can't be encoded fails the add up front
+        log_lines = ''.join(json.dumps({'id': _id, 'properties': obj}) + '\n' for _id, obj in zip(ids, objects)).encode()
+
+        with self._lock:
+            if self._dimensions is None:
+                self._dimensions = matrix.shape[1]
+                (self.path / 'meta.json').write_text(json.dumps({'dimensions': self._dimensions}))
+            if matrix.shape[1] != self._dimensions:
+                return [f'Expected {self._dimensions} dimensions, got {matrix.shape[1]}'] * len(objects)
+            try:
+                with self.__vectors_path.open('ab') as vectors_file:
+                    vectors_file.truncate(len(self._properties) * self.__row_bytes)
+                    vectors_file.write(matrix.tobytes())
+                self.__append_log(log_lines)
+            except OSError as e:
+                return [str(e)] * len(objects)
+            for _id, obj in zip(ids, objects):
+                self.__index(_id, dict(obj))
+            self.__map_vectors()
+        return [None] * len(objects)
+
+    def list_ids(self, chunk_filter: ChunkFilter) -> List[str]:
+        with self._lock:
+            return [self._ids[row] for row in self.__candidates(chunk_filter).tolist()]
+
+    def delete(self, chunk_filter: ChunkFilter) -> int:
+        if not chunk_filter.firebase_ids and not chunk_filter.folders and not chunk_filter.chunk_ids:
+            raise ValueError('Refusing to delete every chunk of a user without a filter')
+        with self._lock:
+            rows = self.__candidates(chunk_filter)
+            if len(rows):
+                self.__append_log((json.dumps({'delete': rows.tolist()}) + '\n').encode())
+                self.__remove_rows(set(rows.tolist()))
+        return len(rows)
+
+    def __candidates(self, chunk_filter: ChunkFilter) -> np.ndarray:
+        user = self._users.get(chunk_filter.user_id)
+        if user is None:
+            return np.zeros(0, dtype=np.int64)
+        rows = user.rows
+        if chunk_filter.firebase_ids:
+            ids = set(chunk_filter.firebase_ids)
+            rows = [row for row in rows if self._properties[row]['firebase_id'] in ids]
+        if chunk_filter.folders:
+            folders = set(chunk_filter.folders)
+            rows = [row for row in rows if self._properties[row].get('folder') in folders]
+        if chunk_filter.chunk_ids:
+            chunk_ids = set(chunk_filter.chunk_ids)
+            rows = [row for row in rows if self._ids[row] in chunk_ids]
+        return np.asarray(rows, dtype=np.int64)
+
+    def __snapshot(self, chunk_filter: ChunkFilter, keyword_query: str | None = None):
+        # searches run outside the lock on a consistent view: vectors are only ever appended, the BM25 postings
+        # of the query are copied
+        with self._lock:
+            user = self._users.get(chunk_filter.user_id)
+            keyword_stats = user.keyword_stats(keyword_query) if user is not None and keyword_query is not None else None
+            return self.__candidates(chunk_filter), self._vectors, keyword_stats
+
+    def __hits(self, rows: np.ndarray, scores: np.ndarray, vectors: np.ndarray, with_vectors: bool) -> List[ChunkHit]:
+        with self._lock:
+            # rows deleted since the snapshot are dropped
+            properties = [self._properties[row] for row in rows.tolist()]
+            properties = [dict(p) if p is not None else None for p in properties]
+        return [ChunkHit(
+            properties=p,
+            score=float(score),
+            vector=np.array(vectors[row]) if with_vectors else None,
+        ) for row, score, p in zip(rows.tolist(), scores.tolist(), properties) if p is not None]
+
+    @classmethod
+    def __top(cls, scores: np.ndarray, limit: int) -> np.ndarray:
+        if len(scores) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+        else:
+            top = np.arange(len(scores))
+        return top[np.argsort(-scores[top], kind='stable')]
+
+    def vector_search(self,
+                      text: str,
+                      chunk_filter: ChunkFilter,
+                      limit: int | None = None,
+                      certainty: float | None = None,
+                      vector: List[float] | None = None,
+                      with_vectors: bool = False) -> List[ChunkHit]:
+        rows, vectors, _ = self.__snapshot(chunk_filter)
+        if not len(rows) or vectors is None:
+            return []
+        query = self.__normalize([vector])[0] if vector is not None else self._embed_query(text)
+        # certainty as Weaviate defines it for cosine distance
+        certainties = (1 + vectors[rows] @ query) / 2
+        if certainty is not None:
+            keep = certainties >= certainty
+            rows, certainties = rows[keep], certainties[keep]
+        top = self.__top(certainties, limit or DEFAULT_LIMIT)
+        return self.__hits(rows[top], certainties[top], vectors, with_vectors)
+
+    def hybrid_search(self,
+                      text: str,
+                      chunk_filter: ChunkFilter,
+                      limit: int | None = None,
+                      alpha: float = 0.5,
+                      vector: List[float] | None = None,
+                      with_vectors: bool = False) -> List[ChunkHit]:
+        rows, vectors, keyword_stats = self.__snapshot(chunk_filter, text)
+        if not len(rows) or vectors is None:
+            return []
+        limit = limit or DEFAULT_LIMIT
+        query = self.__normalize([vector])[0] if vector is not None else self._embed_query(text)
+
+        fused = np.zeros(len(rows), dtype=np.float32)
+        vector_rank = np.argsort(-(vectors[rows] @ query), kind='stable')
+        fused[vector_rank] += alpha / (_rank_constant + np.arange(1, len(rows) + 1))
+        keyword_scores = keyword_stats.bm25(rows)
+        matched = np.flatnonzero(keyword_scores > 0)
+        keyword_rank = matched[np.argsort(-keyword_scores[matched], kind='stable')]
+        fused[keyword_rank] += (1 - alpha) / (_rank_constant + np.arange(1, len(keyword_rank) + 1))
+
+        top = self.__top(fused, limit)
+        return self.__hits(rows[top], fused[top], vectors, with_vectors)
@@ -0,0 +1,233 @@
+import hashlib
+import re
+import threading
+from typing import Any, Dict, List, Set
+
+import numpy as np
+import weaviate
+from weaviate import Tenant
+from weaviate.batch import Batch
+
+from config import Config
+from services.vector_stores.base import CHUNK_PROPERTIES, ChunkFilter, ChunkHit, VectorStore
+from utils.db import document_schema, tenant_document_schema
+
+config = Config()
+
+_list_page_size = 1000
+
+_tenant_name_pattern = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def get_tenant_name(user_id: str) -> str:
+    if _tenant_name_pattern.match(user_id):
+        return user_id
+    return hashlib.sha1(user_id.encode()).hexdigest()
+
+
+class WeaviateVectorStore(VectorStore):
+    """
+    With `vectorstore_multi_tenancy` every user's chunks live in their own tenant of the TenantDocument class
+    and queries only touch that tenant's index, otherwise all users share the Document class and queries are
+    scoped with a user_id filter.
+    """
+
+    name = 'weaviate'
+
+    # client.batch is a single stateful buffer per client, so every executor thread writes through its own
+    __thread_batches = threading.local()
+    # tenants known to exist, by class name
+    __known_tenants: Dict[str, Set[str]] = {}
+    __tenants_lock = threading.Lock()
+
+    def __init__(self, client: weaviate.Client, multi_tenancy: bool | None = None):
+        self.client = client
+        self.multi_tenancy = config.vectorstore_multi_tenancy if multi_tenancy is None else multi_tenancy
+        self.class_name = tenant_document_schema['class'] if self.multi_tenancy else document_schema['class']
+
+    def __tenant(self, user_id: str) -> str | None:
+        return get_tenant_name(user_id) if self.multi_tenancy else None
+
+    def add(self,
+            objects: List[Dict[str, Any]],
+            vectors: List[List[float] | None] | None = None,
+            ids: List[str] | None = None) -> List[str | None]:
+        vectors = vectors or [None] * len(objects)
+        ids = ids or [None] * len(objects)
+        if self.multi_tenancy:
+            self.ensure_tenants({obj['user_id'] for obj in objects})
+        batch = self.__get_thread_batch()
+        try:
+            for obj, vector, _id in zip(objects, vectors, ids):
+                # batch imports with an existing id replace the object
+                batch.add_data_object(obj, self.class_name, uuid=_id, vector=vector, tenant=self.__tenant(obj['user_id']))
+            results = batch.create_objects()
+        finally:
+            # a failed request leaves the objects buffered, they must not leak into the next batch
+            batch.empty_objects()
+        return [self.__get_batch_error(result) for result in results]
+
+    def ensure_tenants(self, user_ids: Set[str]):
+        """
+        Creates the tenants of users that store their first chunks. Known tenants are cached per process,
+        the server is only asked when a user is not in the cache.
+        """
+        tenants = {get_tenant_name(user_id) for user_id in user_ids}
+        with self.__tenants_lock:
+            known = self.__known_tenants.get(self.class_name)
+            if known is None or not tenants <= known:
+                known = {tenant.name for tenant in self.client.schema.get_class_tenants(self.class_name)}
+                missing = tenants - known
+                if missing:
+                    self.client.schema.add_class_tenants(self.class_name, [Tenant(name=name) for name in missing])
+                    known |= missing
+                self.__known_tenants[self.class_name] = known
+
+    def __get_thread_batch(self) -> Batch:
+        batches = getattr(self.__thread_batches, 'by_client', None)
+        if batches is None:
+            batches = self.__thread_batches.by_client = {}
+        if id(self.client) not in batches:
+            batches[id(self.client)] = Batch(self.client._connection)
+        return batches[id(self.client)]
+
+    @classmethod
+    def __get_batch_error(cls, result: Dict[str, Any]) -> str | None:
+        errors = (result.get('result') or {}).get('errors')
+        if not errors:
+            return None
+        return '; '.join(error.get('message', '') for error in errors.get('error', []))
+
+    def vector_search(self,
+                      text: str,
+                      chunk_filter: ChunkFilter,
+                      limit: int | None = None,
+                      certainty: float | None = None,
+                      vector: List[float] | None = None,
+                      with_vectors: bool = False) -> List[ChunkHit]:
+        query = self.__query(chunk_filter)
+        near = {"certainty": certainty} if certainty is not None else {}
+        if vector is not None:
+            query = query.with_near_vector({"vector": list(vector), **near})
+        else:
+            query = query.with_near_text({"concepts": [text], **near})
+        return self.__run(query, limit, 'certainty', with_vectors)
+
+    def hybrid_search(self,
+                      text: str,
+                      chunk_filter: ChunkFilter,
+                      limit: int | None = None,
+                      alpha: float = 0.5,
+                      vector: List[float] | None = None,
+                      with_vectors: bool = False) -> List[ChunkHit]:
+        query = self.__query(chunk_filter).with_hybrid(query=text, alpha=alpha, vector=list(vector) if vector is not None else None)
+        return self.__run(query, limit, 'score', with_vectors)
+
+    def list_ids(self, chunk_filter: ChunkFilter) -> List[str]:
+        """
+        Pages with offsets, cursors can't be combined with a filter. Stops at QUERY_MAXIMUM_RESULTS.
+        """
+        ids = []
+        while True:
+            query = self.__query(chunk_filter, properties=[]).with_additional(['id']).with_limit(_list_page_size).with_offset(len(ids))
+            res = query.do()
+            if res.get('errors', None):
+                if self.__is_missing_tenant(res['errors']):
+                    return ids
+                raise Exception(res['errors'])
+            page = res['data']['Get'][self.class_name] or []
+            ids += [d['_additional']['id'] for d in page]
+            if len(page) < _list_page_size:
+                return ids
+
+    def delete(self, chunk_filter: ChunkFilter) -> int:
+        """
+        Weaviate caps the matches of a single delete request, so it is repeated until nothing is left.
+        """
+        where_filter = self.__get_where_filter(chunk_filter)
+        if where_filter is None:
+            raise ValueError('Refusing to delete every chunk of a tenant without a filter')
+        deleted = 0
+        while True:
+            try:
+                res = self.client.batch.delete_objects(
+                    class_name=self.class_name,
+                    where=where_filter,
+                    tenant=self.__tenant(chunk_filter.user_id)
+                )
+            except weaviate.UnexpectedStatusCodeException as e:
+                if self.__is_missing_tenant(e):
+                    return deleted  # the user never stored anything
+                raise
+            results = (res or {}).get('results', {})
+            if results.get('failed'):
+                raise Exception(f'Could not delete {results["failed"]} chunks')
+            deleted += results.get('successful', 0)
+            if results.get('matches', 0) < results.get('limit', 0) or not results.get('matches'):
+                return deleted
+
+    @classmethod
+    def __build_in_filter(cls, path: str, values: List[str]) -> Dict[str, Any]:
+        # a single set membership operand instead of an Or of one Equal per value
+        return {
+            "path": [path],
+            "operator": "ContainsAny",
+            "valueTextArray": list(values),
+        }
+
+    def __get_where_filter(self, chunk_filter: ChunkFilter) -> Dict[str, Any] | None:
+        operands = []
+        if not self.multi_tenancy:
+            # a tenant only holds the chunks of its user
+            operands.append({
+                "path": ["user_id"],
+                "operator": "Equal",
+                "valueString": chunk_filter.user_id
+            })
+        if chunk_filter.firebase_ids:
+            operands.append(self.__build_in_filter("firebase_id", chunk_filter.firebase_ids))
+        if chunk_filter.folders:
+            operands.append(self.__build_in_filter("folder", chunk_filter.folders))
+        if chunk_filter.chunk_ids:
+            operands.append(self.__build_in_filter("id", chunk_filter.chunk_ids))
+
+        if len(operands) <= 1:
+            return operands[0] if operands else None
+        return {
+            "operator": "And",
+            "operands": operands
+        }
+
+    def __query(self, chunk_filter: ChunkFilter, properties: List[str] | None = None):
+        query = self.client.query.get(self.class_name, CHUNK_PROPERTIES if properties is None else properties)
+        if self.multi_tenancy:
+            query = query.with_tenant(self.__tenant(chunk_filter.user_id))
+        where_filter = self.__get_where_filter(chunk_filter)
+        if where_filter:
+            query = query.with_where(where_filter)
+        return query
+
+    def __run(self, query, limit: int | None, score: str, with_vectors: bool) -> List[ChunkHit]:
+        if limit:
+            query = query.with_limit(limit)
+        res = query.with_additional(
+            [score, 'vector'] if with_vectors else [score]
+        ).do()
+        if res.get('errors', None):
+            if self.__is_missing_tenant(res['errors']):
+                return []  # the user never stored anything
+            raise Exception(res['errors'])
+
+        hits = []
+        for d in res['data']['Get'][self.class_name] or []:
+            additional = d.pop('_additional', None) or {}
+            hits.append(ChunkHit(
+                properties=d,
+                score=float(additional.get(score) or 0),
+                vector=np.asarray(additional['vector'], dtype=np.float32) if with_vectors else None,
+            ))
+        return hits
+
+    @classmethod
+    def __is_missing_tenant(cls, error) -> bool:
+        return 'tenant not found' in str(error)
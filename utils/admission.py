@@ -0,0 +1,123 @@
+import asyncio
+import math
+import time
+
+from config import Config
+
+config = Config()
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f'{name} is over its rate limit, retry in {retry_after:.1f}s')
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Refills `per_minute` units evenly over a minute and holds at most a minute's worth. 0 means unlimited.
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount: float, now: float) -> float:
+        if self.capacity <= 0:
+            return 0.0
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        # a request larger than the bucket would never fit, it only has to wait for a full bucket
+        deficit = min(amount, self.capacity) - self.level
+        return max(0.0, deficit / self.rate)
+
+    def take(self, amount: float):
+        if self.capacity > 0:
+            self.level -= min(amount, self.capacity)
+
+
+class AdmissionController:
+    """
+    Admits upstream calls within a requests per minute and a tokens per minute budget. Calls that do not fit
+    wait in a FIFO queue of at most `max_queue` callers for at most `max_wait` seconds, otherwise they are
+    rejected right away with the time after which a retry would fit.
+    """
+
+    def __init__(self, name: str, rpm: int, tpm: int, max_queue: int, max_wait: float):
+        self.name = name
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._turn: asyncio.Lock | None = None
+        self._waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+
+    def __wait_time(self, tokens: int) -> float:
+        now = time.monotonic()
+        return max(self._requests.wait_time(1, now), self._tokens.wait_time(tokens, now))
+
+    def __take(self, tokens: int):
+        self._requests.take(1)
+        self._tokens.take(tokens)
+        self.admitted += 1
+
+    def __reject(self, retry_after: float):
+        self.rejected += 1
+        raise AdmissionRejected(self.name, max(retry_after, 1.0))
+
+    async def acquire(self, tokens: int, max_wait: float | None = None):
+        """
+        Returns once the call may go ahead. Background work passes `max_wait=math.inf` to wait as long as
+        it takes, it is not bounded by the queue either.
+        """
+        max_wait = self.max_wait if max_wait is None else max_wait
+        if not self._waiting and self.__wait_time(tokens) == 0:
+            self.__take(tokens)
+            return
+
+        bounded = not math.isinf(max_wait)
+        if bounded:
+            if self._waiting >= self.max_queue:
+                self.__reject(self.__wait_time(tokens) + max_wait)
+            wait = self.__wait_time(tokens)
+            if wait > max_wait:
+                self.__reject(wait)
+
+        if self._turn is None:
+            self._turn = asyncio.Lock()
+        self._waiting += 1
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self.__wait_for_turn(tokens), max_wait if bounded else None)
+        except asyncio.TimeoutError:
+            self.__reject(self.__wait_time(tokens))
+        finally:
+            self._waiting -= 1
+
+    async def __wait_for_turn(self, tokens: int):
+        # asyncio.Lock wakes waiters in order, so only the head of the queue watches the buckets
+        async with self._turn:
+            while (wait := self.__wait_time(tokens)) > 0:
+                await asyncio.sleep(wait)
+            self.__take(tokens)
+
+    def stats(self):
+        return {
+            f'{self.name}_admitted': self.admitted,
+            f'{self.name}_queued': self.queued,
+            f'{self.name}_rejected': self.rejected,
+            f'{self.name}_waiting': self._waiting,
+        }
+
+
+llm_admission = AdmissionController(
+    'llm', config.llm_rpm, config.llm_tpm, config.admission_max_queue, config.admission_max_wait,
+)
+embedding_admission = AdmissionController(
+    'embedding', config.embedding_rpm, config.embedding_tpm, config.admission_max_queue, config.admission_max_wait,
+)
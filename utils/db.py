@@ -1,46 +1,107 @@
-from datetime import datetime
-from functools import lru_cache
+import asyncio
+import functools
+import logging
+import threading
+import time
+from typing import Callable, Dict, TypeVar
 
-import firebase_admin
 import weaviate
-from firebase_admin import credentials, firestore
 from google.cloud.firestore_v1 import AsyncClient
 
 from config import Config
 from utils.files import get_root_path
 
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+cred_path = get_root_path().joinpath('bookmarkai-c7f69-0e7393f3fe4e.json')
+
+# text2vec-openai only vectorizes the content, as the embedding service does for precomputed vectors, so
+# vectors written by either side and query vectors come from the same input. The module config of an existing
+# class can't be changed, classes created before need to be re-created and re-indexed to pick it up.
+_skip_vectorization = {"text2vec-openai": {"skip": True, "vectorizePropertyName": False}}
+
 document_schema = {
     "class": "Document",
     "vectorizer": 'text2vec-openai',
+    "moduleConfig": {
+        "text2vec-openai": {"vectorizeClassName": False}
+    },
     "properties": [
         {
             "name": "title",
             "dataType": ["string"],
+            "moduleConfig": _skip_vectorization,
         },
         {
             "name": "url",
             "dataType": ["string"],
+            "moduleConfig": _skip_vectorization,
         },
         {
             "name": "content",
             "dataType": ["string"],
+            "moduleConfig": {
+                "text2vec-openai": {"skip": False, "vectorizePropertyName": False}
+            },
         },
         {
             "name": "firebase_id",
             "dataType": ["string"],
+            "moduleConfig": _skip_vectorization,
         },
         {
             "name": "user_id",
-            "dataType": ["string"]
+            "dataType": ["string"],
+            "moduleConfig": _skip_vectorization,
+        },
+        {
+            "name": "token_count",
+            "dataType": ["int"],
+            "moduleConfig": _skip_vectorization,
+        },
+        {
+            "name": "folder",
+            "dataType": ["text"],
+            "tokenization": "field",  # folder names are matched as a whole
+            "moduleConfig": _skip_vectorization,
         }
     ]
 }
 
+# same properties, but every user's chunks live in their own tenant (and index) of the class
+tenant_document_schema = {
+    **document_schema,
+    "class": "TenantDocument",
+    "multiTenancyConfig": {"enabled": True},
+}
+
+
+def _lazy(factory: Callable[[], T]) -> Callable[[], T]:
+    """
+    Builds the client on first use instead of at import time. Thread safe, so warm-up threads and
+    requests arriving before warm-up is done never build two clients.
+    """
+    lock = threading.Lock()
+    instance = []
+
+    @functools.wraps(factory)
+    def get() -> T:
+        if not instance:
+            with lock:
+                if not instance:
+                    instance.append(factory())
+        return instance[0]
 
-@lru_cache()
+    get.is_initialized = lambda: bool(instance)
+    return get
+
+
+@_lazy
 def get_vectorstore() -> weaviate.Client:
     config = Config()
-    print(f'Connecting to Weaviate at {config.weaviate_url}')
+    log.info(f'Connecting to Weaviate at {config.weaviate_url}')
     weaviate_client = weaviate.Client(
         config.weaviate_url,
         auth_client_secret=weaviate.AuthApiKey(config.weaviate_key) if config.weaviate_key else None,
@@ -49,17 +110,53 @@ def get_vectorstore() -> weaviate.Client:
         }
     )
 
-    if not weaviate_client.schema.exists(document_schema['class']):
-        weaviate_client.schema.create_class(document_schema)
+    for schema in [document_schema, tenant_document_schema]:
+        if not weaviate_client.schema.exists(schema['class']):
+            weaviate_client.schema.create_class(schema)
+        else:
+            # add properties introduced after the class was created
+            existing_class = weaviate_client.schema.get(schema['class'])
+            existing = {p['name'] for p in existing_class['properties']}
+            if (existing_class.get('moduleConfig') or {}).get('text2vec-openai', {}).get('vectorizeClassName', True):
+                log.warning(f'{schema["class"]} vectorizes more than the content, re-create and re-index it '
+                            f'to match the vectors of the embedding service')
+            for prop in schema['properties']:
+                if prop['name'] not in existing:
+                    weaviate_client.schema.property.create(schema['class'], prop)
 
     return weaviate_client
 
 
-cred_path = get_root_path().joinpath('bookmarkai-c7f69-0e7393f3fe4e.json')
-cred = credentials.Certificate(cred_path)
-app = firebase_admin.initialize_app(cred)
-firebase_app = firestore.client()
+@_lazy
+def get_async_firestore() -> AsyncClient:
+    config = Config()
+    if config.firestore_emulator_host:
+        log.info(f'Using the Firestore emulator at {config.firestore_emulator_host}')
+        return AsyncClient(project=config.firebase_project_id)
+    return AsyncClient.from_service_account_json(cred_path)
+
+
+async def warm_up() -> Dict[str, float]:
+    """
+    Builds the Weaviate and Firestore clients in parallel and makes one round trip to each, so the first
+    request does not pay for connection setup. Weaviate is skipped with the local vector store backend. Returns the seconds every backend took.
+    """
+    async def timed(name: str, func):
+        start = time.perf_counter()
+        await func()
+        return name, time.perf_counter() - start
+
+    async def weaviate_ready():
+        client = await asyncio.to_thread(get_vectorstore)
+        if not await asyncio.to_thread(client.is_ready):
+            raise Exception('Weaviate is not ready')
+
+    async def firestore_ready():
+        db = await asyncio.to_thread(get_async_firestore)
+        # opens the channel and fetches an access token, the document does not need to exist
+        await db.collection('_warm_up').document('_warm_up').get()
 
-async_firebase_app = AsyncClient.from_service_account_json(
-    cred_path
-)
+    backends = [timed('firestore', firestore_ready)]
+    if Config().vectorstore_backend == 'weaviate':
+        backends.append(timed('weaviate', weaviate_ready))
+    return dict(await asyncio.gather(*backends))
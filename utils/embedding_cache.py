@@ -0,0 +1,59 @@
+import hashlib
+import re
+import sqlite3
+import threading
+from typing import Dict, List
+
+import numpy as np
+from cachetools import LRUCache
+
+_whitespace = re.compile(r'\s+')
+
+
+def embedding_key(text: str, model: str) -> str:
+    normalized = _whitespace.sub(' ', text).strip()
+    return hashlib.sha256(f'{model}\0{normalized}'.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Content addressed embedding store: an in-memory LRU tier in front of a sqlite file.
+    Vectors are stored as float32 and keyed by `embedding_key`.
+    """
+
+    def __init__(self, path: str, memory_size: int):
+        self.memory: LRUCache[str, np.ndarray] = LRUCache(maxsize=memory_size)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)')
+        self.db.commit()
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found = {}
+        with self.lock:
+            missing = []
+            for key in keys:
+                vector = self.memory.get(key)
+                if vector is None:
+                    missing.append(key)
+                else:
+                    found[key] = vector
+            for start in range(0, len(missing), 500):  # stay below sqlite's host parameter limit
+                batch = missing[start:start + 500]
+                placeholders = ','.join('?' * len(batch))
+                rows = self.db.execute(f'SELECT key, vector FROM embeddings WHERE key IN ({placeholders})', batch)
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32)
+                    self.memory[key] = vector
+                    found[key] = vector
+        return found
+
+    def set_many(self, vectors: Dict[str, np.ndarray]):
+        with self.lock:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)',
+                [(key, vector.astype(np.float32).tobytes()) for key, vector in vectors.items()]
+            )
+            self.db.commit()
+            for key, vector in vectors.items():
+                self.memory[key] = vector
@@ -0,0 +1,185 @@
+import contextvars
+import threading
+import time
+from functools import wraps
+from typing import Dict, List, Sequence, Tuple
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config import Config
+
+config = Config()
+
+# read once, so every instrumented call site is a no-op (or the undecorated function) when disabled
+enabled = config.metrics_enabled
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    """
+    Cumulative histogram in the Prometheus exposition format, one series per label combination.
+    Observed from the event loop and the executor threads.
+    """
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str], buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+            counts, total = series
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            total[0] += value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = [(labels, list(counts), total[0]) for labels, (counts, total) in self._series.items()]
+        for labels, counts, total in sorted(series):
+            label_str = ','.join(f'{name}="{value}"' for name, value in zip(self.label_names, labels))
+            prefix = f'{label_str},' if label_str else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append(f'{self.name}_bucket{{{prefix}le="{le}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{label_str}}} {total}')
+            lines.append(f'{self.name}_count{{{label_str}}} {cumulative}')
+        return lines
+
+
+stage_seconds = Histogram('supermark_stage_seconds', 'Duration of request stages in seconds', ['stage'])
+backend_seconds = Histogram('supermark_backend_seconds', 'Duration of backend calls in seconds', ['backend', 'operation'])
+
+# stage durations of the current request, shared with the executor threads through the copied context
+_request_timings: contextvars.ContextVar[Dict[str, float] | None] = contextvars.ContextVar('request_timings', default=None)
+# one request can record from several executor threads at once, e.g. the gathered deletes of a batch delete
+_timings_lock = threading.Lock()
+
+
+def record(stage: str, seconds: float, backend: str | None = None):
+    if backend:
+        backend_seconds.observe(seconds, backend, stage)
+        stage = f'{backend}.{stage}'
+    else:
+        stage_seconds.observe(seconds, stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        with _timings_lock:
+            timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+def request_timings() -> Dict[str, float] | None:
+    timings = _request_timings.get()
+    if timings is None:
+        return None
+    with _timings_lock:
+        return dict(timings)
+
+
+class _Timer:
+    __slots__ = ('stage', 'backend', 'start')
+
+    def __init__(self, stage: str, backend: str | None):
+        self.stage = stage
+        self.backend = backend
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record(self.stage, time.perf_counter() - self.start, self.backend)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return None
+
+
+_null_timer = _NullTimer()
+
+
+def timed(stage: str, backend: str | None = None):
+    """
+    Context manager recording the duration of the block as `stage`, or as the `stage` operation of `backend`.
+    """
+    if not enabled:
+        return _null_timer
+    return _Timer(stage, backend)
+
+
+def timed_async(stage: str, backend: str | None = None):
+    """
+    Decorator version of `timed` for coroutine functions, leaves the function untouched when disabled.
+    """
+    def decorator(func):
+        if not enabled:
+            return func
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with _Timer(stage, backend):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def server_timing(timings: Dict[str, float]) -> str:
+    return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in timings.items())
+
+
+def render() -> str:
+    return '\n'.join(stage_seconds.render() + backend_seconds.render()) + '\n'
+
+
+class MetricsMiddleware:
+    """
+    Collects the stage timings of every request and reports them as a Server-Timing header. Streaming
+    responses have sent their headers before the stages ran, /chat reports them in a final SSE event instead.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        timings: Dict[str, float] = {}
+        token = _request_timings.set(timings)
+        start = time.perf_counter()
+
+        async def send_with_timings(message: Message):
+            if message['type'] == 'http.response.start':
+                headers = MutableHeaders(scope=message)
+                if not headers.get('content-type', '').startswith('text/event-stream'):
+                    with _timings_lock:
+                        snapshot = dict(timings)
+                    headers.append('Server-Timing', server_timing({**snapshot, 'total': time.perf_counter() - start}))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            _request_timings.reset(token)
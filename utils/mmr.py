@@ -0,0 +1,75 @@
+from typing import List, Sequence
+
+import numpy as np
+
+
+def normalize_relevance(scores: Sequence[float]) -> np.ndarray:
+    """
+    Min-max scales query relevance scores (certainty or hybrid score, whose ranges differ) to [0, 1].
+    """
+    scores = np.asarray(scores, dtype=np.float32)
+    if scores.size == 0:
+        return scores
+    spread = scores.max() - scores.min()
+    if spread == 0:
+        return np.ones_like(scores)
+    return (scores - scores.min()) / spread
+
+
+def best_per_group(groups: Sequence[str], relevance: np.ndarray) -> np.ndarray:
+    """
+    Returns the index of the most relevant item of every group, most relevant group first.
+    """
+    order = np.argsort(-relevance, kind='stable')
+    seen = set()
+    best = []
+    for i in order:
+        if groups[i] not in seen:
+            seen.add(groups[i])
+            best.append(i)
+    return np.asarray(best, dtype=np.int64)
+
+
+def mmr(relevance: np.ndarray,
+        vectors: np.ndarray,
+        k: int,
+        lambda_mult: float = 0.5,
+        groups: Sequence[str] | None = None,
+        max_per_group: int | None = None) -> List[int]:
+    """
+    Maximal marginal relevance: repeatedly picks the item maximising
+    `lambda_mult * relevance - (1 - lambda_mult) * max cosine similarity to the items picked so far`.
+    Similarities are computed once as a matrix, every step only updates the running maximum.
+    With `max_per_group` at most that many items of the same group are picked.
+    """
+    n = len(relevance)
+    k = min(k, n)
+    if k <= 0:
+        return []
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    unit = vectors / np.where(norms == 0, 1, norms)
+    similarity = unit @ unit.T
+
+    available = np.ones(n, dtype=bool)
+    max_similarity = np.full(n, -np.inf, dtype=np.float32)
+    group_ids = np.unique(np.asarray(groups), return_inverse=True)[1] if groups is not None and max_per_group else None
+    group_counts = np.zeros(group_ids.max() + 1 if group_ids is not None else 0, dtype=np.int64)
+
+    selected = []
+    for _ in range(k):
+        # nothing is selected yet in the first round, so only relevance counts
+        penalty = np.where(np.isinf(max_similarity), 0, max_similarity)
+        scores = lambda_mult * relevance - (1 - lambda_mult) * penalty
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        if not available[best]:
+            break
+        selected.append(best)
+        available[best] = False
+        np.maximum(max_similarity, similarity[best], out=max_similarity)
+        if group_ids is not None:
+            group_counts[group_ids[best]] += 1
+            if group_counts[group_ids[best]] >= max_per_group:
+                available[group_ids == group_ids[best]] = False
+    return selected
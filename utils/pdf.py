@@ -0,0 +1,43 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, List
+
+import PyPDF2
+
+from config import Config
+
+config = Config()
+
+# page extraction is CPU bound pure python, so it runs in worker processes instead of on the event loop
+pdf_executor = ProcessPoolExecutor(max_workers=config.pdf_max_workers)
+
+
+def _count_pages(path: str) -> int:
+    return len(PyPDF2.PdfReader(path).pages)
+
+
+def _extract_pages(path: str, start: int, stop: int) -> List[str]:
+    # opened per batch, a reader kept around in the worker would hold the parsed PDF after the upload is done
+    reader = PyPDF2.PdfReader(path)
+    return [reader.pages[page_number].extract_text() for page_number in range(start, stop)]
+
+
+async def iter_pdf_pages(path: str, batch_size: int | None = None) -> AsyncIterator[str]:
+    """
+    Yields the text of every page of the PDF at `path` in page order. Pages are extracted in
+    batches of `batch_size` which run concurrently in the process pool.
+    """
+    batch_size = batch_size or config.pdf_page_batch_size
+    loop = asyncio.get_running_loop()
+    num_pages = await loop.run_in_executor(pdf_executor, _count_pages, path)
+    batches = [
+        loop.run_in_executor(pdf_executor, _extract_pages, path, start, min(start + batch_size, num_pages))
+        for start in range(0, num_pages, batch_size)
+    ]
+    try:
+        for batch in batches:
+            for page_text in await batch:
+                yield page_text
+    finally:
+        for batch in batches:
+            batch.cancel()
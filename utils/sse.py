@@ -0,0 +1,79 @@
+import asyncio
+from typing import AsyncIterator, List
+
+import orjson
+
+from models.chat import ChatServiceMessage
+
+
+def encode_json(obj) -> str:
+    return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+
+async def coalesce_messages(messages: AsyncIterator[ChatServiceMessage],
+                            window: float,
+                            max_bytes: int) -> AsyncIterator[ChatServiceMessage]:
+    """
+    Merges consecutive token messages into one until `window` seconds have passed since the first
+    buffered token or `max_bytes` are buffered. The final `done` message is passed through as is.
+    """
+    if window <= 0:
+        async for msg in messages:
+            yield msg
+        return
+
+    loop = asyncio.get_running_loop()
+    iterator = messages.__aiter__()
+    buffer: List[str] = []
+    buffered_bytes = 0
+    template: ChatServiceMessage | None = None
+    deadline: float | None = None
+    next_msg: asyncio.Future | None = None
+
+    def flush() -> ChatServiceMessage:
+        nonlocal buffered_bytes, deadline
+        msg = ChatServiceMessage.construct(msg=''.join(buffer), relevant_documents=template.relevant_documents, done=False)
+        buffer.clear()
+        buffered_bytes = 0
+        deadline = None
+        return msg
+
+    try:
+        while True:
+            if next_msg is None:
+                next_msg = asyncio.ensure_future(iterator.__anext__())
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            done, _ = await asyncio.wait({next_msg}, timeout=timeout)
+            if not done:
+                yield flush()
+                continue
+
+            try:
+                msg = next_msg.result()
+            except StopAsyncIteration:
+                break
+            finally:
+                next_msg = None
+
+            if msg.done:
+                if buffer:
+                    yield flush()
+                yield msg
+                continue
+
+            template = msg
+            buffer.append(msg.msg)
+            buffered_bytes += len(msg.msg)
+            if deadline is None:
+                deadline = loop.time() + window
+            if buffered_bytes >= max_bytes:
+                yield flush()
+
+        if buffer:
+            yield flush()
+    finally:
+        if next_msg is not None:
+            next_msg.cancel()
+            await asyncio.gather(next_msg, return_exceptions=True)
+        if hasattr(iterator, 'aclose'):
+            await iterator.aclose()
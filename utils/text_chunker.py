@@ -0,0 +1,108 @@
+import re
+from typing import Iterable, Iterator, List, Tuple
+
+from utils.tokens import count_tokens, get_encoding
+
+Chunk = Tuple[str, int]  # (text, token count)
+
+# boundaries tried in order when a piece of text is larger than the token budget, separators stay attached
+_separators = [
+    re.compile(r'(?<=\n\n)'),  # paragraphs
+    re.compile(r'(?<=\n)'),  # lines
+    re.compile(r'(?<=[.!?])(?=\s)'),  # sentences
+    re.compile(r'(?<=\s)(?=\S)'),  # words
+]
+
+
+class _ChunkWindow:
+    def __init__(self, chunk_tokens: int, overlap_tokens: int):
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.units: List[Chunk] = []
+        self.tokens = 0
+        self.fresh = False  # whether units beyond the carried over overlap were added
+
+    def push(self, text: str, tokens: int) -> Iterator[Chunk]:
+        if self.units and self.tokens + tokens > self.chunk_tokens:
+            yield from self.emit()
+            if self.tokens + tokens > self.chunk_tokens:
+                # the carried over overlap leaves no room for this unit
+                self.units, self.tokens = [], 0
+        self.units.append((text, tokens))
+        self.tokens += tokens
+        self.fresh = True
+
+    def emit(self) -> Iterator[Chunk]:
+        if not self.fresh:
+            return
+        text = ''.join(unit for unit, _ in self.units).strip()
+        if text:
+            # the unit counts only budget the window, tokens can merge across unit boundaries and the strip
+            yield text, count_tokens(text)
+
+        # the trailing units that fit into the overlap budget start the next chunk
+        overlap, overlap_tokens = [], 0
+        for unit, tokens in reversed(self.units):
+            if overlap_tokens + tokens > self.overlap_tokens:
+                break
+            overlap.append((unit, tokens))
+            overlap_tokens += tokens
+        self.units, self.tokens = overlap[::-1], overlap_tokens
+        self.fresh = False
+
+
+class TokenTextChunker:
+    """
+    Splits text into chunks of at most `chunk_tokens` tokens, preferring paragraph, then line, sentence and word
+    boundaries and cutting at token boundaries only as the last resort. Chunks are produced lazily, so the
+    input can be a stream of pages and the text is never held twice.
+    """
+
+    def __init__(self, chunk_tokens: int, overlap_tokens: int = 0, max_pending_chars: int = 64 * 1024):
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = min(overlap_tokens, chunk_tokens // 2)
+        self.max_pending_chars = max_pending_chars
+
+    def split_text(self, text: str) -> List[Chunk]:
+        return list(self.iter_chunks([text]))
+
+    def iter_chunks(self, pieces: Iterable[str]) -> Iterator[Chunk]:
+        window = _ChunkWindow(self.chunk_tokens, self.overlap_tokens)
+        pending: List[str] = []
+        pending_chars = 0
+        for piece in pieces:
+            paragraphs = _separators[0].split(piece)
+            if len(paragraphs) == 1:
+                # no paragraph ends in this piece yet
+                pending.append(piece)
+                pending_chars += len(piece)
+                if pending_chars >= self.max_pending_chars:
+                    yield from self.__add(window, ''.join(pending), 1)
+                    pending, pending_chars = [], 0
+                continue
+
+            paragraphs[0] = ''.join(pending) + paragraphs[0]
+            last = paragraphs.pop()
+            pending, pending_chars = [last], len(last)
+            for paragraph in paragraphs:
+                yield from self.__add(window, paragraph, 1)
+
+        if pending:
+            yield from self.__add(window, ''.join(pending), 1)
+        yield from window.emit()
+
+    def __add(self, window: _ChunkWindow, text: str, level: int) -> Iterator[Chunk]:
+        if not text:
+            return
+        tokens = count_tokens(text)
+        if tokens <= self.chunk_tokens:
+            yield from window.push(text, tokens)
+        elif level < len(_separators):
+            for part in _separators[level].split(text):
+                yield from self.__add(window, part, level + 1)
+        else:
+            encoding = get_encoding()
+            token_ids = encoding.encode(text, disallowed_special=())
+            for start in range(0, len(token_ids), self.chunk_tokens):
+                part = token_ids[start:start + self.chunk_tokens]
+                yield from window.push(encoding.decode(part), len(part))
@@ -0,0 +1,15 @@
+from functools import lru_cache
+
+import tiktoken
+
+from config import Config
+
+
+@lru_cache()
+def get_encoding() -> tiktoken.Encoding:
+    # encoding_for_model loads the BPE ranks, so it is built once per process
+    return tiktoken.encoding_for_model(Config().fast_llm_model)
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode(text, disallowed_special=()))
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List
+
+from google.cloud.firestore_v1 import AsyncClient, AsyncDocumentReference
+
+from config import Config
+from utils.db import get_async_firestore
+
+log = logging.getLogger(__name__)
+config = Config()
+
+
+@dataclass
+class _PendingWrite:
+    doc_ref: AsyncDocumentReference
+    data: Dict[str, Any]
+    merge: bool
+    attempts: int = 0
+
+
+class WriteBehindBuffer:
+    """
+    Buffers Firestore `set` writes and commits them in write batches once `batch_size` writes are pending
+    or every `interval` seconds. Writes are fire and forget, a crash loses at most one flush window.
+    """
+    max_attempts = 3
+
+    def __init__(self, get_db: Callable[[], AsyncClient], batch_size: int, interval: float):
+        self.get_db = get_db  # resolved on the first flush, not at import time
+        self.batch_size = batch_size
+        self.interval = interval
+        self._pending: List[_PendingWrite] = []
+        self._full: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    def set(self, doc_ref: AsyncDocumentReference, data: Dict[str, Any], merge: bool = False):
+        if self._task is None:
+            self._full = asyncio.Event()
+            self._task = asyncio.create_task(self.__flush_loop())
+        self._pending.append(_PendingWrite(doc_ref, data, merge))
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+
+    async def flush(self):
+        while self._pending:
+            writes, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+            batch = self.get_db().batch()
+            for write in writes:
+                batch.set(write.doc_ref, write.data, merge=write.merge)
+            try:
+                await batch.commit()
+            except asyncio.CancelledError:
+                # set() on a fixed document is idempotent, committing these again on drain is safe
+                self._pending = writes + self._pending
+                raise
+            except Exception as e:
+                retry = [w for w in writes if w.attempts + 1 < self.max_attempts]
+                for write in retry:
+                    write.attempts += 1
+                log.error(f'Could not commit {len(writes)} buffered writes, retrying {len(retry)}: {e}')
+                self._pending = retry + self._pending
+                return
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        for _ in range(self.max_attempts):  # drain
+            await self.flush()
+            if not self._pending:
+                break
+
+    async def __flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+
+firestore_write_buffer = WriteBehindBuffer(
+    get_async_firestore,
+    batch_size=config.write_behind_batch_size,
+    interval=config.write_behind_interval,
+)
@@ -1,71 +1,104 @@
-import json
 import logging
 from typing import AsyncGenerator, Annotated, List
 
-import numpy as np
-
-from fastapi import APIRouter, Header, Query
+from fastapi import APIRouter, Depends, Header, Query, Response
 from langchain.schema import HumanMessage, AIMessage
 from starlette.responses import StreamingResponse
 
+from config import Config
 from models.bookmark import VectorStoreBookmarkMetadata
-from models.chat import ChatServiceMessage, UserSearchMessage, ChatEndpointMessage
+from models.chat import ChatServiceMessage, UserSearchMessage
+from services.answer_cache_service import answer_cache
 from services.chat_history_service import ChatHistoryService
-from services.context_service import ContextService
+from services.context_service import ContextService, get_context_service
 from services.conversation_service import ConversationService
-from utils.db import get_vectorstore
+from services.llm_service import llm_service
+from utils import metrics
+from utils.admission import llm_admission
+from utils.sse import coalesce_messages, encode_json
 
 router = APIRouter()
 
 
 logger = logging.getLogger(__name__)
+config = Config()
+
 
-context_service = ContextService(client=get_vectorstore())
+def _legacy_frames(documents_json: str):
+    # protocol 1: every frame repeats the documents, only the serialised list is reused
+    def frame(msg: ChatServiceMessage) -> str:
+        return (
+            f'data: {{"chat_response":{encode_json(msg.msg)},"documents":{documents_json},'
+            f'"done":{"true" if msg.done else "false"}}}\n\n'
+        )
+    return frame
 
 
-class NumpyEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.ndarray):
-            return obj.tolist()  # Convert NumPy array to Python list
-        return super(NumpyEncoder, self).default(obj)
+def _delta_frames(msg: ChatServiceMessage) -> str:
+    # protocol 2: documents are sent once in the header event, afterwards only token deltas
+    if msg.done:
+        return 'event: done\ndata: {}\n\n'
+    return f'event: delta\ndata: {{"text":{encode_json(msg.msg)}}}\n\n'
 
 
 async def sse_generator(messages_generator: AsyncGenerator[ChatServiceMessage, None],
                         question: str,
                         conversation_service: ConversationService,
                         conversation_id: str | None = None,
-                        chat_history_service: ChatHistoryService | None = None):
-    async for msg in messages_generator:
-        msg_dict = ChatEndpointMessage(
-            chat_response=msg.msg,
-            documents=[d.metadata.dict() for d in msg.relevant_documents],
-            done=msg.done
-        ).dict()
-        if msg.done:
-            yield f"data: {json.dumps(msg_dict, cls=NumpyEncoder)}\n\n"
-            if conversation_id and chat_history_service:
-                await chat_history_service.add_chat_message(
-                    conversation_id,
-                    AIMessage(
-                        content=msg.msg,
-                    ),
-                    used_context=[d for d in msg.relevant_documents]
-                )
+                        chat_history_service: ChatHistoryService | None = None,
+                        protocol: int = 1,
+                        timing: bool = False):
+    frame = None
+    messages = coalesce_messages(messages_generator, config.sse_coalesce_window, config.sse_coalesce_bytes)
+    async for msg in messages:
+        if frame is None:
+            documents_json = encode_json([d.metadata.dict() for d in msg.relevant_documents])
+            if protocol >= 2:
+                yield f'event: header\ndata: {{"version":2,"documents":{documents_json}}}\n\n'
+                frame = _delta_frames
             else:
-                conversation_service.store_conversation(
-                    question=question,
-                    context=[d for d in msg.relevant_documents],
-                    answer=msg.msg,
-                )
-        else:
-            yield f"data: {json.dumps(msg_dict, cls=NumpyEncoder)}\n\n"
+                frame = _legacy_frames(documents_json)
+
+        yield frame(msg)
+        if msg.done:
+            with metrics.timed('chat.persist'):
+                if conversation_id and chat_history_service:
+                    chat_history_service.enqueue_chat_message(
+                        conversation_id,
+                        AIMessage(
+                            content=msg.msg,
+                        ),
+                        used_context=[d for d in msg.relevant_documents]
+                    )
+                else:
+                    conversation_service.store_conversation(
+                        question=question,
+                        context=[d for d in msg.relevant_documents],
+                        answer=msg.msg,
+                    )
+            timings = metrics.request_timings() if timing else None
+            if timings is not None:
+                # the headers were sent before any stage ran, so the timings close the stream instead
+                yield f'event: timing\ndata: {encode_json({k: v * 1000 for k, v in timings.items()})}\n\n'
 
 
 @router.get('/chat', responses={200: {"content": {"text/event-stream": {}}}})
-async def chat(q: str, conversation_id: str | None = None, selected_context: Annotated[list[str] | None, Query()] = None, x_uid: Annotated[str | None, Header()] = None):
+async def chat(q: str,
+               conversation_id: str | None = None,
+               selected_context: Annotated[list[str] | None, Query()] = None,
+               folder: Annotated[list[str] | None, Query()] = None,
+               x_uid: Annotated[str | None, Header()] = None,
+               protocol: int | None = None,
+               timing: bool = False,
+               context_service: ContextService = Depends(get_context_service)):
     if not (x_uid):
         raise Exception("user not authenticated")
     conversation_service = ConversationService(context_service=context_service, uid=x_uid)
+    prepared = await conversation_service.prepare(q, selected_context, folder)
+    if prepared.cached_answer is None:
+        # admitted before anything is stored, once the stream started a rejection could not be a 429 anymore.
+        # Cached answers make no LLM request and are never charged.
+        await llm_admission.acquire(prepared.prompt_tokens() + config.llm_answer_tokens_estimate)
     chat_history_service = ChatHistoryService(x_uid)
     if conversation_id: # continuous conversation
         await chat_history_service.add_chat_message(
@@ -74,12 +107,10 @@ async def chat(q: str, conversation_id: str | None = None, selected_context: Ann
                 content=q
             )
         )
-    completion = conversation_service.chat(
-        message=q,
-        selected_context=selected_context,
-    )
+    completion = conversation_service.chat(prepared)
     sse = StreamingResponse(
-        sse_generator(completion, q, conversation_service, conversation_id, chat_history_service),
+        sse_generator(completion, q, conversation_service, conversation_id, chat_history_service,
+                      protocol=protocol or config.sse_protocol_version, timing=timing),
         media_type='text/event-stream'
     )
 
@@ -88,35 +119,60 @@ async def chat(q: str, conversation_id: str | None = None, selected_context: Ann
     return sse
 
 
+@router.get('/chat/stats')
+async def chat_stats():
+    return {**llm_service.stats(), **answer_cache.stats(), **llm_admission.stats()}
+
+
 @router.post('/search')
-async def search(query: UserSearchMessage, x_uid: Annotated[str, Header()]) -> List[VectorStoreBookmarkMetadata]:
-    relevant_docs = context_service.search(
+async def search(query: UserSearchMessage,
+                 x_uid: Annotated[str, Header()],
+                 context_service: ContextService = Depends(get_context_service)) -> List[VectorStoreBookmarkMetadata]:
+    relevant_docs = await context_service.asearch(
         query.query,
         x_uid,
         certainty=query.certainty,
         alpha=query.alpha,
-        limit=query.limit_chunks
+        limit=query.limit_chunks,
+        folders=query.folders,
+        group_by_bookmark=query.group_by_bookmark,
+        mmr_lambda=query.mmr_lambda,
     )
 
+    if query.group_by_bookmark:
+        return [d.metadata for d in relevant_docs]  # already distinct and in MMR order
     return sorted(list({d.metadata for d in relevant_docs}), key=lambda x: x.similarity_score, reverse=True)
 
 @router.put('/conversation')
-async def create_conversation(x_uid: Annotated[str, Header()]):
+async def create_conversation(x_uid: Annotated[str, Header()],
+                              context_service: ContextService = Depends(get_context_service)):
     conversation_service = ConversationService(context_service=context_service, uid=x_uid)
-    conv_id = conversation_service.create_new_conversation()
+    conv_id = await conversation_service.create_new_conversation()
 
     return conv_id
 
 @router.get('/conversations')
-async def get_conversations(x_uid: Annotated[str, Header()]):
+async def get_conversations(x_uid: Annotated[str, Header()],
+                            response: Response,
+                            limit: int | None = None,
+                            cursor: str | None = None):
     conversation_service = ChatHistoryService(x_uid)
-    conversations = await conversation_service.get_conversations()
+    page = await conversation_service.get_conversations(limit=limit, cursor=cursor)
+    if page.next_cursor:
+        response.headers['X-Next-Cursor'] = page.next_cursor
 
-    return conversations
+    return page.conversations
 
 @router.get('/chat-history')
-async def get_chat_history(conversation_id: str, x_uid: Annotated[str, Header()]):
+async def get_chat_history(conversation_id: str,
+                           x_uid: Annotated[str, Header()],
+                           response: Response,
+                           limit: int | None = None,
+                           cursor: str | None = None):
     chat_history_service = ChatHistoryService(x_uid)
-    chat_history = await chat_history_service.get_chat_history(conversation_id)
+    page = await chat_history_service.get_chat_history(conversation_id, limit=limit, cursor=cursor)
+    if page.next_cursor:
+        # the body stays a plain list for older extension versions
+        response.headers['X-Next-Cursor'] = page.next_cursor
 
-    return chat_history
\ No newline at end of file
+    return page.messages
\ No newline at end of file
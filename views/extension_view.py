@@ -1,109 +1,165 @@
 import asyncio
-import io
 import logging
+import os
+import tempfile
 from typing import Annotated, List
-from fastapi import APIRouter, Header
-from langchain.text_splitter import CharacterTextSplitter
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
 
 from config import Config
-from models.extension import ExtensionDocument, ExtensionPDFDocument, UrlMetadataInfo
+from models.deletion import DeleteJob, DeleteJobStatus
+from models.extension import ExtensionDocument, ExtensionPDFDocument, ExtensionPDFMetadata, UrlBatchMetadataInfo, UrlMetadataInfo
+from models.ingest import BulkImportResult, IngestJob
 from services.bookmark_store_service import AsyncBookmarkStoreService
-from services.context_service import ContextService
-from utils.db import get_vectorstore, firebase_app as db
-import PyPDF2
+from services.bulk_import_service import BulkImportService
+from services.deletion_service import deletion_service
+from services.embedding_service import embedding_service
+from services.ingest_service import ingest_service
+from utils.pdf import iter_pdf_pages
+from utils.text_chunker import TokenTextChunker
 
 router = APIRouter()
 config = Config()
 log = logging.getLogger(__name__)
 
 
+chunker = TokenTextChunker(config.chunk_tokens, config.chunk_overlap_tokens)
+
+
+def _submit_pdf_file(user_id: str, document: ExtensionPDFMetadata, path: str, idempotency_key: str | None) -> IngestJob:
+    async def load_chunks():
+        try:
+            pages = [page_text async for page_text in iter_pdf_pages(path)]
+        finally:
+            os.unlink(path)
+        # pages are fed to the chunker as they are, the document text is never joined
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: list(chunker.iter_chunks(pages)))
+
+    # a retry with the same key may have submitted while this upload was written, its file is not needed
+    if job := ingest_service.get_idempotent_job(user_id, idempotency_key):
+        os.unlink(path)
+        return job
+    return ingest_service.submit(user_id, document, load_chunks, idempotency_key)
+
+
 @router.post('/store')
-async def store(document: ExtensionDocument, x_uid: Annotated[str, Header()]):
-    vectorstore = get_vectorstore()
-    user_id = x_uid
-    chunks = CharacterTextSplitter(
-        chunk_size=config.chunk_size, chunk_overlap=config.chunk_overlap, separator='.'
-    ).split_text(document.raw_text)
-    log.info(f'created {len(chunks)} chunks')
-    bookmark_service = AsyncBookmarkStoreService()
-    bookmark_ref = await bookmark_service.add_bookmark(user_id, document)
-
-    try:
-        with vectorstore.batch() as batch:
-            for chunk in chunks:
-                batch.add_data_object({
-                    "title": document.title,
-                    "content": chunk,
-                    "user_id": user_id,
-                    "url": document.url,
-                    "firebase_id": bookmark_ref.id,  # all chunks have same firebase id
-                }, "Document")
-            batch.flush()
-    except Exception as e:
-        log.error(e)
-        await bookmark_service.delete_user_bookmark(user_id, document)
-        return {'success': False, 'error': str(e)}
-
-    return {'success': True}
+async def store(document: ExtensionDocument,
+                x_uid: Annotated[str, Header()],
+                idempotency_key: Annotated[str | None, Header()] = None):
+    """
+    Submits with the same Idempotency-Key return the job of the first one instead of storing the page again.
+    """
+    async def load_chunks():
+        return await asyncio.get_running_loop().run_in_executor(None, chunker.split_text, document.raw_text)
+
+    job = ingest_service.submit(x_uid, document, load_chunks, idempotency_key)
+    return {'success': True, 'job_id': job.id}
+
+
+@router.post('/store/bulk')
+async def store_bulk(request: Request, x_uid: Annotated[str, Header()]) -> BulkImportResult:
+    """
+    Takes one ExtensionDocument per line (Content-Type: application/x-ndjson) and imports them all,
+    returning a result per line once every document is stored or has failed.
+    """
+    return await BulkImportService(x_uid, chunker).import_documents(request.stream())
 
 
 @router.post('/storepdf')
-async def store_pdf(document: ExtensionPDFDocument, x_uid: Annotated[str, Header()]):
-    vectorstore = get_vectorstore()
-    user_id = x_uid
-    pdf_bytes = bytes(document.pdf_bytes)
-
-    pdf_text = ''
-    reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
-    num_pages = len(reader.pages)
-
-    for page_number in range(num_pages):
-        page = reader.pages[page_number]
-        pdf_text += page.extract_text()
-
-    chunks = CharacterTextSplitter(
-        chunk_size=config.chunk_size, chunk_overlap=config.chunk_overlap, separator='.'
-    ).split_text(pdf_text)
-    log.info(f'created {len(chunks)} chunks')
-    bookmark_store_service = AsyncBookmarkStoreService()
-    bookmark_ref = await bookmark_store_service.add_bookmark(user_id, document)
-
-    try:
-        with vectorstore.batch() as batch:
-            for chunk in chunks:
-                batch.add_data_object({
-                    "title": document.title,
-                    "content": chunk,
-                    "user_id": user_id,
-                    "url": document.url,
-                    "firebase_id": bookmark_ref.id,  # all chunks have same firebase id
-                }, "Document")
-            batch.flush()
-    except Exception as e:
-        log.error(e)
-        await bookmark_store_service.delete_user_bookmark(user_id, document)
-        return {'success': False, 'error': str(e)}
-
-    return {'success': True}
+async def store_pdf(document: ExtensionPDFDocument,
+                    x_uid: Annotated[str, Header()],
+                    idempotency_key: Annotated[str | None, Header()] = None):
+    # compatibility shim for extension versions that send the PDF as a JSON list of ints
+    if job := ingest_service.get_idempotent_job(x_uid, idempotency_key):
+        return {'success': True, 'job_id': job.id}
+    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as pdf_file:
+        pdf_file.write(bytes(document.pdf_bytes))
+    document.pdf_bytes = []
+    job = _submit_pdf_file(x_uid, document, pdf_file.name, idempotency_key)
+    return {'success': True, 'job_id': job.id}
+
+
+@router.post('/storepdf/upload')
+async def store_pdf_upload(request: Request,
+                           x_uid: Annotated[str, Header()],
+                           document: ExtensionPDFMetadata = Depends(),
+                           idempotency_key: Annotated[str | None, Header()] = None):
+    """
+    Takes the raw PDF as the request body (Content-Type: application/pdf) and the bookmark
+    metadata as query parameters. The body is streamed to a temporary file and never held in memory.
+    """
+    if job := ingest_service.get_idempotent_job(x_uid, idempotency_key):
+        return {'success': True, 'job_id': job.id}
+    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as pdf_file:
+        try:
+            async for body_chunk in request.stream():
+                await asyncio.to_thread(pdf_file.write, body_chunk)
+        except BaseException:
+            # the client went away or the body broke off, nothing will load the file
+            pdf_file.close()
+            os.unlink(pdf_file.name)
+            raise
+    job = _submit_pdf_file(x_uid, document, pdf_file.name, idempotency_key)
+    return {'success': True, 'job_id': job.id}
+
+
+@router.get('/store/status/{job_id}')
+async def store_status(job_id: str, x_uid: Annotated[str, Header()]) -> IngestJob:
+    job = ingest_service.get_job(job_id)
+    if job is None or job.user_id != x_uid:
+        raise HTTPException(status_code=404, detail=f'Job {job_id} does not exist')
+    return job
+
+
+@router.get('/store/embedding-cache')
+async def embedding_cache_stats():
+    return embedding_service.stats()
 
 
 @router.get('/info')
 async def url_metadata(url: str, x_uid: Annotated[str, Header()]) -> UrlMetadataInfo:
-    service = AsyncBookmarkStoreService()
-    bookmarks, folders = await asyncio.gather(service.get_bookmarks_by_url(x_uid, url), service.get_user_folders(x_uid))
+    is_bookmarked, folders = await AsyncBookmarkStoreService().get_url_info(x_uid, [url])
     return UrlMetadataInfo(
-        is_bookmarked=len(bookmarks) > 0,
+        is_bookmarked=is_bookmarked[url],
         folders=folders,
     )
 
+
+@router.post('/info/batch')
+async def batch_url_metadata(urls: List[str], x_uid: Annotated[str, Header()]) -> UrlBatchMetadataInfo:
+    """
+    Answers /info for every open tab in one call.
+    """
+    if len(urls) > config.info_batch_max_urls:
+        raise HTTPException(status_code=400, detail=f'At most {config.info_batch_max_urls} URLs can be looked up at once')
+    is_bookmarked, folders = await AsyncBookmarkStoreService().get_url_info(x_uid, urls)
+    return UrlBatchMetadataInfo(is_bookmarked=is_bookmarked, folders=folders)
+
 @router.post('/batch-delete')
-async def batch_delete(documents: List[str], x_uid: Annotated[str, Header()], folders: List[str] = None):
-    bookmark_service = AsyncBookmarkStoreService()
-    context_service = ContextService(get_vectorstore())
-    try:
-        context_service.batch_delete(x_uid, documents)
-        await bookmark_service.batch_delete(x_uid, documents, folders)
-        return {'success': True}
-    except Exception as e:
-        log.error(e)
-        return {'success': False, 'error': str(e)}
\ No newline at end of file
+async def batch_delete(documents: List[str], x_uid: Annotated[str, Header()], folders: List[str] = None, wait: bool = True):
+    """
+    Deletes the bookmarks and their chunks as a background job. With `wait` the response is sent once the
+    job is finished, otherwise right away and the job can be polled.
+    """
+    job = deletion_service.submit(x_uid, documents, folders)
+    if not wait:
+        return {'success': True, 'job_id': job.id}
+    await deletion_service.wait(job)
+    if job.status == DeleteJobStatus.failed:
+        return {'success': False, 'error': job.error, 'job_id': job.id}
+    return {'success': True, 'job_id': job.id}
+
+
+@router.get('/batch-delete/status/{job_id}')
+async def batch_delete_status(job_id: str, x_uid: Annotated[str, Header()]) -> DeleteJob:
+    job = deletion_service.get_job(job_id)
+    if job is None or job.user_id != x_uid:
+        raise HTTPException(status_code=404, detail=f'Job {job_id} does not exist')
+    return job
+
+
+@router.post('/batch-delete/{job_id}/resume')
+async def batch_delete_resume(job_id: str, x_uid: Annotated[str, Header()]) -> DeleteJob:
+    job = deletion_service.get_job(job_id)
+    if job is None or job.user_id != x_uid:
+        raise HTTPException(status_code=404, detail=f'Job {job_id} does not exist')
+    return deletion_service.resume(job_id)